@@ -0,0 +1,166 @@
+"""朝の占いの生成方式のベンチマーク：1人1回 vs K人分を1回（FORTUNE_BATCH_SIZE）
+
+既定ではGeminiを模擬したモデル（呼び出しごとの固定の遅延 + 出力文字数に比例する遅延）で計測し、
+呼び出し回数・スループット・1人あたりの入出力文字数と推定コストを比較する。
+--live を付けると実際のGemini APIを呼ぶ（GEMINI_API_KEY が必要、課金に注意）。
+
+    python benchmarks/bench_batch_generation.py
+    python benchmarks/bench_batch_generation.py --users 400 --batch-sizes 4 8 16
+    python benchmarks/bench_batch_generation.py --live --users 16 --batch-sizes 8
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--users', type=int, default=200)
+parser.add_argument('--batch-sizes', type=int, nargs='+', default=[4, 8, 16])
+parser.add_argument('--live', action='store_true', help="実際のGemini APIを呼ぶ")
+parser.add_argument('--base-latency', type=float, default=0.8, help="模擬：1回あたりの固定の遅延（秒）")
+parser.add_argument('--per-char-latency', type=float, default=0.004, help="模擬：出力1文字あたりの遅延（秒）")
+parser.add_argument('--time-scale', type=float, default=0.05, help="模擬：遅延に掛ける倍率")
+parser.add_argument('--input-price', type=float, default=0.5, help="入力100万文字あたりの料金（USD）")
+parser.add_argument('--output-price', type=float, default=1.5, help="出力100万文字あたりの料金（USD）")
+args = parser.parse_args()
+
+if not args.live:
+    # 模擬ではクォータで頭打ちにならないようにする（同時実行数の上限はそのまま）
+    os.environ.setdefault('GEMINI_RATE_PER_MINUTE', '1000000')
+    os.environ.setdefault('GEMINI_BURST', '1000')
+
+from delivery import FanOutDelivery
+from gemini_client import gemini
+from scheduler import fortune_scheduler
+
+FORTUNE_BODY = "総合運：★★★★☆\n今日は素直な気持ちが伝わる日💕 いつもより少しだけ勇気を出して、" \
+               "気になる人に自分から声をかけてみて。\n恋愛運のピークは14:00-15:00。" \
+               "この時間のメッセージは特に好印象を残せます📱\nラッキーアクションは「いつもと違う道で帰る」こと🍀 " \
+               "小さな変化が新しいご縁を運んできます。\n迷ったときは笑顔を選んで✨ " \
+               "あなたの優しさに、きっと誰かが気づいてくれます。焦らず、自分らしいペースで進んでいきましょう！"
+
+
+class SimulatedResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class Meter:
+    """呼び出し回数と入出力の文字数"""
+
+    def __init__(self):
+        self.calls = 0
+        self.input_chars = 0
+        self.output_chars = 0
+        self.lock = threading.Lock()
+
+    def add(self, prompt, text):
+        with self.lock:
+            self.calls += 1
+            self.input_chars += len(prompt)
+            self.output_chars += len(text)
+
+
+def simulated_generate_content(meter):
+    def generate_content(prompt, request_options=None):
+        user_list = prompt.split("【ユーザー一覧】", 1)[-1].split("1人あたり", 1)[0]
+        ids = [int(n) for n in re.findall(r'"id": (\d+)', user_list)]
+        if "JSON配列" in prompt:
+            text = json.dumps([{"id": n, "fortune": FORTUNE_BODY} for n in ids], ensure_ascii=False)
+        else:
+            text = FORTUNE_BODY
+        time.sleep((args.base_latency + args.per_char_latency * len(text)) * args.time_scale)
+        meter.add(prompt, text)
+        return SimulatedResponse(text)
+    return generate_content
+
+
+def live_generate_content(meter, original):
+    def generate_content(prompt, request_options=None):
+        response = original(prompt, request_options=request_options)
+        meter.add(prompt, response.text)
+        return response
+    return generate_content
+
+
+def make_users(count):
+    statuses = ["片想い", "恋人がいる", "復縁したい", "出会いを探してる"]
+    concerns = ["相手の気持ち", "タイミング", "自分の魅力", "将来のこと"]
+    users = []
+    for i in range(count):
+        users.append((f"U{i:032x}", {
+            "name": f"ユーザー{i}",
+            "animal_character": {"name": "ゾウ", "traits": "真面目で努力家"},
+            "sanmeigaku": {"jikkan": "乙", "element": "乙亥", "traits": "柔軟で協調性がある"},
+            "relationship_status": statuses[i % 4],
+            "main_concern": concerns[i % 4],
+            "is_premium": False,
+        }))
+    return users
+
+
+def run(label, users, batch_size):
+    meter = Meter()
+    original = gemini.model.generate_content
+    if args.live:
+        gemini.model.generate_content = live_generate_content(meter, original)
+    else:
+        gemini.model.generate_content = simulated_generate_content(meter)
+    stored = {}
+    fortune_date = date.today()
+    started = time.perf_counter()
+    try:
+        if batch_size == 1:
+            engine = FanOutDelivery(
+                label,
+                generate=lambda user_id, user_data: fortune_scheduler.generate_personalized_morning_fortune(
+                    user_data, fortune_date
+                ),
+                push=stored.__setitem__
+            )
+            engine.run(users)
+        else:
+            fortune_scheduler.pregenerate_in_batches(users, fortune_date, stored.__setitem__, batch_size)
+    finally:
+        gemini.model.generate_content = original
+    elapsed = time.perf_counter() - started
+
+    fortunes = len(stored)
+    cost = (meter.input_chars * args.input_price + meter.output_chars * args.output_price) / 1_000_000
+    return {
+        'label': label,
+        'calls': meter.calls,
+        'elapsed': elapsed,
+        'per_sec': fortunes / elapsed if elapsed else 0.0,
+        'input_per_fortune': meter.input_chars / fortunes if fortunes else 0,
+        'output_per_fortune': meter.output_chars / fortunes if fortunes else 0,
+        'cost_per_1000': cost / fortunes * 1000 if fortunes else 0.0,
+    }
+
+
+def main():
+    users = make_users(args.users)
+    mode = "live Gemini" if args.live else f"simulated (time scale {args.time_scale})"
+    print(f"users = {args.users}, {mode}")
+
+    results = [run('single', users, 1)]
+    for batch_size in args.batch_sizes:
+        results.append(run(f'batch K={batch_size}', users, batch_size))
+
+    baseline = results[0]
+    print(f"  {'mode':<12} {'calls':>6} {'seconds':>8} {'fortunes/s':>11} "
+          f"{'in chars':>9} {'out chars':>10} {'$/1000':>8} {'speedup':>8}")
+    for r in results:
+        print(f"  {r['label']:<12} {r['calls']:>6} {r['elapsed']:>8.2f} {r['per_sec']:>11.1f} "
+              f"{r['input_per_fortune']:>9.0f} {r['output_per_fortune']:>10.0f} "
+              f"{r['cost_per_1000']:>8.4f} {r['per_sec'] / baseline['per_sec']:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
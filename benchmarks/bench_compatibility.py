@@ -0,0 +1,78 @@
+"""相性スコアのベンチマーク：1組ずつの計算 vs CompatibilityCalculator の一括計算
+
+    python benchmarks/bench_compatibility.py
+    python benchmarks/bench_compatibility.py --pairs 1000000 --per-pair-sample 20000
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compatibility import CompatibilityCalculator, SCORE_TABLE
+
+
+def random_birthdays(size, seed):
+    rng = np.random.default_rng(seed)
+    start = np.datetime64('1950-01-01')
+    return start + rng.integers(0, 60 * 365, size=size).astype('timedelta64[D]')
+
+
+def score_pair(key_a, key_b):
+    """1組ずつ関係を判定して合計する（表を使わない場合）"""
+    calc = CompatibilityCalculator
+    (pillar_a, animal_a), (pillar_b, animal_b) = divmod(key_a, 12), divmod(key_b, 12)
+    total = (
+        calc.WEIGHTS["jikkan"] * calc.jikkan_relation(pillar_a % 10, pillar_b % 10)[1]
+        + calc.WEIGHTS["junishi"] * calc.junishi_relation(pillar_a % 12, pillar_b % 12)[1]
+        + calc.WEIGHTS["animal"] * calc.animal_relation(animal_a, animal_b)[1]
+    )
+    return int(np.rint((total - 1) / 4 * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pairs', type=int, default=1000000)
+    parser.add_argument('--per-pair-sample', type=int, default=20000,
+                        help="1組ずつの計算はこの件数で計測して pairs 件に換算する")
+    args = parser.parse_args()
+
+    user = random_birthdays(1, seed=1)
+    candidates = random_birthdays(args.pairs, seed=2)
+    print(f"pairs = {args.pairs}")
+
+    started = time.perf_counter()
+    user_key = CompatibilityCalculator.keys(user)
+    candidate_keys = CompatibilityCalculator.keys(candidates)
+    keys_time = time.perf_counter() - started
+    print(f"  keys (birthday -> key):     {keys_time:8.3f}s")
+
+    sample = candidate_keys[:args.per_pair_sample]
+    started = time.perf_counter()
+    expected = [score_pair(int(user_key[0]), int(key)) for key in sample]
+    per_pair = (time.perf_counter() - started) / len(sample) * args.pairs
+    print(f"  per-pair:                   {per_pair:8.3f}s  (extrapolated from {len(sample)})")
+
+    started = time.perf_counter()
+    scores = CompatibilityCalculator.score_many(user_key, candidate_keys)
+    one_to_many = time.perf_counter() - started
+    print(f"  score_many (1 x {args.pairs}):  {one_to_many:8.3f}s  ({per_pair / one_to_many:.0f}x)")
+    assert (scores[:len(sample)] == np.array(expected)).all()
+
+    side = int(np.sqrt(args.pairs))
+    started = time.perf_counter()
+    matrix = CompatibilityCalculator.score_matrix(candidate_keys[:side], candidate_keys[side:2 * side])
+    n_by_m = time.perf_counter() - started
+    print(f"  score_matrix ({side} x {side}): {n_by_m:8.3f}s  ({per_pair / n_by_m:.0f}x)")
+
+    started = time.perf_counter()
+    top = CompatibilityCalculator.top_k(user_key, candidate_keys, k=10)
+    print(f"  top_k (k=10):               {time.perf_counter() - started:8.3f}s  best={top[0][1]}")
+    print(f"  score table: {SCORE_TABLE.nbytes / 1024:.0f} KiB, matrix: {matrix.nbytes / 1024 / 1024:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
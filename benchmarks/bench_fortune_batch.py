@@ -0,0 +1,58 @@
+"""FortuneCalculator のベンチマーク：1件ずつの計算 vs calculate_batch
+
+    python benchmarks/bench_fortune_batch.py
+    python benchmarks/bench_fortune_batch.py --size 1000000 --per-call-sample 100000
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fortune_logic import FortuneCalculator
+
+
+def random_birthdays(size, seed=0):
+    rng = np.random.default_rng(seed)
+    start = np.datetime64('1950-01-01')
+    return start + rng.integers(0, 60 * 365, size=size).astype('timedelta64[D]')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=1000000)
+    parser.add_argument('--per-call-sample', type=int, default=100000,
+                        help="1件ずつの計算はこの件数で計測して size 件に換算する")
+    args = parser.parse_args()
+
+    dates = random_birthdays(args.size)
+    strings = [f"{d.year}年{d.month}月{d.day}日" for d in dates.astype(object)]
+    print(f"birthdays = {args.size}")
+
+    sample = strings[:args.per_call_sample]
+    started = time.perf_counter()
+    for birthday in sample:
+        FortuneCalculator.calculate_sanmeigaku(birthday)
+        FortuneCalculator.calculate_animal_character(birthday)
+    per_call = (time.perf_counter() - started) / len(sample) * args.size
+    print(f"  per-call (sanmeigaku + animal): {per_call:8.2f}s  (extrapolated from {len(sample)})")
+
+    started = time.perf_counter()
+    result = FortuneCalculator.calculate_batch(strings)
+    batch_strings = time.perf_counter() - started
+    print(f"  calculate_batch(strings):       {batch_strings:8.2f}s  ({per_call / batch_strings:.1f}x)")
+
+    started = time.perf_counter()
+    result_dates = FortuneCalculator.calculate_batch(dates)
+    batch_dates = time.perf_counter() - started
+    print(f"  calculate_batch(datetime64):    {batch_dates:8.2f}s  ({per_call / batch_dates:.0f}x)")
+
+    assert (result == result_dates).all()
+    print(f"  result size: {result.nbytes / 1024 / 1024:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
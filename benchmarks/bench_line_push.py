@@ -0,0 +1,117 @@
+"""LINE push のベンチマーク：SDK標準の LineBotApi vs LineClient（接続プール + push_many）
+
+ローカルで LINE API の代わりのHTTPサーバーを立て、そこへ push を送って比較する。
+サーバーは1リクエストごとに --server-latency 秒待ってから200を返す。
+
+    python benchmarks/bench_line_push.py
+    python benchmarks/bench_line_push.py --pushes 2000 --in-flight 8 16 32 --server-latency 0.02
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from linebot import LineBotApi
+from linebot.models import TextSendMessage
+
+from line_client import LineClient
+
+warnings.filterwarnings('ignore')
+
+
+class StandInLineServer(ThreadingHTTPServer):
+    """LINE Messaging API の代わりをするHTTPサーバー"""
+
+    daemon_threads = True
+
+    def __init__(self, latency):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.latency = latency
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive を有効にする
+    disable_nagle_algorithm = True   # ヘッダーと本文を別々に書くので遅延ACKで40ms待たないように
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+        body = b'{"sentMessages":[]}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def pushes(count):
+    message = TextSendMessage(text="おはようございます☀️ 今日の運勢をお届けします")
+    return ((f"U{i:032x}", message) for i in range(count))
+
+
+def report(label, server, count, elapsed, stats=None):
+    line = (f"  {label:<28} {elapsed:7.2f}s  {count / elapsed:8.1f} pushes/sec  "
+            f"{server.connections:5d} connections")
+    if stats:
+        line += f"  p50 {stats['p50'] * 1000:.1f}ms / p95 {stats['p95'] * 1000:.1f}ms"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pushes', type=int, default=1000)
+    parser.add_argument('--sequential-pushes', type=int, default=200,
+                        help="SDK標準（逐次）はこの件数で計測する")
+    parser.add_argument('--in-flight', type=int, nargs='+', default=[1, 8, 16, 32])
+    parser.add_argument('--server-latency', type=float, default=0.01)
+    args = parser.parse_args()
+
+    print(f"stand-in LINE server latency {args.server_latency * 1000:.0f}ms")
+
+    server = StandInLineServer(args.server_latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        # SDK標準：1件ずつ送り、毎回接続を張り直す
+        api = LineBotApi('dummy', endpoint=server.endpoint)
+        started = time.perf_counter()
+        for to, message in pushes(args.sequential_pushes):
+            api.push_message(to, message)
+        report('LineBotApi (sequential)', server, args.sequential_pushes,
+               time.perf_counter() - started)
+
+        for in_flight in args.in_flight:
+            server.connections = 0
+            client = LineClient('dummy', endpoint=server.endpoint, max_in_flight=in_flight)
+            result = client.push_many(pushes(args.pushes))
+            assert result['errors'] == 0, result['failed'][:3]
+            report(f'LineClient.push_many x{in_flight}', server, args.pushes,
+                   result['elapsed'], client.push_stats.summary())
+        print(f"  latency histogram (last run): {client.push_stats.histogram()}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
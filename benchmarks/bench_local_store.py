@@ -0,0 +1,89 @@
+"""ローカル保存のベンチマーク：従来のJSONファイル vs SQLiteUserStore
+
+1人分の書き込み（main.save_user_data / update_user_fields 相当）の時間を、
+ユーザー数 10k / 100k で比較する。
+
+    python benchmarks/bench_local_store.py
+    python benchmarks/bench_local_store.py --sizes 10000 100000 --writes 20
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_store import SQLiteUserStore
+
+
+def make_user(i):
+    return {
+        "created_at": "2024-01-01T00:00:00",
+        "name": f"user{i}",
+        "gender": "女性",
+        "birthday": "1995年4月15日",
+        "onboarding_stage": 5,
+        "onboarding_complete": True,
+        "relationship_status": "片想い",
+        "main_concern": "タイミング",
+        "sanmeigaku": {"jikkan": "乙", "junishi": "亥", "element": "乙亥",
+                       "traits": "柔軟で協調性がある", "love_tendency": "相手に合わせながら、じっくり関係を築く"},
+        "animal_character": {"name": "ゾウ", "traits": "真面目で努力家", "love": "誠実で長続きする愛"},
+        "palm_analysis": None,
+        "is_premium": False,
+    }
+
+
+def json_update(path, user_id, changes):
+    """main.py の従来のJSONモードと同じ書き込み（全体を読み込んで全体を書き出す）"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            users_data = json.load(f)
+    except Exception:
+        users_data = {}
+    users_data.setdefault(user_id, {}).update(changes)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(users_data, f, ensure_ascii=False, indent=2)
+
+
+def measure(label, func, user_ids, writes):
+    targets = random.sample(user_ids, writes)
+    started = time.perf_counter()
+    for n, user_id in enumerate(targets):
+        func(user_id, {"onboarding_stage": n % 6})
+    elapsed = time.perf_counter() - started
+    per_write = elapsed / writes
+    print(f"  {label:<8} {writes:>6} writes  {per_write * 1000:10.2f} ms/write  {1 / per_write:10.1f} writes/sec")
+    return per_write
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--writes', type=int, default=20, help="JSONで計測する書き込み回数")
+    parser.add_argument('--sqlite-writes', type=int, default=2000)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        print(f"users = {size}")
+        users = {f"U{i:032x}": make_user(i) for i in range(size)}
+        user_ids = list(users)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path = os.path.join(tmp, 'users_data.json')
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump(users, f, ensure_ascii=False, indent=2)
+            store = SQLiteUserStore(os.path.join(tmp, 'users_data.sqlite3'))
+            store.import_json(json_path)
+
+            json_time = measure('json', lambda u, c: json_update(json_path, u, c),
+                                user_ids, args.writes)
+            sqlite_time = measure('sqlite', store.update, user_ids, args.sqlite_writes)
+            print(f"  speedup: {json_time / sqlite_time:.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os
+import re
+import unicodedata
+from datetime import date
+from functools import lru_cache
+
+# 解析結果をキャッシュする件数
+BIRTHDAY_CACHE_SIZE = int(os.environ.get('BIRTHDAY_CACHE_SIZE', 4096))
+
+# 西暦の書き方
+WESTERN_PATTERNS = [
+    re.compile(r'(\d{4})年(\d{1,2})月(\d{1,2})日'),
+    re.compile(r'(\d{4})/(\d{1,2})/(\d{1,2})'),
+    re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})'),
+]
+
+# 和暦（元年にも対応）
+ERA_PATTERN = re.compile(r'(令和|平成|昭和)(\d{1,2}|元)年(\d{1,2})月(\d{1,2})日')
+
+# 元号ごとの「元年の前年」の西暦
+ERA_OFFSETS = {"令和": 2018, "平成": 1988, "昭和": 1925}
+
+
+@lru_cache(maxsize=BIRTHDAY_CACHE_SIZE)
+def parse_birthday(text):
+    """生年月日の文字列を date に変換
+
+    全角数字・全角記号は半角にそろえてから解析する。
+    読み取れない場合や存在しない日付（2月30日など）は None。
+    """
+    if not text:
+        return None
+    normalized = unicodedata.normalize('NFKC', text)
+
+    for pattern in WESTERN_PATTERNS:
+        match = pattern.search(normalized)
+        if match:
+            year, month, day = map(int, match.groups())
+            return _make_date(year, month, day)
+
+    match = ERA_PATTERN.search(normalized)
+    if match:
+        era, era_year, month, day = match.groups()
+        era_year = 1 if era_year == "元" else int(era_year)
+        return _make_date(ERA_OFFSETS[era] + era_year, int(month), int(day))
+
+    return None
+
+
+def _make_date(year, month, day):
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None
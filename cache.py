@@ -0,0 +1,77 @@
+import copy
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """件数上限つきのLRU+TTLキャッシュ（スレッドセーフ）
+
+    値は保存時と取得時にコピーするため、呼び出し側が辞書を書き換えても
+    キャッシュの中身は変わらない。
+    """
+
+    def __init__(self, maxsize=1000, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {
+            'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'stale': 0, 'invalidations': 0
+        }
+
+    def get(self, key):
+        """値を取得（なければ・期限切れならNone）"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._data[key]
+                self.counters['expired'] += 1
+                self.counters['misses'] += 1
+                return None
+            self._data.move_to_end(key)
+            self.counters['hits'] += 1
+        return copy.deepcopy(value)
+
+    def set(self, key, value, ttl=None):
+        """値を保存（ttl を渡すとこのエントリだけ有効期限を変える）"""
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def update(self, key, changes):
+        """キャッシュ済みの辞書に変更を反映（書き込みスルー）。なければ何もしない"""
+        changes = copy.deepcopy(changes)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                entry[1].update(changes)
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.counters['invalidations'] += 1
+
+    def record_stale(self, key):
+        """取得後に古いと判明した（別プロセスで更新されていた）エントリを捨てる"""
+        with self._lock:
+            self._data.pop(key, None)
+            self.counters['hits'] -= 1
+            self.counters['misses'] += 1
+            self.counters['stale'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters, size=len(self._data), maxsize=self.maxsize, ttl=self.ttl)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,130 @@
+import os
+import threading
+from datetime import date
+
+import numpy as np
+
+# 暦テーブル（scripts/build_calendar_table.py で生成したもの）
+CALENDAR_TABLE_PATH = os.environ.get(
+    'CALENDAR_TABLE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'calendar_table.npy')
+)
+
+# テーブルの範囲（1日1行）
+FIRST_DATE = date(1900, 1, 1)
+LAST_DATE = date(2100, 12, 31)
+FIRST_ORDINAL = FIRST_DATE.toordinal()
+
+# 干支はすべて60周期の番号（0=甲子 … 59=癸亥）。十干は番号%10、十二支は番号%12
+TABLE_DTYPE = np.dtype([
+    ('year_pillar', 'i1'),  # 年柱（年の区切りは立春）
+    ('day_pillar', 'i1'),   # 日柱
+    ('animal', 'i1'),       # 動物占い60分類の番号-1
+])
+
+# 動物占い60分類（番号順）
+ANIMAL_60 = [
+    "長距離ランナーのチータ", "社交家のたぬき", "落ち着きのない猿", "フットワークの軽い子守熊",
+    "面倒見のいい黒ひょう", "愛情あふれる虎", "全力疾走するチータ", "磨き上げられたたぬき",
+    "大きな志をもった猿", "母性豊かな子守熊", "正直なこじか", "人気者のゾウ",
+    "ネアカの狼", "協調性のないひつじ", "どっしりとした猿", "コアラのなかの子守熊",
+    "強い意志をもったこじか", "デリケートなゾウ", "放浪の狼", "物静かなひつじ",
+    "落ち着きのあるペガサス", "強靭な翼をもつペガサス", "無邪気なひつじ", "クリエイティブな狼",
+    "穏やかな狼", "粘り強いひつじ", "波乱に満ちたペガサス", "優雅なペガサス",
+    "チャレンジ精神の旺盛なひつじ", "順応性のある狼", "リーダーとなるゾウ", "しっかり者のこじか",
+    "活動的な子守熊", "気分屋の猿", "頼られると嬉しいひつじ", "好感のもたれる狼",
+    "まっしぐらに突き進むゾウ", "華やかなこじか", "夢とロマンの子守熊", "尽くす猿",
+    "大器晩成のたぬき", "足腰の強いチータ", "動きまわる虎", "情熱的な黒ひょう",
+    "サービス精神旺盛な子守熊", "守りの猿", "人間味あふれるたぬき", "品格のあるチータ",
+    "ゆったりとした悠然の虎", "落ち込みの激しい黒ひょう", "我が道を行くライオン", "統率力のあるライオン",
+    "感情豊かな黒ひょう", "楽天的な虎", "パワフルな虎", "気取らない黒ひょう",
+    "感情的なライオン", "傷つきやすいライオン", "束縛を嫌う黒ひょう", "慈悲深い虎",
+]
+
+# 60分類 -> 12分類の名前（子守熊は FortuneCalculator.ANIMAL_CHARACTERS に合わせて「コアラ」）
+_ANIMAL_BASES = ["黒ひょう", "チータ", "たぬき", "子守熊", "こじか", "ゾウ",
+                 "ひつじ", "ペガサス", "ライオン", "狼", "猿", "虎"]
+ANIMAL_60_BASE = [
+    next(base for base in _ANIMAL_BASES if name.endswith(base)).replace("子守熊", "コアラ")
+    for name in ANIMAL_60
+]
+
+# 日柱の基準：ユリウス通日(JDN)から (JDN + 49) % 60。date.toordinal() + 1721425 = JDN
+_JDN_OFFSET = 1721425
+_UNIX_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+_table = None
+_lock = threading.Lock()
+
+
+def _risshun_day(years):
+    """立春の2月の日付（寿星万年暦の近似式。境界付近で±1日ずれることがある）"""
+    y2 = years % 100
+    c = np.where((years - 1) // 100 >= 20, 3.87, 4.6295)
+    leaps = np.maximum((y2 - 1) // 4, 0)
+    return np.floor(y2 * 0.2422 + c).astype(np.int64) - leaps
+
+
+def build_rows(ordinals):
+    """date.toordinal() の配列から暦テーブルの行を計算する"""
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    days = (ordinals - _UNIX_EPOCH_ORDINAL).astype('datetime64[D]')
+    years = days.astype('datetime64[Y]')
+    year = years.astype(np.int64) + 1970
+
+    # 立春より前の生まれは前年扱い
+    risshun = years.astype('datetime64[D]') + 31 + _risshun_day(year) - 1
+    pillar_year = np.where(days >= risshun, year, year - 1)
+
+    rows = np.empty(len(ordinals), dtype=TABLE_DTYPE)
+    rows['year_pillar'] = (pillar_year - 4) % 60
+    rows['day_pillar'] = (ordinals + _JDN_OFFSET + 49) % 60
+    # 動物占いの60分類は日柱の順番と一致する（1=甲子=長距離ランナーのチータ）
+    rows['animal'] = rows['day_pillar']
+    return rows
+
+
+def build_table():
+    """FIRST_DATE〜LAST_DATE の暦テーブルを作る"""
+    return build_rows(np.arange(FIRST_ORDINAL, LAST_DATE.toordinal() + 1))
+
+
+def load_table():
+    """暦テーブルを読み込む（初回のみ。ファイルはメモリマップするので常駐メモリはほぼ増えない）"""
+    global _table
+    if _table is not None:
+        return _table
+    with _lock:
+        if _table is None:
+            try:
+                _table = np.load(CALENDAR_TABLE_PATH, mmap_mode='r')
+            except (OSError, ValueError) as e:
+                # テーブルがない環境でも動くよう、メモリ上で作る
+                print(f"Calendar table not loaded ({e}), building in memory")
+                _table = build_table()
+    return _table
+
+
+def lookup(ordinals):
+    """date.toordinal() の配列に対応する行を返す（範囲外の日付はその場で計算）"""
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    table = load_table()
+    index = ordinals - FIRST_ORDINAL
+    inside = (index >= 0) & (index < len(table))
+    if inside.all():
+        return table[index]
+    rows = np.empty(len(ordinals), dtype=TABLE_DTYPE)
+    rows[inside] = table[index[inside]]
+    rows[~inside] = build_rows(ordinals[~inside])
+    return rows
+
+
+def lookup_date(d):
+    """1日分の (年柱, 日柱, 動物番号-1)"""
+    index = d.toordinal() - FIRST_ORDINAL
+    table = load_table()
+    if 0 <= index < len(table):
+        row = table[index]
+    else:
+        row = build_rows([d.toordinal()])[0]
+    return int(row['year_pillar']), int(row['day_pillar']), int(row['animal'])
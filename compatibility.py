@@ -0,0 +1,186 @@
+import numpy as np
+
+from fortune_logic import FortuneCalculator, ANIMAL_60_TO_12
+
+
+class CompatibilityCalculator:
+    """生年月日どうしの相性（算命学の十干・十二支と動物占い）
+
+    生年月日はまず「相性キー」（年柱60通り × 動物12分類 = 720通り）に変換し、
+    キーどうしの相性は事前に作った 720×720 の表から引く。
+    1対多・N×M のどちらも配列の添字参照だけで計算できる。
+    """
+
+    # 十干の五行（木・火・土・金・水）
+    JIKKAN_ELEMENTS = [0, 0, 1, 1, 2, 2, 3, 3, 4, 4]
+
+    # 干合（かんごう）：甲己・乙庚・丙辛・丁壬・戊癸
+    KANGOU = [("甲", "己"), ("乙", "庚"), ("丙", "辛"), ("丁", "壬"), ("戊", "癸")]
+
+    # 支合（しごう）
+    SHIGOU = [("子", "丑"), ("寅", "亥"), ("卯", "戌"), ("辰", "酉"), ("巳", "申"), ("午", "未")]
+
+    # 三合（さんごう）
+    SANGOU = [("申", "子", "辰"), ("亥", "卯", "未"), ("寅", "午", "戌"), ("巳", "酉", "丑")]
+
+    # 動物占いの3グループ
+    ANIMAL_GROUPS = {
+        "MOON": ["こじか", "黒ひょう", "たぬき", "ひつじ"],
+        "EARTH": ["狼", "猿", "虎", "コアラ"],
+        "SUN": ["チータ", "ライオン", "ゾウ", "ペガサス"],
+    }
+
+    # 合計点の重み（各要素は1〜5点）
+    WEIGHTS = {"jikkan": 0.4, "junishi": 0.3, "animal": 0.3}
+
+    # 相性度に応じたひとこと
+    COMMENTS = [
+        (85, "運命的な相性！自然体でいられる最高のパートナーです"),
+        (70, "とても良い相性。お互いを高め合える関係です"),
+        (55, "バランスの良い相性。思いやりで絆が深まります"),
+        (40, "違いが魅力になる相性。相手のペースを尊重して"),
+        (0, "刺激し合う相性。素直な言葉が距離を縮めます"),
+    ]
+
+    @staticmethod
+    def jikkan_relation(a, b):
+        """十干どうしの関係と点数（1〜5）"""
+        names = FortuneCalculator.JIKKAN
+        if (names[a], names[b]) in CompatibilityCalculator.KANGOU or \
+                (names[b], names[a]) in CompatibilityCalculator.KANGOU:
+            return "干合", 5
+        ea = CompatibilityCalculator.JIKKAN_ELEMENTS[a]
+        eb = CompatibilityCalculator.JIKKAN_ELEMENTS[b]
+        if ea == eb:
+            return "比和", 3.5
+        # 相生：木→火→土→金→水→木
+        if (ea + 1) % 5 == eb or (eb + 1) % 5 == ea:
+            return "相生", 4.5
+        # 残りは相剋
+        return "相剋", 2
+
+    @staticmethod
+    def junishi_relation(a, b):
+        """十二支どうしの関係と点数（1〜5）"""
+        names = FortuneCalculator.JUNISHI
+        pair = (names[a], names[b])
+        if pair in CompatibilityCalculator.SHIGOU or pair[::-1] in CompatibilityCalculator.SHIGOU:
+            return "支合", 5
+        if a == b:
+            return "同支", 3.5
+        if any(pair[0] in group and pair[1] in group for group in CompatibilityCalculator.SANGOU):
+            return "三合", 4.5
+        if (a - b) % 12 == 6:
+            return "冲", 1.5
+        return "普通", 3
+
+    @staticmethod
+    def animal_relation(a, b):
+        """動物占い12分類どうしの関係と点数（1〜5）"""
+        if a == b:
+            return "同じ動物", 4
+        name_a = FortuneCalculator.ANIMAL_CHARACTERS[a]["name"]
+        name_b = FortuneCalculator.ANIMAL_CHARACTERS[b]["name"]
+        for members in CompatibilityCalculator.ANIMAL_GROUPS.values():
+            if name_a in members and name_b in members:
+                return "同じグループ", 4.5
+        return "違うグループ", 3
+
+    @classmethod
+    def keys(cls, birthdays):
+        """生年月日（文字列・date のリスト、または datetime64 の配列）を相性キーに変換
+
+        解析できなかった生年月日は -1。
+        """
+        batch = FortuneCalculator.calculate_batch(birthdays)
+        year_pillar = batch['year_pillar'].astype(np.int64)
+        animal = ANIMAL_12_OF_60[np.where(batch['valid'], batch['animal'], 0)]
+        return np.where(batch['valid'], year_pillar * 12 + animal, -1)
+
+    @classmethod
+    def _as_keys(cls, birthdays):
+        if isinstance(birthdays, np.ndarray) and np.issubdtype(birthdays.dtype, np.integer):
+            return birthdays
+        if isinstance(birthdays, str):
+            birthdays = [birthdays]
+        return cls.keys(birthdays)
+
+    @classmethod
+    def score_many(cls, birthday, candidates):
+        """1人と複数の候補の相性度（0〜100）。解析できない組み合わせは -1"""
+        key = cls._as_keys(birthday)[0]
+        candidate_keys = cls._as_keys(candidates)
+        if key < 0:
+            return np.full(len(candidate_keys), -1, dtype=np.int16)
+        scores = SCORE_TABLE[key, np.maximum(candidate_keys, 0)]
+        return np.where(candidate_keys >= 0, scores, -1).astype(np.int16)
+
+    @classmethod
+    def score_matrix(cls, birthdays_a, birthdays_b):
+        """N×M の相性度（0〜100）。解析できない組み合わせは -1"""
+        keys_a = cls._as_keys(birthdays_a)
+        keys_b = cls._as_keys(birthdays_b)
+        scores = SCORE_TABLE[np.maximum(keys_a, 0)[:, None], np.maximum(keys_b, 0)[None, :]]
+        invalid = (keys_a < 0)[:, None] | (keys_b < 0)[None, :]
+        return np.where(invalid, -1, scores).astype(np.int16)
+
+    @classmethod
+    def top_k(cls, birthday, candidates, k=10):
+        """相性の良い候補の上位k件を [(候補の添字, 相性度), ...] で返す"""
+        scores = cls.score_many(birthday, candidates)
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(i), int(scores[i])) for i in top if scores[i] >= 0]
+
+    @classmethod
+    def diagnose(cls, birthday_a, birthday_b):
+        """2人の相性診断（内訳つき）。どちらかが解析できなければNone"""
+        keys = cls.keys([birthday_a, birthday_b])
+        if (keys < 0).any():
+            return None
+        (pillar_a, animal_a), (pillar_b, animal_b) = divmod(int(keys[0]), 12), divmod(int(keys[1]), 12)
+        jikkan = cls.jikkan_relation(pillar_a % 10, pillar_b % 10)
+        junishi = cls.junishi_relation(pillar_a % 12, pillar_b % 12)
+        animal = cls.animal_relation(animal_a, animal_b)
+        score = int(SCORE_TABLE[keys[0], keys[1]])
+        return {
+            "score": score,
+            "stars": min(5, score // 20 + 1),
+            "jikkan": jikkan[0],
+            "junishi": junishi[0],
+            "animal": animal[0],
+            "partner_element": f"{FortuneCalculator.JIKKAN[pillar_b % 10]}{FortuneCalculator.JUNISHI[pillar_b % 12]}",
+            "partner_animal": FortuneCalculator.ANIMAL_CHARACTERS[animal_b]["name"],
+            "comment": next(text for threshold, text in cls.COMMENTS if score >= threshold),
+        }
+
+
+def _build_score_table():
+    """相性キー 720×720 の相性度（0〜100）"""
+    calc = CompatibilityCalculator
+    weights = calc.WEIGHTS
+    jikkan = np.array([[calc.jikkan_relation(a, b)[1] for b in range(10)] for a in range(10)])
+    junishi = np.array([[calc.junishi_relation(a, b)[1] for b in range(12)] for a in range(12)])
+    animal = np.array([[calc.animal_relation(a, b)[1] for b in range(12)] for a in range(12)])
+
+    pillars = np.arange(720) // 12
+    animals = np.arange(720) % 12
+    total = (
+        weights["jikkan"] * jikkan[(pillars % 10)[:, None], (pillars % 10)[None, :]]
+        + weights["junishi"] * junishi[(pillars % 12)[:, None], (pillars % 12)[None, :]]
+        + weights["animal"] * animal[animals[:, None], animals[None, :]]
+    )
+    # 1〜5点を0〜100に
+    table = np.rint((total - 1) / 4 * 100).astype(np.int16)
+    table.setflags(write=False)
+    return table
+
+
+# 動物占い60分類の番号-1 -> 12分類
+ANIMAL_12_OF_60 = np.array(ANIMAL_60_TO_12, dtype=np.int64)
+
+# 相性キーどうしの相性度
+SCORE_TABLE = _build_score_table()
@@ -1,10 +1,13 @@
 import os
 import json
+import time
+import threading
 from datetime import datetime
-from sqlalchemy import create_engine, Column, String, Text, DateTime, Boolean, Integer
+from sqlalchemy import create_engine, event, exc, and_, Column, String, Text, DateTime, Date, Boolean, Integer
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import sessionmaker, scoped_session, aliased
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 # データベースURL（環境変数から取得）
 DATABASE_URL = os.environ.get('DATABASE_URL', '')
@@ -19,16 +22,94 @@ if 'postgres.railway.internal' in DATABASE_URL:
 if DATABASE_URL and DATABASE_URL.startswith('postgres://'):
     DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
 
+# 接続プールの設定
+# DB_POOL_MODE=null（既定）: リクエストごとに接続 / queue: コネクションプールを使う
+DB_POOL_MODE = os.environ.get('DB_POOL_MODE', 'null').lower()
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 300))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+# 全ユーザーを順に読み込むときに1回で取得する行数
+DB_STREAM_BATCH_SIZE = int(os.environ.get('DB_STREAM_BATCH_SIZE', 500))
+# JSONからの一括移行で1トランザクションに入れる行数
+DB_MIGRATE_BATCH_SIZE = int(os.environ.get('DB_MIGRATE_BATCH_SIZE', 1000))
+
+class TimedQueuePool(QueuePool):
+    """接続の取得待ち時間を計測するQueuePool"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = {'checkouts': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'timeouts': 0}
+        self._stats_lock = threading.Lock()
+    
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.wait_stats['timeouts'] += 1
+            raise
+        finally:
+            waited = time.monotonic() - started
+            with self._stats_lock:
+                self.wait_stats['checkouts'] += 1
+                self.wait_stats['wait_total'] += waited
+                self.wait_stats['wait_max'] = max(self.wait_stats['wait_max'], waited)
+    
+    def recreate(self):
+        # dispose時に作り直されても同じ集計を引き継ぐ
+        pool = super().recreate()
+        pool.wait_stats = self.wait_stats
+        pool._stats_lock = self._stats_lock
+        return pool
+
+def _engine_options():
+    """DB_POOL_MODEに応じたcreate_engineのオプション"""
+    if DB_POOL_MODE == 'queue':
+        return {
+            'poolclass': TimedQueuePool,
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT,
+            'pool_recycle': DB_POOL_RECYCLE,
+            'pool_pre_ping': DB_POOL_PRE_PING,
+        }
+    return {'poolclass': NullPool}  # Railway環境での接続プール問題を回避
+
+def _protect_pool_across_fork(engine):
+    """fork前に作られた接続を子プロセスで使い回さない（gunicornのpreload対策）"""
+    
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+    
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            # 親プロセスの接続は閉じずに手放し、新しい接続を作らせる
+            connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+            raise exc.DisconnectionError(
+                f"Connection record belongs to pid {connection_record.info['pid']}, "
+                f"attempting to check out in pid {pid}"
+            )
+
 # エンジンの作成（DATABASE_URLが空の場合はスキップ）
 if DATABASE_URL:
     try:
         engine = create_engine(
             DATABASE_URL,
-            poolclass=NullPool,  # Railway環境での接続プール問題を回避
-            echo=False
+            echo=False,
+            **_engine_options()
         )
-        # セッションの設定
+        if DB_POOL_MODE == 'queue':
+            _protect_pool_across_fork(engine)
+        # セッションの設定（スレッドごとにセッションを使い回す）
         SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+        # 長時間のストリーミング読み込み用（スレッドのセッションとは独立させる）
+        StreamSession = sessionmaker(autocommit=False, autoflush=False, bind=engine)
         DB_AVAILABLE = True
     except Exception as e:
         print(f"Database connection failed: {e}")
@@ -37,6 +118,7 @@ else:
     DB_AVAILABLE = False
     engine = None
     SessionLocal = None
+    StreamSession = None
 
 # ベースクラス
 Base = declarative_base()
@@ -79,6 +161,7 @@ class User(Base):
         return {
             'user_id': self.user_id,
             'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
             'name': self.name,
             'gender': self.gender,
             'birthday': self.birthday,
@@ -134,10 +217,159 @@ class User(Base):
         user.is_premium = data.get('is_premium', False)
         
         return user
+    
+    # JSON文字列で保存する列 / ISO形式の文字列から変換する日時の列
+    JSON_COLUMNS = ('sanmeigaku', 'animal_character', 'extra_data')
+    DATETIME_COLUMNS = ('palm_uploaded_at', 'subscription_start', 'subscription_end')
+    # save_user / update_user_fields で書き換えない列
+    PROTECTED_COLUMNS = ('user_id', 'created_at', 'updated_at')
+    
+    @classmethod
+    def column_values(cls, data):
+        """辞書のうちusersテーブルの列に当たる項目を、保存用の値に変換"""
+        columns = cls.__table__.columns
+        values = {}
+        for key, value in data.items():
+            if key not in columns or key in cls.PROTECTED_COLUMNS:
+                continue
+            if key in cls.JSON_COLUMNS and not isinstance(value, str):
+                value = json.dumps(value, ensure_ascii=False) if value else None
+            elif key in cls.DATETIME_COLUMNS:
+                value = _parse_datetime(value)
+            values[key] = value
+        return values
+
+def _iter_json_object_items(f, chunk_size=1 << 16):
+    """トップレベルのJSONオブジェクトを (キー, 値) ごとに少しずつ読み込む
+
+    ファイル全体をメモリに載せずに、巨大な users_data.json を先頭から順に処理する。
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buf = buf[pos:] + chunk
+        pos = 0
+        return True
+    
+    def peek():
+        """空白を読み飛ばして次の文字を返す（末尾なら空文字）"""
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if eof or not fill():
+                return ''
+    
+    def decode():
+        nonlocal pos
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof or not fill():
+                    raise
+                continue
+            # バッファの末尾で終わった値（数値など）は途中で切れている可能性がある
+            if end == len(buf) and not eof and fill():
+                continue
+            pos = end
+            return value
+    
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise ValueError(f"Expected '{char}' at offset {pos}")
+        pos += 1
+    
+    expect('{')
+    if peek() == '}':
+        return
+    while True:
+        peek()
+        key = decode()
+        expect(':')
+        peek()
+        value = decode()
+        yield key, value
+        if peek() == ',':
+            pos += 1
+            continue
+        expect('}')
+        return
+
+def _parse_datetime(value):
+    """ISO形式の文字列をdatetimeに変換（変換できなければNone）"""
+    if not value or isinstance(value, datetime):
+        return value or None
+    try:
+        return datetime.fromisoformat(value.replace('Z', ''))
+    except (TypeError, ValueError):
+        return None
+
+class DailyFortune(Base):
+    """生成済みの占いメッセージ（配信前に事前生成して保存）"""
+    __tablename__ = 'daily_fortunes'
+    
+    user_id = Column(String(255), primary_key=True)
+    fortune_date = Column(Date, primary_key=True)
+    kind = Column(String(20), primary_key=True, default='morning')  # morning / weekly など
+    message = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+
+class DeadLetter(Base):
+    """再試行しても配信できなかったpush（あとで再送できるように保存）"""
+    __tablename__ = 'dead_letters'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String(255), nullable=False, index=True)
+    kind = Column(String(20), nullable=False)  # morning / weekly など
+    messages = Column(Text, nullable=False)  # JSON（送信するメッセージの配列）
+    retry_key = Column(String(64), nullable=False)  # 再送でも同じ X-Line-Retry-Key を使う
+    status_code = Column(Integer)
+    error = Column(Text)
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.now)
+    redriven_at = Column(DateTime)  # 再送に成功した日時（未再送はNULL）
+
+class DeliveryLog(Base):
+    """定期配信の記録（再実行・再開のときに配信済みのユーザーを飛ばす）"""
+    __tablename__ = 'delivery_logs'
+    
+    user_id = Column(String(255), primary_key=True)
+    delivery_date = Column(Date, primary_key=True)
+    kind = Column(String(20), primary_key=True)  # morning / weekly など
+    status = Column(String(20), nullable=False)  # delivered / dead_lettered
+    created_at = Column(DateTime, default=datetime.now)
+
+class JobRun(Base):
+    """定期ジョブの実行記録（running のまま残っていれば途中で止まった実行）"""
+    __tablename__ = 'job_runs'
+    
+    job_id = Column(String(64), primary_key=True)
+    run_date = Column(Date, primary_key=True)
+    status = Column(String(20), nullable=False)  # running / completed / failed / abandoned
+    started_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime)
 
 class DatabaseManager:
     """データベース操作を管理するクラス"""
     
+    # 定期配信のプロンプトで使う列
+    DELIVERY_COLUMNS = (
+        'user_id', 'name', 'relationship_status', 'main_concern',
+        'sanmeigaku', 'animal_character', 'is_premium'
+    )
+    
     @staticmethod
     def init_db():
         """データベースの初期化"""
@@ -152,6 +384,29 @@ class DatabaseManager:
             print(f"Database initialization error: {e}")
             return False
     
+    @staticmethod
+    def pool_stats():
+        """接続プールの利用状況"""
+        if not DB_AVAILABLE:
+            return None
+        pool = engine.pool
+        if not isinstance(pool, TimedQueuePool):
+            return {'mode': 'null'}
+        with pool._stats_lock:
+            wait = dict(pool.wait_stats)
+        return {
+            'mode': 'queue',
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(0, pool.overflow()),
+            'max_overflow': DB_MAX_OVERFLOW,
+            'checkouts': wait['checkouts'],
+            'timeouts': wait['timeouts'],
+            'wait_avg': wait['wait_total'] / wait['checkouts'] if wait['checkouts'] else 0.0,
+            'wait_max': wait['wait_max'],
+        }
+    
     @staticmethod
     def get_user(user_id):
         """ユーザー情報を取得"""
@@ -164,27 +419,58 @@ class DatabaseManager:
         finally:
             session.close()
     
+    @staticmethod
+    def get_user_version(user_id):
+        """ユーザーの最終更新日時（キャッシュの鮮度確認用）"""
+        session = SessionLocal()
+        try:
+            row = session.query(User.updated_at).filter(User.user_id == user_id).first()
+            if row and row[0]:
+                return row[0].isoformat()
+            return None
+        finally:
+            session.close()
+    
     @staticmethod
     def save_user(user_id, user_data):
-        """ユーザー情報を保存"""
+        """ユーザー情報を保存（辞書に含まれる項目だけを書き込む）"""
+        return DatabaseManager._upsert_user(
+            user_id, User.column_values(user_data), user_data.get('created_at')
+        )
+    
+    @staticmethod
+    def update_user_fields(user_id, **changes):
+        """変更した項目だけを保存
+
+        例: DatabaseManager.update_user_fields(user_id, onboarding_stage=3)
+        """
+        return DatabaseManager._upsert_user(user_id, User.column_values(changes))
+    
+    @staticmethod
+    def _upsert_user(user_id, values, created_at=None):
+        """INSERT ... ON CONFLICT DO UPDATE で1回の往復で保存"""
+        now = datetime.now()
+        created_at = _parse_datetime(created_at) or now
         session = SessionLocal()
         try:
-            user = session.query(User).filter(User.user_id == user_id).first()
-            
-            if user:
-                # 既存ユーザーの更新
-                for key, value in user_data.items():
-                    if key in ['sanmeigaku', 'animal_character'] and isinstance(value, dict):
-                        setattr(user, key, json.dumps(value, ensure_ascii=False))
-                    elif key == 'created_at':
-                        continue  # created_atは更新しない
-                    elif hasattr(user, key):
-                        setattr(user, key, value)
-                user.updated_at = datetime.now()
+            if engine.dialect.name == 'postgresql':
+                stmt = pg_insert(User.__table__).values(
+                    user_id=user_id, created_at=created_at, updated_at=now, **values
+                )
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[User.__table__.c.user_id],
+                    set_=dict(values, updated_at=now)
+                )
+                session.execute(stmt)
             else:
-                # 新規ユーザーの作成
-                user = User.from_dict(user_id, user_data)
-                session.add(user)
+                # PostgreSQL以外（ローカル検証用のSQLiteなど）はORMで保存
+                user = session.get(User, user_id)
+                if user is None:
+                    user = User(user_id=user_id, created_at=created_at)
+                    session.add(user)
+                for key, value in values.items():
+                    setattr(user, key, value)
+                user.updated_at = now
             
             session.commit()
             return True
@@ -205,6 +491,71 @@ class DatabaseManager:
         finally:
             session.close()
     
+    @staticmethod
+    def iter_users(onboarding_complete=None, premium_only=False, columns=DELIVERY_COLUMNS,
+                   daily_fortune=None, missing_daily_fortune=None, undelivered=None, batch_size=None):
+        """条件に合うユーザーをサーバーサイドカーソルで少しずつ読み込む
+
+        (user_id, user_data) を順に返す。絞り込みはSQL側で行い、
+        user_data には columns で指定した列だけが入る。
+        daily_fortune=(日付, 種類) を渡すと生成済みの占いを 'daily_fortune' に入れる
+        （(日付, 種類, 種類2, ...) なら2つ目以降は '<種類>_fortune' に。なければNone）。
+        missing_daily_fortune=(日付, 種類) を渡すと生成済みのユーザーを除外する。
+        undelivered=(日付, 種類) を渡すと配信の記録があるユーザーを除外する。
+        """
+        columns = ('user_id',) + tuple(c for c in columns if c != 'user_id')
+        session = StreamSession()
+        try:
+            query = session.query(*[getattr(User, c) for c in columns])
+            
+            if onboarding_complete is not None:
+                query = query.filter(User.onboarding_complete == onboarding_complete)
+            if premium_only:
+                query = query.filter(User.is_premium == True)
+            
+            fortune_keys = []
+            if daily_fortune is not None:
+                fortune_date, kinds = daily_fortune[0], daily_fortune[1:]
+                for i, kind in enumerate(kinds):
+                    fortune = aliased(DailyFortune)
+                    query = query.add_columns(fortune.message).outerjoin(
+                        fortune, and_(
+                            fortune.user_id == User.user_id,
+                            fortune.fortune_date == fortune_date,
+                            fortune.kind == kind
+                        )
+                    )
+                    fortune_keys.append('daily_fortune' if i == 0 else f'{kind}_fortune')
+            if missing_daily_fortune is not None:
+                fortune_date, kind = missing_daily_fortune
+                query = query.filter(~session.query(DailyFortune.user_id).filter(
+                    DailyFortune.user_id == User.user_id,
+                    DailyFortune.fortune_date == fortune_date,
+                    DailyFortune.kind == kind
+                ).exists())
+            if undelivered is not None:
+                delivery_date, kind = undelivered
+                query = query.filter(~session.query(DeliveryLog.user_id).filter(
+                    DeliveryLog.user_id == User.user_id,
+                    DeliveryLog.delivery_date == delivery_date,
+                    DeliveryLog.kind == kind
+                ).exists())
+            
+            query = query.execution_options(stream_results=True).yield_per(
+                batch_size or DB_STREAM_BATCH_SIZE
+            )
+            
+            for row in query:
+                user_data = dict(zip(columns, row))
+                for key in User.JSON_COLUMNS:
+                    if key in user_data:
+                        user_data[key] = json.loads(user_data[key]) if user_data[key] else None
+                for i, key in enumerate(fortune_keys):
+                    user_data[key] = row[len(columns) + i]
+                yield user_data['user_id'], user_data
+        finally:
+            session.close()
+    
     @staticmethod
     def delete_user(user_id):
         """ユーザーを削除"""
@@ -229,6 +580,244 @@ class DatabaseManager:
         finally:
             session.close()
     
+    @staticmethod
+    def get_daily_fortune(user_id, fortune_date, kind='morning'):
+        """ユーザーの生成済み占いを取得（なければNone）"""
+        session = SessionLocal()
+        try:
+            row = session.query(DailyFortune.message).filter(
+                DailyFortune.user_id == user_id,
+                DailyFortune.fortune_date == fortune_date,
+                DailyFortune.kind == kind
+            ).first()
+            return row[0] if row else None
+        finally:
+            session.close()
+    
+    @staticmethod
+    def save_daily_fortune(user_id, fortune_date, message, kind='morning'):
+        """生成済みの占いを保存（同じキーがあれば上書き）"""
+        session = SessionLocal()
+        try:
+            session.merge(DailyFortune(
+                user_id=user_id,
+                fortune_date=fortune_date,
+                kind=kind,
+                message=message
+            ))
+            session.commit()
+            return True
+        except Exception as e:
+            session.rollback()
+            print(f"Save daily fortune error: {e}")
+            return False
+        finally:
+            session.close()
+    
+    @staticmethod
+    def purge_daily_fortunes(before_date):
+        """指定日より前の生成済み占いを削除"""
+        session = SessionLocal()
+        try:
+            deleted = session.query(DailyFortune).filter(
+                DailyFortune.fortune_date < before_date
+            ).delete(synchronize_session=False)
+            session.commit()
+            return deleted
+        except Exception as e:
+            session.rollback()
+            print(f"Purge daily fortunes error: {e}")
+            return 0
+        finally:
+            session.close()
+    
+    @staticmethod
+    def save_dead_letter(user_id, kind, messages, retry_key, error, status_code=None, attempts=0):
+        """配信できなかったpushを保存（messages はメッセージのJSON辞書のリスト）"""
+        session = SessionLocal()
+        try:
+            session.add(DeadLetter(
+                user_id=user_id,
+                kind=kind,
+                messages=json.dumps(messages, ensure_ascii=False),
+                retry_key=retry_key,
+                status_code=status_code,
+                error=str(error)[:1000],
+                attempts=attempts
+            ))
+            session.commit()
+            return True
+        except Exception as e:
+            session.rollback()
+            print(f"Save dead letter error: {e}")
+            return False
+        finally:
+            session.close()
+    
+    @staticmethod
+    def get_pending_dead_letters(limit=None):
+        """未再送のpushを古い順に取得"""
+        session = SessionLocal()
+        try:
+            query = session.query(DeadLetter).filter(
+                DeadLetter.redriven_at.is_(None)
+            ).order_by(DeadLetter.id)
+            if limit:
+                query = query.limit(limit)
+            return [
+                {
+                    'id': letter.id,
+                    'user_id': letter.user_id,
+                    'kind': letter.kind,
+                    'messages': json.loads(letter.messages),
+                    'retry_key': letter.retry_key,
+                    'attempts': letter.attempts or 0,
+                    'created_at': letter.created_at,
+                }
+                for letter in query
+            ]
+        finally:
+            session.close()
+    
+    @staticmethod
+    def update_dead_letter(letter_id, redriven=False, error=None, status_code=None, attempts=0):
+        """再送の結果を記録（成功なら redriven_at を入れる）"""
+        session = SessionLocal()
+        try:
+            letter = session.query(DeadLetter).get(letter_id)
+            if letter is None:
+                return False
+            letter.attempts = (letter.attempts or 0) + attempts
+            if redriven:
+                letter.redriven_at = datetime.now()
+            else:
+                letter.error = str(error)[:1000]
+                letter.status_code = status_code
+            session.commit()
+            return True
+        except Exception as e:
+            session.rollback()
+            print(f"Update dead letter error: {e}")
+            return False
+        finally:
+            session.close()
+    
+    @staticmethod
+    def save_delivery_logs(entries):
+        """配信の記録 [(user_id, 日付, 種類, 状態), ...] を1トランザクションでまとめて保存"""
+        if not entries:
+            return 0
+        now = datetime.now()
+        rows = {}
+        for user_id, delivery_date, kind, status in entries:
+            # 同じキーが1文に2回入るとPostgreSQLのON CONFLICTがエラーになるので後勝ちでまとめる
+            rows[(user_id, delivery_date, kind)] = {
+                'user_id': user_id, 'delivery_date': delivery_date, 'kind': kind,
+                'status': status, 'created_at': now
+            }
+        rows = list(rows.values())
+        
+        session = SessionLocal()
+        try:
+            if engine.dialect.name == 'postgresql':
+                stmt = pg_insert(DeliveryLog.__table__).values(rows)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=['user_id', 'delivery_date', 'kind'],
+                    set_={'status': stmt.excluded.status, 'created_at': now}
+                )
+                session.execute(stmt)
+            else:
+                for row in rows:
+                    session.merge(DeliveryLog(**row))
+            session.commit()
+            return len(rows)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+    
+    @staticmethod
+    def purge_delivery_logs(before_date):
+        """指定日より前の配信記録を削除"""
+        session = SessionLocal()
+        try:
+            deleted = session.query(DeliveryLog).filter(
+                DeliveryLog.delivery_date < before_date
+            ).delete(synchronize_session=False)
+            session.commit()
+            return deleted
+        except Exception as e:
+            session.rollback()
+            print(f"Purge delivery logs error: {e}")
+            return 0
+        finally:
+            session.close()
+    
+    @staticmethod
+    def start_job_run(job_id, run_date):
+        """ジョブの実行開始を記録（同じ日の記録があれば running に戻す）"""
+        session = SessionLocal()
+        try:
+            session.merge(JobRun(
+                job_id=job_id,
+                run_date=run_date,
+                status='running',
+                started_at=datetime.now(),
+                finished_at=None
+            ))
+            session.commit()
+            return True
+        except Exception as e:
+            session.rollback()
+            print(f"Start job run error: {e}")
+            return False
+        finally:
+            session.close()
+    
+    @staticmethod
+    def finish_job_run(job_id, run_date, status='completed'):
+        """ジョブの実行終了を記録"""
+        session = SessionLocal()
+        try:
+            run = session.query(JobRun).get((job_id, run_date))
+            if run is None:
+                return False
+            run.status = status
+            run.finished_at = datetime.now()
+            session.commit()
+            return True
+        except Exception as e:
+            session.rollback()
+            print(f"Finish job run error: {e}")
+            return False
+        finally:
+            session.close()
+    
+    @staticmethod
+    def get_job_run_status(job_id, run_date):
+        """その日の実行の状態（記録がなければNone）"""
+        session = SessionLocal()
+        try:
+            row = session.query(JobRun.status).filter(
+                JobRun.job_id == job_id, JobRun.run_date == run_date
+            ).first()
+            return row[0] if row else None
+        finally:
+            session.close()
+    
+    @staticmethod
+    def get_interrupted_job_runs():
+        """running のまま残っている実行を [(job_id, 日付), ...] で取得"""
+        session = SessionLocal()
+        try:
+            return [
+                (run.job_id, run.run_date)
+                for run in session.query(JobRun).filter(JobRun.status == 'running')
+            ]
+        finally:
+            session.close()
+    
     @staticmethod
     def migrate_from_json(json_file_path='users_data.json'):
         """JSONファイルからデータを移行"""
@@ -247,9 +836,120 @@ class DatabaseManager:
             print(f"Migration error: {e}")
             return 0
 
+    @staticmethod
+    def bulk_migrate_from_json(json_file_path='users_data.json', batch_size=None,
+                               checkpoint_path=None):
+        """JSONファイルからデータを一括移行（大量データ向け）
+
+        JSONを先頭から少しずつ読み込み、batch_size件ごとに複数行のupsertを
+        1トランザクションで実行する。バッチごとに進捗をチェックポイントファイルに
+        記録するので、中断しても同じコマンドで続きから再開できる。
+        """
+        batch_size = batch_size or DB_MIGRATE_BATCH_SIZE
+        checkpoint_path = checkpoint_path or f"{json_file_path}.migrate_checkpoint"
+        
+        position = 0
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'r', encoding='utf-8') as f:
+                position = json.load(f).get('position', 0)
+            print(f"Resuming migration from user #{position}")
+        
+        started = time.monotonic()
+        migrated_count = 0
+        batch = []
+        
+        def flush():
+            nonlocal position, migrated_count
+            DatabaseManager._upsert_users_batch(batch)
+            position += len(batch)
+            migrated_count += len(batch)
+            DatabaseManager._write_migrate_checkpoint(checkpoint_path, position)
+            elapsed = time.monotonic() - started
+            print(f"Migrated {position} users ({migrated_count / elapsed:.0f} rows/sec)")
+            batch.clear()
+        
+        try:
+            with open(json_file_path, 'r', encoding='utf-8') as f:
+                for index, (user_id, user_data) in enumerate(_iter_json_object_items(f)):
+                    if index < position:
+                        continue  # 前回までに移行済み
+                    batch.append((user_id, user_data))
+                    if len(batch) >= batch_size:
+                        flush()
+                if batch:
+                    flush()
+        except Exception as e:
+            print(f"Migration error: {e} (resume from user #{position})")
+            return migrated_count
+        
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        elapsed = time.monotonic() - started
+        rate = migrated_count / elapsed if elapsed > 0 else 0.0
+        print(f"Migrated {migrated_count} users from JSON to PostgreSQL "
+              f"in {elapsed:.1f}s ({rate:.0f} rows/sec)")
+        return migrated_count
+    
+    @staticmethod
+    def _upsert_users_batch(batch):
+        """複数ユーザーを1トランザクションで保存
+
+        既存ユーザーはJSONにある項目だけを更新する（ない項目でDBの値を消さない）。
+        ON CONFLICT で更新する列は1文で共通なので、持っている項目の組ごとに1文にまとめる。
+        """
+        now = datetime.now()
+        columns = [c.name for c in User.__table__.columns if c.name not in User.PROTECTED_COLUMNS]
+        groups = {}
+        for user_id, user_data in batch:
+            values = User.column_values(user_data)
+            row = {c: values.get(c, User.__table__.c[c].default.arg
+                                 if User.__table__.c[c].default is not None else None)
+                   for c in columns}
+            row.update(
+                user_id=user_id,
+                created_at=_parse_datetime(user_data.get('created_at')) or now,
+                updated_at=now
+            )
+            groups.setdefault(tuple(sorted(values)), []).append((row, values))
+        
+        session = SessionLocal()
+        try:
+            if engine.dialect.name == 'postgresql':
+                for present, items in groups.items():
+                    stmt = pg_insert(User.__table__).values([row for row, values in items])
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=[User.__table__.c.user_id],
+                        set_=dict({c: stmt.excluded[c] for c in present}, updated_at=now)
+                    )
+                    session.execute(stmt)
+            else:
+                for items in groups.values():
+                    for row, values in items:
+                        user = session.get(User, row['user_id'])
+                        if user is None:
+                            session.add(User(**row))
+                            continue
+                        for key, value in values.items():
+                            setattr(user, key, value)
+                        user.updated_at = now
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+    
+    @staticmethod
+    def _write_migrate_checkpoint(checkpoint_path, position):
+        """チェックポイントを書き換え（一時ファイル経由で途中状態を残さない）"""
+        tmp_path = f"{checkpoint_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'position': position, 'updated_at': datetime.now().isoformat()}, f)
+        os.replace(tmp_path, checkpoint_path)
+
 # データベース初期化を実行
 if __name__ == "__main__":
     if DatabaseManager.init_db():
         print("Database initialized successfully!")
-        # JSONからの移行を実行
-        DatabaseManager.migrate_from_json()
+        # JSONからの移行を実行（中断した場合は再実行で続きから）
+        DatabaseManager.bulk_migrate_from_json()
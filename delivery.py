@@ -0,0 +1,225 @@
+import os
+import time
+import bisect
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# 並列度の設定（環境変数で調整可能）
+GENERATION_CONCURRENCY = int(os.environ.get('DELIVERY_GENERATION_CONCURRENCY', 8))
+PUSH_CONCURRENCY = int(os.environ.get('DELIVERY_PUSH_CONCURRENCY', 16))
+# 生成〜配信の途中にあるユーザー数の上限（メモリを一定に保つため）
+MAX_IN_FLIGHT = int(os.environ.get('DELIVERY_MAX_IN_FLIGHT', 200))
+# 配信記録をまとめて書き込む件数と間隔（秒）。途中で止まったときに失われる記録はこの範囲まで
+LOG_BATCH_SIZE = int(os.environ.get('DELIVERY_LOG_BATCH_SIZE', 500))
+LOG_FLUSH_INTERVAL = float(os.environ.get('DELIVERY_LOG_FLUSH_INTERVAL', 2.0))
+
+
+class StageStats:
+    """ステージごとの処理件数とレイテンシを集計
+
+    window を指定すると直近 window 件のサンプルだけを保持する（常駐プロセス用）。
+    buckets（秒の上限のリスト）を指定すると、全件のレイテンシのヒストグラムも集計する。
+    """
+
+    def __init__(self, name, window=None, buckets=None):
+        self.name = name
+        self.samples = deque(maxlen=window) if window else []
+        self.total = 0
+        self.errors = 0
+        self.buckets = sorted(buckets) if buckets else None
+        self.bucket_counts = [0] * (len(self.buckets) + 1) if buckets else None
+        self._lock = threading.Lock()
+
+    def record(self, elapsed, ok=True):
+        with self._lock:
+            self.samples.append(elapsed)
+            self.total += 1
+            if not ok:
+                self.errors += 1
+            if self.buckets:
+                self.bucket_counts[bisect.bisect_left(self.buckets, elapsed)] += 1
+
+    def histogram(self):
+        """{'<=0.05': 件数, ..., '>1.0': 件数} の形式のヒストグラム"""
+        if not self.buckets:
+            return None
+        with self._lock:
+            counts = list(self.bucket_counts)
+        histogram = {f"<={bound:g}": count for bound, count in zip(self.buckets, counts)}
+        histogram[f">{self.buckets[-1]:g}"] = counts[-1]
+        return histogram
+
+    def summary(self):
+        """集計結果を辞書で返す（秒単位）"""
+        with self._lock:
+            samples = sorted(self.samples)
+            total = self.total
+            errors = self.errors
+        if not samples:
+            summary = {'count': total, 'errors': errors, 'avg': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+        else:
+            summary = {
+                'count': total,
+                'errors': errors,
+                'avg': sum(samples) / len(samples),
+                'p50': samples[int(len(samples) * 0.50)],
+                'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                'max': samples[-1],
+            }
+        if self.buckets:
+            summary['histogram'] = self.histogram()
+        return summary
+
+    def format(self):
+        s = self.summary()
+        return (f"  [{self.name}] {s['count']} calls, {s['errors']} errors, "
+                f"avg {s['avg']:.2f}s / p50 {s['p50']:.2f}s / p95 {s['p95']:.2f}s / max {s['max']:.2f}s")
+
+
+class BatchWriter:
+    """記録を溜めて write(記録のリスト) でまとめて書き込む（スレッドセーフ）
+
+    batch_size 件溜まったとき、前回の書き込みから flush_interval 秒以上経って記録が
+    追加されたとき、flush() のときに書き込む。書き込みは add() を呼んだスレッドで行う。
+    """
+
+    def __init__(self, name, write, batch_size=None, flush_interval=None):
+        self.name = name
+        self.write = write
+        self.batch_size = batch_size or LOG_BATCH_SIZE
+        self.flush_interval = LOG_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.stats = StageStats(name)
+        self.counts = {'written': 0, 'failed': 0}
+        self._buffer = []
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self._buffer.append(record)
+            if (len(self._buffer) < self.batch_size
+                    and time.monotonic() - self._flushed_at < self.flush_interval):
+                return
+            batch = self._take()
+        self._write(batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._write(batch)
+
+    def _take(self):
+        batch = self._buffer
+        self._buffer = []
+        self._flushed_at = time.monotonic()
+        return batch
+
+    def _write(self, batch):
+        started = time.monotonic()
+        try:
+            self.write(batch)
+        except Exception as e:
+            self.stats.record(time.monotonic() - started, ok=False)
+            print(f"{self.name}: failed to write {len(batch)} records: {e}")
+            with self._lock:
+                self.counts['failed'] += len(batch)
+            return
+        self.stats.record(time.monotonic() - started)
+        with self._lock:
+            self.counts['written'] += len(batch)
+
+    def summary(self):
+        with self._lock:
+            counts = dict(self.counts)
+        return dict(counts, batches=self.stats.summary())
+
+
+class FanOutDelivery:
+    """生成ステージと配信ステージをパイプライン化した並列配信エンジン
+
+    generate(user_id, user_data) -> メッセージ と push(user_id, メッセージ) を
+    それぞれ独立したワーカープールで実行する。生成が終わったユーザーから
+    順に配信ステージへ流れるため、Geminiの待ち時間とLINEの待ち時間が重なる。
+    """
+
+    def __init__(self, name, generate, push,
+                 generation_concurrency=None, push_concurrency=None, max_in_flight=None):
+        self.name = name
+        self.generate = generate
+        self.push = push
+        self.generation_concurrency = generation_concurrency or GENERATION_CONCURRENCY
+        self.push_concurrency = push_concurrency or PUSH_CONCURRENCY
+        self.max_in_flight = max_in_flight or MAX_IN_FLIGHT
+
+    def run(self, users):
+        """(user_id, user_data) のイテラブルを配信し、結果の集計を返す"""
+        generate_stats = StageStats('generate')
+        push_stats = StageStats('push')
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        counts = {'success': 0, 'errors': 0}
+        counts_lock = threading.Lock()
+
+        def count(key):
+            with counts_lock:
+                counts[key] += 1
+
+        gen_pool = ThreadPoolExecutor(max_workers=self.generation_concurrency,
+                                      thread_name_prefix=f'{self.name}-gen')
+        push_pool = ThreadPoolExecutor(max_workers=self.push_concurrency,
+                                       thread_name_prefix=f'{self.name}-push')
+
+        def push_stage(user_id, message):
+            started = time.monotonic()
+            try:
+                self.push(user_id, message)
+                push_stats.record(time.monotonic() - started)
+                count('success')
+            except Exception as e:
+                push_stats.record(time.monotonic() - started, ok=False)
+                print(f"Error sending to {user_id}: {e}")
+                count('errors')
+            finally:
+                in_flight.release()
+
+        def generate_stage(user_id, user_data):
+            started = time.monotonic()
+            try:
+                message = self.generate(user_id, user_data)
+            except Exception as e:
+                generate_stats.record(time.monotonic() - started, ok=False)
+                print(f"Error generating for {user_id}: {e}")
+                count('errors')
+                in_flight.release()
+                return
+            generate_stats.record(time.monotonic() - started)
+            push_pool.submit(push_stage, user_id, message)
+
+        run_started = time.monotonic()
+        try:
+            for user_id, user_data in users:
+                in_flight.acquire()
+                gen_pool.submit(generate_stage, user_id, user_data)
+        finally:
+            # 生成ステージが全て終わってから配信ステージを閉じる
+            gen_pool.shutdown(wait=True)
+            push_pool.shutdown(wait=True)
+
+        elapsed = time.monotonic() - run_started
+        total = counts['success'] + counts['errors']
+        rate = total / elapsed if elapsed > 0 else 0.0
+
+        print(f"{self.name} completed: {counts['success']} success, {counts['errors']} errors "
+              f"in {elapsed:.1f}s ({rate:.1f} users/sec)")
+        print(generate_stats.format())
+        print(push_stats.format())
+
+        return {
+            'success': counts['success'],
+            'errors': counts['errors'],
+            'elapsed': elapsed,
+            'users_per_sec': rate,
+            'generate': generate_stats.summary(),
+            'push': push_stats.summary(),
+        }
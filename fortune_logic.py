@@ -1,5 +1,8 @@
-from datetime import datetime
-import re
+from datetime import datetime, date
+import numpy as np
+
+import calendar_table
+from birthday_parser import parse_birthday
 
 class FortuneCalculator:
     """算命学・動物占いの計算ロジック"""
@@ -10,7 +13,7 @@ class FortuneCalculator:
     # 十二支（じゅうにし）
     JUNISHI = ["子", "丑", "寅", "卯", "辰", "巳", "午", "未", "申", "酉", "戌", "亥"]
     
-    # 動物占いキャラクター（60種類から主要12種類）
+    # 動物占いキャラクター（12分類。60分類の名前は calendar_table.ANIMAL_60）
     ANIMAL_CHARACTERS = {
         0: {"name": "こじか", "traits": "純粋で人懐っこい", "love": "一途で素直な愛情表現"},
         1: {"name": "黒ひょう", "traits": "情熱的でスマート", "love": "駆け引き上手で魅力的"},
@@ -26,106 +29,168 @@ class FortuneCalculator:
         11: {"name": "虎", "traits": "正義感が強い", "love": "真っ直ぐな愛情"}
     }
     
+    # 十干ごとの性格特性
+    JIKKAN_TRAITS = {
+        "甲": "リーダーシップがあり積極的",
+        "乙": "柔軟で協調性がある",
+        "丙": "明るく情熱的",
+        "丁": "繊細で気配り上手",
+        "戊": "安定感があり信頼される",
+        "己": "面倒見が良く包容力がある",
+        "庚": "正義感が強く行動的",
+        "辛": "美的センスが高く繊細",
+        "壬": "知的で柔軟な思考",
+        "癸": "直感力が鋭く感受性豊か"
+    }
+    
+    # 十干ごとの恋愛傾向
+    LOVE_TENDENCIES = {
+        "甲": "積極的にアプローチし、相手をリードする",
+        "乙": "相手に合わせながら、じっくり関係を築く",
+        "丙": "情熱的で、感情表現が豊か",
+        "丁": "細やかな気遣いで相手を包む",
+        "戊": "安定した関係を築き、相手を守る",
+        "己": "相手を受け入れ、支える",
+        "庚": "真っ直ぐな愛情表現",
+        "辛": "上品で洗練された愛し方",
+        "壬": "変化を楽しむ恋愛",
+        "癸": "深い精神的つながりを求める"
+    }
+    
+    # calculate_batch の結果の型
+    BATCH_DTYPE = np.dtype([
+        ('valid', '?'),
+        ('year', 'i2'), ('month', 'i1'), ('day', 'i1'),
+        ('year_pillar', 'i1'), ('jikkan', 'i1'), ('junishi', 'i1'), ('day_pillar', 'i1'), ('animal', 'i1'),
+    ])
+    
     @staticmethod
-    def parse_birthday(birthday_str):
-        """生年月日文字列をdatetimeオブジェクトに変換"""
-        patterns = [
-            (r'(\d{4})年(\d{1,2})月(\d{1,2})日', '%Y-%m-%d'),
-            (r'(\d{4})/(\d{1,2})/(\d{1,2})', '%Y-%m-%d'),
-            (r'(\d{4})-(\d{1,2})-(\d{1,2})', '%Y-%m-%d'),
-        ]
-        
-        for pattern, _ in patterns:
-            match = re.search(pattern, birthday_str)
-            if match:
-                year, month, day = map(int, match.groups())
-                return datetime(year, month, day)
-        
-        # 和暦の処理
-        if "平成" in birthday_str:
-            match = re.search(r'平成(\d{1,2})年(\d{1,2})月(\d{1,2})日', birthday_str)
-            if match:
-                h_year, month, day = map(int, match.groups())
-                year = 1988 + h_year
-                return datetime(year, month, day)
-        elif "昭和" in birthday_str:
-            match = re.search(r'昭和(\d{1,2})年(\d{1,2})月(\d{1,2})日', birthday_str)
-            if match:
-                s_year, month, day = map(int, match.groups())
-                year = 1925 + s_year
-                return datetime(year, month, day)
-        
-        return None
+    def parse_birthday(birthday):
+        """生年月日（文字列・date）を date に変換。読み取れなければNone"""
+        if isinstance(birthday, date):
+            return birthday
+        return parse_birthday(birthday)
     
     @classmethod
-    def calculate_sanmeigaku(cls, birthday_str):
-        """生年月日から十干十二支を算出"""
-        birth_date = cls.parse_birthday(birthday_str)
+    def calculate_sanmeigaku(cls, birthday):
+        """生年月日（文字列・date）から十干十二支を算出"""
+        birth_date = cls.parse_birthday(birthday)
         if not birth_date:
             return None
         
-        # 簡易計算（実際の算命学はもっと複雑）
-        year = birth_date.year
-        
-        # 十干の計算（年の下一桁から算出）
-        jikkan_index = (year - 4) % 10
-        jikkan = cls.JIKKAN[jikkan_index]
-        
-        # 十二支の計算
-        junishi_index = (year - 4) % 12
-        junishi = cls.JUNISHI[junishi_index]
-        
-        # 性格特性を定義
-        jikkan_traits = {
-            "甲": "リーダーシップがあり積極的",
-            "乙": "柔軟で協調性がある",
-            "丙": "明るく情熱的",
-            "丁": "繊細で気配り上手",
-            "戊": "安定感があり信頼される",
-            "己": "面倒見が良く包容力がある",
-            "庚": "正義感が強く行動的",
-            "辛": "美的センスが高く繊細",
-            "壬": "知的で柔軟な思考",
-            "癸": "直感力が鋭く感受性豊か"
-        }
+        # 年柱・日柱は暦テーブルから引く（年の区切りは立春）
+        year_pillar, day_pillar, _ = calendar_table.lookup_date(birth_date)
+        jikkan = cls.JIKKAN[year_pillar % 10]
+        junishi = cls.JUNISHI[year_pillar % 12]
+        day_jikkan = cls.JIKKAN[day_pillar % 10]
+        day_junishi = cls.JUNISHI[day_pillar % 12]
         
         return {
             "jikkan": jikkan,
             "junishi": junishi,
             "element": f"{jikkan}{junishi}",
-            "traits": jikkan_traits.get(jikkan, ""),
+            "day_jikkan": day_jikkan,
+            "day_element": f"{day_jikkan}{day_junishi}",
+            "traits": cls.JIKKAN_TRAITS.get(jikkan, ""),
             "love_tendency": cls._get_love_tendency(jikkan, junishi)
         }
     
     @classmethod
-    def calculate_animal_character(cls, birthday_str):
-        """生年月日から動物占いキャラクターを判定"""
-        birth_date = cls.parse_birthday(birthday_str)
+    def calculate_animal_character(cls, birthday):
+        """生年月日（文字列・date）から動物占いキャラクターを判定"""
+        birth_date = cls.parse_birthday(birthday)
         if not birth_date:
             return None
         
-        # 簡易計算（実際はもっと複雑な計算）
-        total = birth_date.year + birth_date.month + birth_date.day
-        animal_index = total % 12
+        # 60分類は暦テーブルから引き、性格・恋愛傾向は12分類のものを使う
+        _, _, animal = calendar_table.lookup_date(birth_date)
+        character = dict(cls.ANIMAL_CHARACTERS[ANIMAL_60_TO_12[animal]])
+        character["number"] = animal + 1
+        character["full_name"] = calendar_table.ANIMAL_60[animal]
+        return character
+    
+    @classmethod
+    def calculate_batch(cls, birthdays):
+        """大量の生年月日から十干・十二支・動物の番号をまとめて算出
+
+        birthdays は生年月日（文字列・date）のリスト、または datetime64 の配列。
+        各生年月日は1回だけ解析し、計算はNumPyの配列演算で行う。
+        BATCH_DTYPE の構造化配列を返す（解析できなかった行は valid=False、番号は-1）。
+        year_pillar / day_pillar は年柱・日柱の60周期の番号、jikkan / junishi は年柱の十干・十二支、
+        animal は60分類の番号-1。
+        名前が必要な場合は np.array(cls.JIKKAN)[result['jikkan']] のように引く。
+        """
+        if isinstance(birthdays, np.ndarray) and np.issubdtype(birthdays.dtype, np.datetime64):
+            days = birthdays.astype('datetime64[D]')
+            valid = ~np.isnat(days)
+        else:
+            parsed = [cls.parse_birthday(b) if isinstance(b, str) else b for b in birthdays]
+            days = np.array(
+                [np.datetime64(p.date() if isinstance(p, datetime) else p, 'D') if p else np.datetime64('NaT', 'D')
+                 for p in parsed],
+                dtype='datetime64[D]'
+            )
+            valid = ~np.isnat(days)
+        
+        # 解析できなかった行はテーブルの先頭日で埋めておき、結果を-1にする
+        days = np.where(valid, days, np.datetime64(calendar_table.FIRST_DATE, 'D'))
+        months = days.astype('datetime64[M]')
+        years = months.astype('datetime64[Y]')
+        y = years.astype(np.int64) + 1970
+        m = (months - years.astype('datetime64[M]')).astype(np.int64) + 1
+        d = (days - months.astype('datetime64[D]')).astype(np.int64) + 1
+        rows = calendar_table.lookup(days.astype(np.int64) + ORDINAL_OF_UNIX_EPOCH)
+        year_pillar = rows['year_pillar'].astype(np.int64)
         
-        return cls.ANIMAL_CHARACTERS[animal_index]
+        result = np.zeros(len(days), dtype=cls.BATCH_DTYPE)
+        result['valid'] = valid
+        result['year'] = np.where(valid, y, 0)
+        result['month'] = np.where(valid, m, 0)
+        result['day'] = np.where(valid, d, 0)
+        result['year_pillar'] = np.where(valid, year_pillar, -1)
+        result['jikkan'] = np.where(valid, year_pillar % 10, -1)
+        result['junishi'] = np.where(valid, year_pillar % 12, -1)
+        result['day_pillar'] = np.where(valid, rows['day_pillar'], -1)
+        result['animal'] = np.where(valid, rows['animal'], -1)
+        return result
     
-    @staticmethod
-    def _get_love_tendency(jikkan, junishi):
+    @classmethod
+    def _get_love_tendency(cls, jikkan, junishi):
         """十干十二支から恋愛傾向を導出"""
-        tendencies = {
-            "甲": "積極的にアプローチし、相手をリードする",
-            "乙": "相手に合わせながら、じっくり関係を築く",
-            "丙": "情熱的で、感情表現が豊か",
-            "丁": "細やかな気遣いで相手を包む",
-            "戊": "安定した関係を築き、相手を守る",
-            "己": "相手を受け入れ、支える",
-            "庚": "真っ直ぐな愛情表現",
-            "辛": "上品で洗練された愛し方",
-            "壬": "変化を楽しむ恋愛",
-            "癸": "深い精神的つながりを求める"
-        }
-        return tendencies.get(jikkan, "")
+        return cls.LOVE_TENDENCIES.get(jikkan, "")
+    
+    # 本人の十干と日の十干の相性（簡易版、載っていない組み合わせは3）
+    ELEMENT_COMPATIBILITY = {
+        ("甲", "丙"): 5, ("甲", "丁"): 5, ("甲", "戊"): 3, ("甲", "己"): 3,
+        ("乙", "丙"): 5, ("乙", "丁"): 5, ("乙", "庚"): 2, ("乙", "辛"): 2,
+        ("丙", "戊"): 5, ("丙", "己"): 5, ("丙", "庚"): 3, ("丙", "辛"): 3,
+        ("丁", "戊"): 5, ("丁", "己"): 5, ("丁", "壬"): 2, ("丁", "癸"): 2,
+        # ... 実際はもっと詳細な相性表
+    }
+    
+    # 運勢スコアに基づくアドバイス
+    FORTUNE_ADVICES = {
+        5: "最高の運気！積極的な行動が成功を呼びます",
+        4: "良い運気。チャンスを逃さないで",
+        3: "安定した運気。いつも通りで大丈夫",
+        2: "慎重に行動を。タイミングを見極めて",
+        1: "充電期間。無理せず休息を"
+    }
+    
+    @classmethod
+    def element_fortune_table(cls, start_date, days):
+        """(十干, 日付) の運勢スコア表を返す
+
+        10×days の配列で、[十干の番号, start_date からの日数] がその日のスコア。
+        日の十干は10日周期なので、相性行列の列を並べ替えるだけで作れる。
+        """
+        ordinals = start_date.toordinal() + np.arange(days)
+        return ELEMENT_COMPATIBILITY_MATRIX[:, ordinals % 10]
+    
+    @classmethod
+    def get_weekly_element_scores(cls, week_start):
+        """週の運勢スコア（10×7）"""
+        return cls.element_fortune_table(week_start, 7)
     
     @staticmethod
     def get_daily_element_fortune(jikkan, current_date=None):
@@ -134,22 +199,17 @@ class FortuneCalculator:
             current_date = datetime.now()
         
         # 日の十干を簡易計算
-        day_number = current_date.toordinal()
-        day_jikkan_index = day_number % 10
-        day_jikkan = FortuneCalculator.JIKKAN[day_jikkan_index]
-        
-        # 相性マトリックス（簡易版）
-        compatibility = {
-            ("甲", "丙"): 5, ("甲", "丁"): 5, ("甲", "戊"): 3, ("甲", "己"): 3,
-            ("乙", "丙"): 5, ("乙", "丁"): 5, ("乙", "庚"): 2, ("乙", "辛"): 2,
-            ("丙", "戊"): 5, ("丙", "己"): 5, ("丙", "庚"): 3, ("丙", "辛"): 3,
-            ("丁", "戊"): 5, ("丁", "己"): 5, ("丁", "壬"): 2, ("丁", "癸"): 2,
-            # ... 実際はもっと詳細な相性表
-        }
-        
-        # デフォルトは3（普通）
-        score = compatibility.get((jikkan, day_jikkan), 3)
+        day_jikkan_index = current_date.toordinal() % 10
         
+        jikkan_index = JIKKAN_INDEX.get(jikkan)
+        if jikkan_index is None:
+            # 不明な十干は常に3（普通）
+            day_jikkan = FortuneCalculator.JIKKAN[day_jikkan_index]
+            return FortuneCalculator._daily_element_result(3, day_jikkan)
+        return dict(DAILY_ELEMENT_RESULTS[jikkan_index][day_jikkan_index])
+    
+    @staticmethod
+    def _daily_element_result(score, day_jikkan):
         return {
             "score": score,
             "day_element": day_jikkan,
@@ -160,11 +220,33 @@ class FortuneCalculator:
     @staticmethod
     def _get_fortune_advice(score):
         """運勢スコアに基づくアドバイス"""
-        advices = {
-            5: "最高の運気！積極的な行動が成功を呼びます",
-            4: "良い運気。チャンスを逃さないで",
-            3: "安定した運気。いつも通りで大丈夫",
-            2: "慎重に行動を。タイミングを見極めて",
-            1: "充電期間。無理せず休息を"
-        }
-        return advices.get(score, "")
+        return FortuneCalculator.FORTUNE_ADVICES.get(score, "")
+
+
+# date.toordinal() と datetime64[D] の整数値の差
+ORDINAL_OF_UNIX_EPOCH = datetime(1970, 1, 1).toordinal()
+
+# 動物占い60分類の番号-1 -> ANIMAL_CHARACTERS のキー
+ANIMAL_60_TO_12 = [
+    next(key for key, character in FortuneCalculator.ANIMAL_CHARACTERS.items() if character["name"] == base)
+    for base in calendar_table.ANIMAL_60_BASE
+]
+
+# 十干 -> 番号
+JIKKAN_INDEX = {name: i for i, name in enumerate(FortuneCalculator.JIKKAN)}
+
+# 相性行列（行: 本人の十干, 列: 日の十干）
+ELEMENT_COMPATIBILITY_MATRIX = np.full((10, 10), 3, dtype=np.int8)
+for (_own, _day), _score in FortuneCalculator.ELEMENT_COMPATIBILITY.items():
+    ELEMENT_COMPATIBILITY_MATRIX[JIKKAN_INDEX[_own], JIKKAN_INDEX[_day]] = _score
+ELEMENT_COMPATIBILITY_MATRIX.setflags(write=False)
+
+# get_daily_element_fortune の結果を全組み合わせ分（10×10）作っておく
+DAILY_ELEMENT_RESULTS = [
+    [
+        FortuneCalculator._daily_element_result(int(ELEMENT_COMPATIBILITY_MATRIX[own, day]),
+                                                FortuneCalculator.JIKKAN[day])
+        for day in range(10)
+    ]
+    for own in range(10)
+]
@@ -0,0 +1,251 @@
+import os
+import time
+import threading
+from collections import deque
+
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+from delivery import StageStats
+from ratelimit import TokenBucket, PrioritySlots
+
+# Gemini呼び出しの設定（環境変数で調整可能）
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-pro')
+# 同時に実行する呼び出しの上限（プロセス内の全スレッド共通）
+GEMINI_MAX_CONCURRENCY = int(os.environ.get('GEMINI_MAX_CONCURRENCY', 8))
+# 1回の呼び出しの期限（秒）
+GEMINI_TIMEOUT = float(os.environ.get('GEMINI_TIMEOUT', 20))
+# 空き枠・レート制限を待つ時間の上限（秒）。一斉配信（batch）は長めに待つ
+GEMINI_WAIT_TIMEOUT = float(os.environ.get('GEMINI_WAIT_TIMEOUT', 10))
+GEMINI_BATCH_WAIT_TIMEOUT = float(os.environ.get('GEMINI_BATCH_WAIT_TIMEOUT', 600))
+# ユーザーとの会話（interactive）のために確保しておく割合（同時実行枠・レート制限の両方）
+GEMINI_INTERACTIVE_RESERVED_SHARE = float(os.environ.get('GEMINI_INTERACTIVE_RESERVED_SHARE', 0.25))
+# クォータ（1分あたりのリクエスト数）と瞬間的な上限。どちらもAPIキー全体の値
+GEMINI_RATE_PER_MINUTE = float(os.environ.get('GEMINI_RATE_PER_MINUTE', 60))
+GEMINI_BURST = int(os.environ.get('GEMINI_BURST', 10))
+# レート制限・同時実行枠はプロセスごとに持つので、キー全体の値をプロセス数で割って使う。
+# gunicornのワーカー数（WEB_CONCURRENCY）+ スケジューラーを動かすプロセスの数に合わせる
+GEMINI_PROCESS_COUNT = max(1, int(os.environ.get(
+    'GEMINI_PROCESS_COUNT', os.environ.get('WEB_CONCURRENCY', 1)
+)))
+# サーキットブレーカー：直近 WINDOW 回のうち THRESHOLD 以上が失敗したら COOLDOWN 秒止める
+GEMINI_CIRCUIT_WINDOW = int(os.environ.get('GEMINI_CIRCUIT_WINDOW', 20))
+GEMINI_CIRCUIT_MIN_CALLS = int(os.environ.get('GEMINI_CIRCUIT_MIN_CALLS', 10))
+GEMINI_CIRCUIT_THRESHOLD = float(os.environ.get('GEMINI_CIRCUIT_THRESHOLD', 0.5))
+GEMINI_CIRCUIT_COOLDOWN = float(os.environ.get('GEMINI_CIRCUIT_COOLDOWN', 30))
+
+genai.configure(api_key=os.environ.get('GEMINI_API_KEY', ''))
+
+
+# 呼び出しの優先度
+INTERACTIVE = PrioritySlots.HIGH  # Webhookからの呼び出し（ユーザーが返信を待っている）
+BATCH = PrioritySlots.LOW         # スケジューラーの一斉配信
+
+
+class GeminiUnavailable(Exception):
+    """呼び出しを行わなかった（サーキットが開いている・混雑している）"""
+
+
+class CircuitBreaker:
+    """エラー率によるサーキットブレーカー
+
+    closed: 通常どおり呼び出す
+    open: COOLDOWN の間は呼び出さずにすぐ失敗させる（呼び出し側はフォールバックへ）
+    half_open: COOLDOWN 明けに1回だけ試し、成功すれば closed、失敗すれば再び open
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window=None, min_calls=None, threshold=None, cooldown=None):
+        self.window = window or GEMINI_CIRCUIT_WINDOW
+        self.min_calls = min_calls or GEMINI_CIRCUIT_MIN_CALLS
+        self.threshold = threshold or GEMINI_CIRCUIT_THRESHOLD
+        self.cooldown = cooldown or GEMINI_CIRCUIT_COOLDOWN
+        self.state = self.CLOSED
+        self._results = deque(maxlen=self.window)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        # 各状態に入った回数と、各状態で断った呼び出しの数
+        self.transitions = {self.CLOSED: 0, self.OPEN: 0, self.HALF_OPEN: 0}
+        self.rejected = {self.OPEN: 0, self.HALF_OPEN: 0}
+
+    def _set_state(self, state):
+        if state != self.state:
+            print(f"Gemini circuit: {self.state} -> {state}")
+            self.state = state
+            self.transitions[state] += 1
+
+    def allow(self):
+        """呼び出してよいか（half_open では試しの1回だけ許可）"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.cooldown:
+                    self.rejected[self.OPEN] += 1
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    self.rejected[self.HALF_OPEN] += 1
+                    return False
+                self._probing = True
+            return True
+
+    def record(self, ok):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if ok:
+                    self._results.clear()
+                    self._set_state(self.CLOSED)
+                else:
+                    self._open()
+                return
+            self._results.append(ok)
+            failures = self._results.count(False)
+            if (len(self._results) >= self.min_calls
+                    and failures / len(self._results) >= self.threshold):
+                self._open()
+
+    def cancel(self):
+        """allow() のあと実際には呼び出さなかった（half_open の試しの枠を戻す）"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._results.clear()
+        self._set_state(self.OPEN)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'recent_calls': len(self._results),
+                'recent_errors': self._results.count(False),
+                'transitions': dict(self.transitions),
+                'rejected': dict(self.rejected),
+            }
+
+
+class GeminiClient:
+    """Gemini呼び出しの共通窓口
+
+    すべての呼び出しが同時実行数の上限・レート制限・呼び出しごとの期限・
+    サーキットブレーカーを通る。生成できなかった場合は例外になるので、
+    呼び出し側はこれまでどおりフォールバックの文面を返す。
+
+    同時実行枠とレート制限のトークンは reserved_share の分を interactive 用に残し、
+    batch はその残りだけを使う。枠が空いたときは待っている interactive が先に取る。
+    """
+
+    def __init__(self, model_name=None, max_concurrency=None, timeout=None,
+                 wait_timeout=None, rate_per_minute=None, burst=None, reserved_share=None):
+        self.model = genai.GenerativeModel(model_name or GEMINI_MODEL)
+        self.max_concurrency = max_concurrency or GEMINI_MAX_CONCURRENCY
+        self.timeout = timeout or GEMINI_TIMEOUT
+        self.wait_timeouts = {
+            INTERACTIVE: GEMINI_WAIT_TIMEOUT if wait_timeout is None else wait_timeout,
+            BATCH: GEMINI_BATCH_WAIT_TIMEOUT,
+        }
+        self.reserved_share = (GEMINI_INTERACTIVE_RESERVED_SHARE
+                               if reserved_share is None else reserved_share)
+        # 引数を省略した場合はキー全体の値をこのプロセスの取り分にする
+        if rate_per_minute is None:
+            rate_per_minute = GEMINI_RATE_PER_MINUTE / GEMINI_PROCESS_COUNT
+        if burst is None:
+            burst = max(1, GEMINI_BURST // GEMINI_PROCESS_COUNT)
+        self.bucket = TokenBucket(rate_per_minute / 60.0, burst)
+        self.reserved_tokens = self.bucket.capacity * self.reserved_share
+        reserved_slots = round(self.max_concurrency * self.reserved_share)
+        if self.reserved_share > 0:
+            reserved_slots = max(1, reserved_slots)
+        self.slots = PrioritySlots(self.max_concurrency, reserved_slots)
+        self.circuit = CircuitBreaker()
+        self.latency = StageStats('gemini', window=1000)
+        # 優先度ごとの待ち時間（レート制限 + 同時実行枠）
+        self.wait_stats = {
+            INTERACTIVE: StageStats('interactive wait', window=1000),
+            BATCH: StageStats('batch wait', window=1000),
+        }
+        self.counters = {'calls': 0, 'success': 0, 'errors': 0, 'timeouts': 0,
+                         'circuit_open': 0, 'rate_limited': 0, 'busy': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key):
+        with self._lock:
+            self.counters[key] += 1
+
+    def generate(self, prompt, priority=INTERACTIVE, timeout=None, wait_timeout=None):
+        """プロンプトから文章を生成して返す
+
+        サーキットが開いている・wait_timeout 秒以内に枠が空かない場合は GeminiUnavailable。
+        """
+        wait_timeout = self.wait_timeouts[priority] if wait_timeout is None else wait_timeout
+        if not self.circuit.allow():
+            self._count('circuit_open')
+            raise GeminiUnavailable("Gemini circuit is open")
+
+        acquired = False
+        started = time.monotonic()
+        try:
+            deadline = started + wait_timeout
+            reserve = self.reserved_tokens if priority == BATCH else 0
+            if not self.bucket.acquire(timeout=wait_timeout, reserve=reserve):
+                self._count('rate_limited')
+                self.wait_stats[priority].record(time.monotonic() - started, ok=False)
+                raise GeminiUnavailable("Gemini rate limit wait exceeded")
+            if not self.slots.acquire(priority, timeout=max(0.0, deadline - time.monotonic())):
+                # 呼び出さなかったのでトークンを戻す
+                self.bucket.refund()
+                self._count('busy')
+                self.wait_stats[priority].record(time.monotonic() - started, ok=False)
+                raise GeminiUnavailable("Gemini concurrency limit wait exceeded")
+            acquired = True
+            self.wait_stats[priority].record(time.monotonic() - started)
+            return self._call(prompt, timeout or self.timeout)
+        except GeminiUnavailable:
+            # 呼び出していないのでサーキットの判定には含めない
+            self.circuit.cancel()
+            raise
+        finally:
+            if acquired:
+                self.slots.release(priority)
+
+    def _call(self, prompt, timeout):
+        self._count('calls')
+        started = time.monotonic()
+        try:
+            response = self.model.generate_content(prompt, request_options={'timeout': timeout})
+            text = response.text
+        except Exception as e:
+            self.latency.record(time.monotonic() - started, ok=False)
+            self.circuit.record(False)
+            if isinstance(e, (google_exceptions.DeadlineExceeded, TimeoutError)):
+                self._count('timeouts')
+            self._count('errors')
+            raise
+        self.latency.record(time.monotonic() - started)
+        self.circuit.record(True)
+        self._count('success')
+        return text
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return dict(
+            counters,
+            circuit=self.circuit.stats(),
+            rate_limit=dict(self.bucket.stats(), reserved_tokens=self.reserved_tokens,
+                            process_count=GEMINI_PROCESS_COUNT),
+            slots=self.slots.stats(),
+            queue_wait={priority: stats.summary() for priority, stats in self.wait_stats.items()},
+            latency=self.latency.summary(),
+        )
+
+
+# プロセス内で共有するクライアント
+gemini = GeminiClient()
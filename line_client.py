@@ -0,0 +1,477 @@
+import os
+import time
+import uuid
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+from linebot.models import TextSendMessage
+
+from delivery import StageStats
+from ratelimit import TokenBucket
+
+# LINE APIの設定（環境変数で調整可能）
+LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', '')
+# 検証用のLINE代替サーバーに向けるときに変更する
+LINE_API_ENDPOINT = os.environ.get('LINE_API_ENDPOINT', 'https://api.line.me')
+# keep-aliveで使い回す接続の数（同時に送るリクエスト数以上にする）
+LINE_POOL_SIZE = int(os.environ.get('LINE_POOL_SIZE', 32))
+# push_many で同時に送るリクエスト数の上限
+LINE_PUSH_MAX_IN_FLIGHT = int(os.environ.get('LINE_PUSH_MAX_IN_FLIGHT', 16))
+# 1リクエストの期限（秒）
+LINE_TIMEOUT = float(os.environ.get('LINE_TIMEOUT', 10))
+# pushのレート制限（LINEの上限 2,000件/秒 に余裕を持たせる）
+LINE_PUSH_RATE_PER_SECOND = float(os.environ.get('LINE_PUSH_RATE_PER_SECOND', 1500))
+# 429・5xx・通信エラーのときの再試行（指数バックオフ + ジッター）
+LINE_PUSH_MAX_RETRIES = int(os.environ.get('LINE_PUSH_MAX_RETRIES', 5))
+LINE_RETRY_BASE_DELAY = float(os.environ.get('LINE_RETRY_BASE_DELAY', 1.0))
+LINE_RETRY_MAX_DELAY = float(os.environ.get('LINE_RETRY_MAX_DELAY', 60))
+# multicast 1回あたりの宛先の上限（LINEの上限は500）
+LINE_MULTICAST_MAX_RECIPIENTS = min(500, int(os.environ.get('LINE_MULTICAST_MAX_RECIPIENTS', 500)))
+# LINEが同じ X-Line-Retry-Key を重複として扱う期間（時間）。過ぎたキーは新しいリクエストと同じ
+LINE_RETRY_KEY_VALID_HOURS = 24
+# 1回の push・multicast に入れられるメッセージ数の上限（LINEの仕様）
+LINE_MAX_MESSAGES_PER_REQUEST = 5
+# MulticastBatcher が同じ内容の宛先を待つ時間（秒）と、溜めておく宛先数の上限
+LINE_MULTICAST_WINDOW = float(os.environ.get('LINE_MULTICAST_WINDOW', 2.0))
+LINE_MULTICAST_BUFFER_SIZE = int(os.environ.get('LINE_MULTICAST_BUFFER_SIZE', 20000))
+
+# レイテンシのヒストグラムの区切り（秒）
+LATENCY_BUCKETS = [0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def shared_session():
+    """プロセス内で共有する requests.Session（fork後は作り直す）"""
+    global _session, _session_pid
+    if _session is not None and _session_pid == os.getpid():
+        return _session
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=LINE_POOL_SIZE, pool_block=False)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+            _session_pid = os.getpid()
+    return _session
+
+
+class PooledHttpClient(RequestsHttpClient):
+    """接続を使い回す HttpClient
+
+    SDK標準の RequestsHttpClient は requests.post などをそのまま呼ぶため、
+    リクエストのたびにTCP/TLS接続を張り直す。こちらは共有のセッションを使う。
+    """
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = shared_session().get(
+            url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = shared_session().post(
+            url, headers=headers, data=data, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = shared_session().put(
+            url, headers=headers, data=data, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = shared_session().delete(
+            url, headers=headers, data=data, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+
+
+class PushFailed(Exception):
+    """再試行しても送れなかったpush"""
+
+    def __init__(self, to, retry_key, attempts, cause):
+        target = f"{len(to)} recipients" if isinstance(to, (list, tuple)) else to
+        super().__init__(f"push to {target} failed after {attempts} attempts: {cause}")
+        self.to = to
+        self.retry_key = retry_key
+        self.attempts = attempts
+        self.cause = cause
+        self.status_code = getattr(cause, 'status_code', None)
+
+
+def is_retryable(error):
+    """再試行すれば通る可能性があるエラーか（429・5xx・通信エラー）"""
+    if isinstance(error, LineBotApiError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def retry_delay(attempt, error=None):
+    """attempt 回目の失敗後に待つ秒数（Retry-After があればそれに従う）"""
+    headers = getattr(error, 'headers', None) or {}
+    retry_after = headers.get('Retry-After') or headers.get('retry-after')
+    if retry_after:
+        try:
+            return min(LINE_RETRY_MAX_DELAY, float(retry_after))
+        except ValueError:
+            pass
+    # フルジッター：0〜base*2^attempt のランダム（同時に再送が集中しないように）
+    return random.uniform(0, min(LINE_RETRY_MAX_DELAY, LINE_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+class LineClient:
+    """LINE Messaging API の共通クライアント
+
+    LineBotApi はリクエストヘッダー（X-Line-Retry-Key など）をインスタンスに持つため、
+    スレッドごとにインスタンスを作る。HTTP接続はすべてのスレッドで共有のプールを使う。
+    """
+
+    def __init__(self, channel_access_token=None, endpoint=None, timeout=None, max_in_flight=None):
+        self.channel_access_token = channel_access_token or LINE_CHANNEL_ACCESS_TOKEN
+        self.endpoint = endpoint or LINE_API_ENDPOINT
+        self.timeout = timeout or LINE_TIMEOUT
+        self.max_in_flight = max_in_flight or LINE_PUSH_MAX_IN_FLIGHT
+        self._local = threading.local()
+        self.push_stats = StageStats('push', window=1000, buckets=LATENCY_BUCKETS)
+        self.reply_stats = StageStats('reply', window=1000, buckets=LATENCY_BUCKETS)
+        self.multicast_stats = StageStats('multicast', window=1000, buckets=LATENCY_BUCKETS)
+        self.push_bucket = TokenBucket(LINE_PUSH_RATE_PER_SECOND)
+        self.counters = {'retries': 0, 'rate_limited': 0, 'server_errors': 0,
+                         'network_errors': 0, 'other_errors': 0, 'duplicates': 0, 'gave_up': 0,
+                         'multicast_recipients': 0}
+        self._lock = threading.Lock()
+
+    @property
+    def api(self):
+        """このスレッド用の LineBotApi"""
+        api = getattr(self._local, 'api', None)
+        if api is None:
+            api = LineBotApi(
+                self.channel_access_token, endpoint=self.endpoint,
+                timeout=self.timeout, http_client=PooledHttpClient
+            )
+            self._local.api = api
+        return api
+
+    def reply_message(self, reply_token, messages, **kwargs):
+        started = time.monotonic()
+        try:
+            self.api.reply_message(reply_token, messages, **kwargs)
+        except Exception:
+            self.reply_stats.record(time.monotonic() - started, ok=False)
+            raise
+        self.reply_stats.record(time.monotonic() - started)
+
+    def push_message(self, to, messages, retry_key=None, **kwargs):
+        api = self.api
+        started = time.monotonic()
+        try:
+            api.push_message(to, messages, retry_key=retry_key, **kwargs)
+        except Exception:
+            self.push_stats.record(time.monotonic() - started, ok=False)
+            raise
+        finally:
+            # LineBotApi は retry_key をヘッダーに残したままにするので、次の送信に持ち越さない
+            api.headers.pop('X-Line-Retry-Key', None)
+        self.push_stats.record(time.monotonic() - started)
+
+    def multicast(self, to, messages, retry_key=None, **kwargs):
+        api = self.api
+        started = time.monotonic()
+        try:
+            api.multicast(to, messages, retry_key=retry_key, **kwargs)
+        except Exception:
+            self.multicast_stats.record(time.monotonic() - started, ok=False)
+            raise
+        finally:
+            api.headers.pop('X-Line-Retry-Key', None)
+        self.multicast_stats.record(time.monotonic() - started)
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.counters[key] += amount
+
+    def push_reliably(self, to, messages, retry_key=None, max_retries=None):
+        """レート制限を守って送信し、429・5xx・通信エラーは待ってから再送する
+
+        再送には毎回同じ X-Line-Retry-Key を使うので、前の送信が実は届いていても二重には届かない
+        （その場合LINEは409を返すので、送信済みとして扱う）。
+        再試行しても送れなかった場合・再試行できないエラーの場合は（想定外の例外も含めて）PushFailed。
+        """
+        return self._send_reliably(self.push_message, to, messages, retry_key, max_retries)
+
+    def multicast_reliably(self, to, messages, retry_key=None, max_retries=None):
+        """複数の宛先（LINE_MULTICAST_MAX_RECIPIENTS 人まで）に同じメッセージを1回で送る
+
+        再送の扱いは push_reliably と同じ。失敗した場合は宛先全員が未配信。
+        """
+        if len(to) > LINE_MULTICAST_MAX_RECIPIENTS:
+            raise ValueError(f"multicast supports up to {LINE_MULTICAST_MAX_RECIPIENTS} recipients")
+        attempts = self._send_reliably(self.multicast, list(to), messages, retry_key, max_retries)
+        self._count('multicast_recipients', len(to))
+        return attempts
+
+    def _send_reliably(self, send, to, messages, retry_key, max_retries):
+        retry_key = retry_key or str(uuid.uuid4())
+        max_retries = LINE_PUSH_MAX_RETRIES if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            # multicast も1リクエストとして数える（LINEのレート制限はリクエスト単位）
+            self.push_bucket.acquire()
+            attempt += 1
+            try:
+                send(to, messages, retry_key=retry_key)
+                return attempt
+            except LineBotApiError as e:
+                if e.status_code == 409:
+                    # 同じ retry key のリクエストを受付済み
+                    self._count('duplicates')
+                    return attempt
+                error = e
+                if e.status_code == 429:
+                    self._count('rate_limited')
+                elif e.status_code >= 500:
+                    self._count('server_errors')
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._count('network_errors')
+                error = e
+            except requests.RequestException as e:
+                # 応答の途中で切れた・SSLエラーなど。再試行はしないが PushFailed にしてデッドレターに残す
+                self._count('network_errors')
+                error = e
+            except Exception as e:
+                # 応答が読めないなど想定外のエラーも、取りこぼさずに PushFailed にする
+                self._count('other_errors')
+                error = e
+            if not is_retryable(error) or attempt > max_retries:
+                self._count('gave_up')
+                raise PushFailed(to, retry_key, attempt, error) from error
+            self._count('retries')
+            time.sleep(retry_delay(attempt - 1, error))
+
+    def push_many(self, pushes, max_in_flight=None, on_success=None):
+        """(宛先, メッセージ) のイテラブルを並列に送信して結果を集計する
+
+        同時に送るリクエストは max_in_flight 件まで。各宛先は push_reliably で送り、
+        再試行しても送れなかった宛先は failed に (宛先, PushFailed) で入る。
+        on_success(宛先) を渡すと、送れた宛先ごとにその場で呼ぶ（全体の終了を待たない）。
+        """
+        max_in_flight = max_in_flight or self.max_in_flight
+        slots = threading.BoundedSemaphore(max_in_flight)
+        result = {'success': 0, 'errors': 0, 'failed': []}
+        lock = threading.Lock()
+        started = time.monotonic()
+
+        def send(to, messages):
+            try:
+                self.push_reliably(to, messages)
+            except Exception as e:
+                with lock:
+                    result['errors'] += 1
+                    result['failed'].append((to, e))
+                slots.release()
+                return
+            try:
+                with lock:
+                    result['success'] += 1
+                if on_success is not None:
+                    on_success(to)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='line-push') as pool:
+            for to, messages in pushes:
+                slots.acquire()
+                pool.submit(send, to, messages)
+
+        result['elapsed'] = time.monotonic() - started
+        total = result['success'] + result['errors']
+        result['per_sec'] = total / result['elapsed'] if result['elapsed'] else 0.0
+        return result
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            'counters': counters,
+            'rate_limit': self.push_bucket.stats(),
+            'push': self.push_stats.summary(),
+            'multicast': self.multicast_stats.summary(),
+            'reply': self.reply_stats.summary(),
+            'pool_size': LINE_POOL_SIZE,
+            'max_in_flight': self.max_in_flight,
+        }
+
+
+def text_messages_key(text):
+    """テキスト1件またはテキストのリストを、同じ内容かを比べられるタプルにする"""
+    texts = (text,) if isinstance(text, str) else tuple(text)
+    if not 1 <= len(texts) <= LINE_MAX_MESSAGES_PER_REQUEST:
+        raise ValueError(f"a request carries 1 to {LINE_MAX_MESSAGES_PER_REQUEST} messages, got {len(texts)}")
+    return texts
+
+
+def text_messages(text):
+    """テキスト1件またはテキストのリストを TextSendMessage のリストにする"""
+    return [TextSendMessage(text=t) for t in text_messages_key(text)]
+
+
+class MulticastBatcher:
+    """同じ内容のテキストを送る宛先をまとめて multicast で送る
+
+    add(宛先, テキスト) で溜めていき、同じテキストの宛先が chunk_size 人に達したらその場で送る。
+    テキストのリスト（LINE_MAX_MESSAGES_PER_REQUEST 件まで）を渡すと1回のリクエストで続けて送る。
+    最初の宛先が入ってから window 秒経った内容、溜まった宛先が buffer_size 人を超えたときの全部、
+    close() のときの残りを送る（宛先が2人以上なら multicast、1人なら push）。
+    window 秒ごとに待ち時間を過ぎた内容を送るスレッドが動くので、配信が生成を待って止まることはない。
+    送れた宛先には on_delivered(宛先のリスト, テキストのタプル)、送れなかった宛先ごとに
+    on_failure(宛先, メッセージ, PushFailed) を呼ぶ。スレッドセーフ。使い終わったら close() を呼ぶ。
+    """
+
+    def __init__(self, client, on_failure=None, on_delivered=None, chunk_size=None,
+                 buffer_size=None, window=None):
+        self.client = client
+        self.on_failure = on_failure
+        self.on_delivered = on_delivered
+        self.chunk_size = min(chunk_size or LINE_MULTICAST_MAX_RECIPIENTS, LINE_MULTICAST_MAX_RECIPIENTS)
+        self.buffer_size = buffer_size or LINE_MULTICAST_BUFFER_SIZE
+        self.window = LINE_MULTICAST_WINDOW if window is None else window
+        # テキスト -> (最初に入った時刻, 宛先のリスト)。dictの順序がそのまま古い順になる
+        self._groups = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.counts = {'multicast_calls': 0, 'multicast_recipients': 0,
+                       'unicast_calls': 0, 'delivered': 0, 'failed': 0}
+        self._closed = threading.Event()
+        self._timer = None
+        if self.window > 0:
+            self._timer = threading.Thread(target=self._flush_periodically,
+                                           name='multicast-window', daemon=True)
+            self._timer.start()
+
+    def _count(self, **amounts):
+        with self._lock:
+            for key, amount in amounts.items():
+                self.counts[key] += amount
+
+    def add(self, to, text):
+        texts = text_messages_key(text)
+        if self.window <= 0:
+            self._send({texts: [to]})
+            return
+        with self._lock:
+            group = self._groups.setdefault(texts, (time.monotonic(), []))[1]
+            group.append(to)
+            self._pending += 1
+            if len(group) >= self.chunk_size:
+                ready = {texts: self._groups.pop(texts)[1]}
+                self._pending -= len(ready[texts])
+            elif self._pending >= self.buffer_size:
+                ready = self._take_all()
+            else:
+                return
+        self._send(ready)
+
+    def flush(self):
+        """溜まっている宛先をすべて送る"""
+        with self._lock:
+            ready = self._take_all()
+        self._send(ready)
+
+    def close(self):
+        """待ち時間を見るスレッドを止めて、残りを送る"""
+        self._closed.set()
+        if self._timer is not None:
+            self._timer.join()
+        self.flush()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.window / 2):
+            self.flush_expired()
+
+    def flush_expired(self):
+        """最初の宛先が入ってから window 秒以上経った内容を送る"""
+        deadline = time.monotonic() - self.window
+        ready = {}
+        with self._lock:
+            for texts, (added_at, recipients) in self._groups.items():
+                if added_at > deadline:
+                    break
+                ready[texts] = recipients
+            for texts, recipients in ready.items():
+                del self._groups[texts]
+                self._pending -= len(recipients)
+        if ready:
+            self._send(ready)
+
+    def _take_all(self):
+        ready = {texts: recipients for texts, (added_at, recipients) in self._groups.items()}
+        self._groups = {}
+        self._pending = 0
+        return ready
+
+    def _send(self, groups):
+        singles = []
+        for texts, recipients in groups.items():
+            if len(recipients) == 1:
+                singles.append((recipients[0], texts))
+                continue
+            for start in range(0, len(recipients), self.chunk_size):
+                self._multicast(recipients[start:start + self.chunk_size], texts)
+        if singles:
+            payloads = dict(singles)
+            
+            def delivered(to):
+                # 1人送れるごとに記録する（途中で止まっても送った分は記録に残る）
+                self._count(delivered=1)
+                if self.on_delivered is not None:
+                    self.on_delivered([to], payloads[to])
+            
+            result = self.client.push_many(
+                ((to, text_messages(texts)) for to, texts in singles), on_success=delivered
+            )
+            self._count(unicast_calls=len(singles))
+            for to, error in result['failed']:
+                self._fail(to, text_messages(payloads[to]), error)
+
+    def _multicast(self, recipients, texts):
+        messages = text_messages(texts)
+        try:
+            self.client.multicast_reliably(recipients, messages)
+        except Exception as e:
+            self._count(multicast_calls=1)
+            for to in recipients:
+                self._fail(to, messages, e)
+            return
+        self._count(multicast_calls=1, multicast_recipients=len(recipients),
+                    delivered=len(recipients))
+        if self.on_delivered is not None:
+            self.on_delivered(recipients, texts)
+
+    def _fail(self, to, messages, error):
+        self._count(failed=1)
+        print(f"Error sending to {to}: {error}")
+        if self.on_failure is not None:
+            self.on_failure(to, messages, error)
+
+    def summary(self):
+        with self._lock:
+            counts = dict(self.counts)
+        counts['api_calls'] = counts['multicast_calls'] + counts['unicast_calls']
+        counts['api_calls_saved'] = counts['delivered'] + counts['failed'] - counts['api_calls']
+        return counts
+
+
+# プロセス内で共有するクライアント
+line_client = LineClient()
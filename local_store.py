@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# JSONモード（DATABASE_URLなし）のときのローカル保存先
+LOCAL_STORE_PATH = os.environ.get('LOCAL_STORE_PATH', 'users_data.sqlite3')
+
+
+class SQLiteUserStore:
+    """ローカル用のユーザーデータ保存（組み込みSQLite）
+
+    1ユーザー1行で保存するため、1人分の書き込みはファイル全体の読み書きにならない。
+    書き込みはトランザクション単位でアトミックに行われ（WALモード）、
+    gunicornの複数ワーカーからの同時書き込みはSQLiteのファイルロックで直列化される。
+    その日の占いも daily_fortunes に保存する（ユーザーごとに最新の日付の分だけ残す）。
+    """
+
+    def __init__(self, path=LOCAL_STORE_PATH, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                " user_id TEXT PRIMARY KEY,"
+                " data TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS daily_fortunes ("
+                " user_id TEXT NOT NULL,"
+                " fortune_date TEXT NOT NULL,"
+                " kind TEXT NOT NULL,"
+                " message TEXT NOT NULL,"
+                " PRIMARY KEY (user_id, fortune_date, kind))"
+            )
+
+    def _connect(self):
+        """スレッド・プロセスごとの接続（fork後は作り直す）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        # WAL + synchronous=NORMAL: プロセスが落ちても書きかけの状態は残らない
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def get(self, user_id):
+        row = self._connect().execute(
+            "SELECT data FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, user_id, user_data):
+        """ユーザーデータを丸ごと保存"""
+        self._connect().execute(
+            "INSERT INTO users (user_id, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (user_id, json.dumps(user_data, ensure_ascii=False), time.time())
+        )
+
+    def update(self, user_id, changes):
+        """変更した項目だけを反映（読み込みから書き込みまで排他ロック）"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT data FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            user_data = json.loads(row[0]) if row else {}
+            user_data.update(changes)
+            conn.execute(
+                "INSERT INTO users (user_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (user_id, json.dumps(user_data, ensure_ascii=False), time.time())
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def save_many(self, users_data):
+        """複数ユーザーを1トランザクションで保存"""
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO users (user_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                ((user_id, json.dumps(data, ensure_ascii=False), now)
+                 for user_id, data in users_data.items())
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_daily_fortune(self, user_id, fortune_date, kind='morning'):
+        """ユーザーの生成済み占いを取得（なければNone）"""
+        row = self._connect().execute(
+            "SELECT message FROM daily_fortunes WHERE user_id = ? AND fortune_date = ? AND kind = ?",
+            (user_id, fortune_date.isoformat(), kind)
+        ).fetchone()
+        return row[0] if row else None
+
+    def save_daily_fortune(self, user_id, fortune_date, message, kind='morning'):
+        """生成済みの占いを保存し、そのユーザーの前の日付の分を消す"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM daily_fortunes WHERE user_id = ? AND fortune_date < ?",
+                (user_id, fortune_date.isoformat())
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO daily_fortunes (user_id, fortune_date, kind, message) "
+                "VALUES (?, ?, ?, ?)",
+                (user_id, fortune_date.isoformat(), kind, message)
+            )
+            conn.execute("COMMIT")
+        except Exception as e:
+            conn.execute("ROLLBACK")
+            print(f"Save daily fortune error: {e}")
+            return False
+        return True
+
+    def all(self):
+        rows = self._connect().execute("SELECT user_id, data FROM users")
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def import_json(self, json_file_path):
+        """既存のJSONファイルを取り込む（保存先が空のときだけ）"""
+        if not os.path.exists(json_file_path) or self.count() > 0:
+            return 0
+        try:
+            with open(json_file_path, 'r', encoding='utf-8') as f:
+                users_data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Local store import error: {e}")
+            return 0
+        if users_data:
+            self.save_many(users_data)
+            print(f"Imported {len(users_data)} users from {json_file_path} into {self.path}")
+        return len(users_data)
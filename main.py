@@ -1,30 +1,67 @@
 import os
 import json
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
+import time
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from flask import Flask, request, abort, jsonify
+from linebot import WebhookParser
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage, FollowEvent,
     ImageMessage, QuickReply, QuickReplyButton, MessageAction
 )
 import google.generativeai as genai
-from datetime import datetime, time
-import re
+from datetime import datetime
+import pytz
 
 # カスタムモジュール
 from fortune_logic import FortuneCalculator
+from birthday_parser import parse_birthday
+from compatibility import CompatibilityCalculator
+from webhook_queue import WebhookWorkerPool
+from cache import TTLCache
+from gemini_client import gemini
+from line_client import line_client
 
 app = Flask(__name__)
 
+# タイムゾーン設定（日本時間）
+JST = pytz.timezone('Asia/Tokyo')
+
 # 環境変数から取得（デフォルト値付き）
-line_bot_api = LineBotApi(os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', ''))
-handler = WebhookHandler(os.environ.get('LINE_CHANNEL_SECRET', ''))
+# LINE APIは共通クライアント（keep-aliveの接続プールを共有）を使う
+line_bot_api = line_client
+parser = WebhookParser(os.environ.get('LINE_CHANNEL_SECRET', ''))
+
+# イベントの種類（メッセージイベントはメッセージの種類も）ごとの処理関数
+event_handlers = {}
+
+def on_event(event_type, message=None):
+    """event_handlers に処理関数を登録するデコレーター"""
+    def register(func):
+        event_handlers[(event_type, message)] = func
+        return func
+    return register
 
-# Gemini設定
-genai.configure(api_key=os.environ.get('GEMINI_API_KEY', ''))
-model = genai.GenerativeModel('gemini-pro')
+# Gemini設定（呼び出しは gemini_client.gemini を通す）
 vision_model = genai.GenerativeModel('gemini-pro-vision')
 
+# AI生成を待って返信する時間の上限（秒）。超えたら後からpushで届ける
+REPLY_DEADLINE_SECONDS = float(os.environ.get('REPLY_DEADLINE_SECONDS', 10))
+GENERATING_NOTICE = """🔮 占いを作成中です…
+
+できあがったらすぐにお届けします！
+少しだけお待ちください😊"""
+reply_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('REPLY_GENERATION_WORKERS', 8)),
+    thread_name_prefix='reply-gen'
+)
+# 返信の結果（fast: 期限内 / late: 後からpush / fallback: 期限内に生成失敗）。1リクエストに1つ数える
+# late_fallback は late のうち後から生成に失敗した件数（late の内数）
+reply_outcomes = {'fast': 0, 'late': 0, 'fallback': 0, 'late_fallback': 0}
+reply_outcomes_lock = threading.Lock()
+
 # データベース初期化を試みる
 USE_DATABASE = False
 try:
@@ -36,47 +73,112 @@ except Exception as e:
     print(f"Database initialization failed, using JSON: {e}")
     USE_DATABASE = False
 
+# DBが使えない場合のローカル保存（LOCAL_STORAGE=json で従来のJSONファイル）
+LOCAL_STORAGE = os.environ.get('LOCAL_STORAGE', 'sqlite').lower()
+local_store = None
+if not USE_DATABASE and LOCAL_STORAGE == 'sqlite':
+    from local_store import SQLiteUserStore
+    local_store = SQLiteUserStore()
+    local_store.import_json('users_data.json')
+
 # JSONファイル操作関数（フォールバック用）
 def load_users_data_json():
     try:
         with open('users_data.json', 'r', encoding='utf-8') as f:
             return json.load(f)
-    except:
+    except Exception:
         return {}
 
 def save_users_data_json(data):
     with open('users_data.json', 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
 
+# ユーザーデータのキャッシュ
+# キャッシュはgunicornのワーカーごとにあるので、別ワーカーでの更新に備えて
+# DBモードではヒット時にDBのupdated_atと照合する（USER_CACHE_VALIDATE=0 で照合しない）。
+# 照合しないモードでは、返信のたびに段階が進むオンボーディング中のユーザーを
+# 短いTTL（USER_CACHE_ONBOARDING_TTL）でキャッシュする
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1000))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 30))
+USER_CACHE_ONBOARDING_TTL = float(os.environ.get('USER_CACHE_ONBOARDING_TTL', 5))
+USER_CACHE_VALIDATE = os.environ.get('USER_CACHE_VALIDATE', 'true').lower() in ('1', 'true', 'yes')
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
 # ユーザーデータ操作のラッパー関数
 def get_user_data(user_id):
     """ユーザーデータを取得"""
+    user_data = user_cache.get(user_id)
+    if user_data is not None:
+        if not (USE_DATABASE and USER_CACHE_VALIDATE):
+            return user_data
+        if DatabaseManager.get_user_version(user_id) == user_data.get('updated_at'):
+            return user_data
+        user_cache.record_stale(user_id)
+    
     if USE_DATABASE:
-        return DatabaseManager.get_user(user_id)
+        user_data = DatabaseManager.get_user(user_id)
+    elif local_store:
+        user_data = local_store.get(user_id)
     else:
         users_data = load_users_data_json()
-        return users_data.get(user_id)
+        user_data = users_data.get(user_id)
+    
+    if user_data is not None:
+        user_cache.set(user_id, user_data, ttl=user_cache_ttl(user_data))
+    return user_data
+
+def user_cache_ttl(user_data):
+    """キャッシュの有効期限（照合しないモードのオンボーディング中は短くする）"""
+    if (USE_DATABASE and USER_CACHE_VALIDATE) or user_data.get('onboarding_complete'):
+        return USER_CACHE_TTL
+    return USER_CACHE_ONBOARDING_TTL
 
 def save_user_data(user_id, user_data):
     """ユーザーデータを保存"""
+    user_cache.invalidate(user_id)
     if USE_DATABASE:
         return DatabaseManager.save_user(user_id, user_data)
+    elif local_store:
+        local_store.save(user_id, user_data)
+        return True
     else:
         users_data = load_users_data_json()
         users_data[user_id] = user_data
         save_users_data_json(users_data)
         return True
 
+def update_user_fields(user_id, **changes):
+    """変更した項目だけを保存"""
+    if USE_DATABASE:
+        saved = DatabaseManager.update_user_fields(user_id, **changes)
+    elif local_store:
+        local_store.update(user_id, changes)
+        saved = True
+    else:
+        users_data = load_users_data_json()
+        users_data.setdefault(user_id, {}).update(changes)
+        save_users_data_json(users_data)
+        saved = True
+    
+    # 照合モードではupdated_atが変わるので捨てる。それ以外は変更をキャッシュにも反映
+    if saved and not (USE_DATABASE and USER_CACHE_VALIDATE):
+        user_cache.update(user_id, changes)
+    else:
+        user_cache.invalidate(user_id)
+    return saved
+
 def get_all_users_data():
     """全ユーザーデータを取得"""
     if USE_DATABASE:
         return DatabaseManager.get_all_users()
+    elif local_store:
+        return local_store.all()
     else:
         return load_users_data_json()
 
 @app.route("/")
 def home():
-    mode = "PostgreSQL" if USE_DATABASE else "JSON"
+    mode = "PostgreSQL" if USE_DATABASE else ("SQLite" if local_store else "JSON")
     return f"""
     <h1>ポチ恋 Bot is running! 💕</h1>
     <p>1タップ恋愛占い - {mode}モード</p>
@@ -90,14 +192,52 @@ def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
 
+    # 署名検証と解析だけここで行い、イベント処理はワーカーに任せてすぐに200を返す
     try:
-        handler.handle(body, signature)
+        payload = parser.parse(body, signature, as_payload=True)
     except InvalidSignatureError:
         abort(400)
 
+    # 1回のWebhookに複数ユーザーのイベントが入ることがあるので、イベントごとに振り分ける
+    for event in payload.events:
+        source = getattr(event, 'source', None)
+        shard_key = source.sender_id if source is not None else None
+        webhook_workers.submit(shard_key, event)
+
     return 'OK'
 
-@handler.add(FollowEvent)
+@app.route("/metrics")
+def metrics():
+    with reply_outcomes_lock:
+        replies = dict(reply_outcomes)
+    return jsonify({
+        'webhook': webhook_workers.stats(),
+        'replies': replies,
+        'db_pool': DatabaseManager.pool_stats() if USE_DATABASE else None,
+        'user_cache': user_cache.stats(),
+        'gemini': gemini.stats(),
+        'line': line_client.stats()
+    })
+
+def process_webhook(event):
+    """ワーカースレッドでのイベント処理（解析済みのイベントを event_handlers の処理関数に渡す）
+
+    メッセージの種類まで一致する処理関数がなければ、イベントの種類だけで登録した処理関数を使う。
+    登録のないイベントは何もしない。
+    """
+    message = getattr(event, 'message', None)
+    func = None
+    if message is not None:
+        func = event_handlers.get((type(event), type(message)))
+    if func is None:
+        func = event_handlers.get((type(event), None))
+    if func is not None:
+        func(event)
+
+webhook_workers = WebhookWorkerPool(process_webhook)
+atexit.register(webhook_workers.drain)
+
+@on_event(FollowEvent)
 def handle_follow(event):
     user_id = event.source.user_id
 
@@ -126,7 +266,7 @@ def handle_follow(event):
         TextSendMessage(text=welcome_message)
     )
 
-@handler.add(MessageEvent, message=TextMessage)
+@on_event(MessageEvent, message=TextMessage)
 def handle_message(event):
     user_id = event.source.user_id
     user_message = event.message.text.strip()
@@ -171,7 +311,7 @@ def handle_message(event):
     # 通常の処理
     handle_regular_message(event, user_id, user_data)
 
-@handler.add(MessageEvent, message=ImageMessage)
+@on_event(MessageEvent, message=ImageMessage)
 def handle_image_simple(event):
     """手相画像の簡易処理"""
     user_id = event.source.user_id
@@ -183,28 +323,32 @@ def handle_image_simple(event):
     # オンボーディング中の手相受付
     if user_data.get("onboarding_stage") == 5:
         # 簡易的な手相分析
-        user_data["palm_analysis"] = "手相から素晴らしい恋愛運を感じます！感情線がはっきりしていて、愛情深い性格が表れています。"
-        user_data["palm_uploaded_at"] = datetime.now().isoformat()
-        user_data["onboarding_complete"] = True
+        changes = {
+            "palm_analysis": "手相から素晴らしい恋愛運を感じます！感情線がはっきりしていて、愛情深い性格が表れています。",
+            "palm_uploaded_at": datetime.now().isoformat(),
+            "onboarding_complete": True
+        }
         
         # データを保存
-        save_user_data(user_id, user_data)
+        user_data.update(changes)
+        update_user_fields(user_id, **changes)
         
         # 初回診断を生成
-        fortune = generate_first_fortune_with_all_data(user_data)
-        
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=fortune)
+        reply_with_deadline(
+            event, user_id,
+            lambda: generate_first_fortune_with_all_data(user_data, raise_on_error=True),
+            lambda: first_fortune_fallback(user_data)
         )
 
 def handle_onboarding(event, user_id, user_data):
     stage = user_data.get("onboarding_stage", 0)
     message = event.message.text
+    # このメッセージで変更した項目（最後にまとめて保存）
+    changes = {}
 
     if stage == 0:  # 名前
-        user_data["name"] = message
-        user_data["onboarding_stage"] = 1
+        changes["name"] = message
+        changes["onboarding_stage"] = 1
         reply = f"""ありがとうございます、{message}さん✨
 
 次に、性別を教えてください！
@@ -221,7 +365,7 @@ def handle_onboarding(event, user_id, user_data):
         ])
         
         # データを保存
-        save_user_data(user_id, user_data)
+        update_user_fields(user_id, **changes)
         
         line_bot_api.reply_message(
             event.reply_token,
@@ -231,8 +375,8 @@ def handle_onboarding(event, user_id, user_data):
 
     elif stage == 1:  # 性別
         if message in ["女性", "男性", "その他"]:
-            user_data["gender"] = message
-            user_data["onboarding_stage"] = 2
+            changes["gender"] = message
+            changes["onboarding_stage"] = 2
             reply = """生年月日を教えてください📅
 
 （例：1995年4月15日）
@@ -243,17 +387,18 @@ def handle_onboarding(event, user_id, user_data):
             reply = "ボタンから選んでください😊"
 
     elif stage == 2:  # 生年月日
-        if validate_birthday(message):
-            user_data["birthday"] = message
+        birth_date = validate_birthday(message)
+        if birth_date:
+            changes["birthday"] = message
             
-            # 算命学と動物占いを計算
+            # 算命学と動物占いを計算（解析済みの日付を渡す）
             try:
-                sanmeigaku = FortuneCalculator.calculate_sanmeigaku(message)
-                animal = FortuneCalculator.calculate_animal_character(message)
+                sanmeigaku = FortuneCalculator.calculate_sanmeigaku(birth_date)
+                animal = FortuneCalculator.calculate_animal_character(birth_date)
                 
                 if sanmeigaku and animal:
-                    user_data["sanmeigaku"] = sanmeigaku
-                    user_data["animal_character"] = animal
+                    changes["sanmeigaku"] = sanmeigaku
+                    changes["animal_character"] = animal
                     
                     reply = f"""素敵！{user_data['name']}さんは
 {animal['name']}タイプですね🐾
@@ -289,7 +434,7 @@ def handle_onboarding(event, user_id, user_data):
 3️⃣ 復縁したい
 4️⃣ 出会いを探してる"""
             
-            user_data["onboarding_stage"] = 3
+            changes["onboarding_stage"] = 3
         else:
             reply = "正しい形式で入力してください😊\n例：1995年4月15日"
 
@@ -302,8 +447,8 @@ def handle_onboarding(event, user_id, user_data):
         }
 
         if message in status_map:
-            user_data["relationship_status"] = status_map[message]
-            user_data["onboarding_stage"] = 4
+            changes["relationship_status"] = status_map[message]
+            changes["onboarding_stage"] = 4
             reply = """恋愛で一番の悩みは？
 
 1️⃣ タイミングがわからない
@@ -324,8 +469,8 @@ def handle_onboarding(event, user_id, user_data):
         }
 
         if message in concern_map:
-            user_data["main_concern"] = concern_map[message]
-            user_data["onboarding_stage"] = 5
+            changes["main_concern"] = concern_map[message]
+            changes["onboarding_stage"] = 5
             
             reply = """最後に、より精度の高い
 占いのために...
@@ -343,15 +488,20 @@ def handle_onboarding(event, user_id, user_data):
     
     elif stage == 5:  # 手相待ち
         if message.lower() in ["スキップ", "スキップする", "skip"]:
-            user_data["onboarding_complete"] = True
-            user_data["palm_analysis"] = None
+            changes["onboarding_complete"] = True
+            changes["palm_analysis"] = None
             
             # データを保存
-            save_user_data(user_id, user_data)
+            user_data.update(changes)
+            update_user_fields(user_id, **changes)
             
             # 初回診断を生成
-            fortune = generate_first_fortune_with_all_data(user_data)
-            reply = fortune
+            reply_with_deadline(
+                event, user_id,
+                lambda: generate_first_fortune_with_all_data(user_data, raise_on_error=True),
+                lambda: first_fortune_fallback(user_data)
+            )
+            return
         else:
             # 画像は後で処理されるので、ここでは手相以外のテキストに対応
             reply = """手相の写真を送ってください📸
@@ -359,8 +509,10 @@ def handle_onboarding(event, user_id, user_data):
 または「スキップする」と入力して
 次に進むこともできます！"""
 
-    # データを保存
-    save_user_data(user_id, user_data)
+    # 変更した項目だけを保存
+    if changes:
+        user_data.update(changes)
+        update_user_fields(user_id, **changes)
 
     # 返信
     line_bot_api.reply_message(
@@ -368,26 +520,72 @@ def handle_onboarding(event, user_id, user_data):
         TextSendMessage(text=reply)
     )
 
+def reply_with_deadline(event, user_id, generate, fallback):
+    """AI生成を待つ返信
+
+    イベント受信から REPLY_DEADLINE_SECONDS 以内に生成できればそのまま返信し、
+    間に合わなければ先に「作成中」と返信して、結果は後からpushで届ける。
+    生成に失敗した場合はフォールバックの文面を使う。
+    """
+    future = reply_executor.submit(generate)
+    
+    # キューで待った時間も含めて、イベントの受信時刻から期限を計算
+    elapsed = time.time() - event.timestamp / 1000
+    budget = max(0.0, REPLY_DEADLINE_SECONDS - elapsed)
+    
+    try:
+        reply = future.result(timeout=budget)
+        count_reply_outcome('fast')
+    except FutureTimeoutError:
+        count_reply_outcome('late')
+        # 「作成中」の返信に失敗しても結果は届けるので、先にコールバックを登録する
+        future.add_done_callback(lambda f: push_late_reply(user_id, f, fallback))
+        try:
+            line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text=GENERATING_NOTICE)
+            )
+        except Exception as e:
+            print(f"Error replying generating notice to {user_id}: {e}")
+        return
+    except Exception as e:
+        print(f"Reply generation error: {e}")
+        count_reply_outcome('fallback')
+        reply = fallback()
+    
+    line_bot_api.reply_message(
+        event.reply_token,
+        TextSendMessage(text=reply)
+    )
+
+def push_late_reply(user_id, future, fallback):
+    """期限に間に合わなかった生成結果をpushで届ける"""
+    try:
+        message = future.result()
+    except Exception as e:
+        print(f"Reply generation error: {e}")
+        count_reply_outcome('late_fallback')
+        message = fallback()
+    
+    try:
+        line_client.push_reliably(user_id, TextSendMessage(text=message))
+    except Exception as e:
+        print(f"Error pushing late reply to {user_id}: {e}")
+
+def count_reply_outcome(outcome):
+    with reply_outcomes_lock:
+        reply_outcomes[outcome] += 1
+
 def validate_birthday(text):
-    patterns = [
-        r'(\d{4})年(\d{1,2})月(\d{1,2})日',
-        r'平成(\d{1,2})年(\d{1,2})月(\d{1,2})日',
-        r'昭和(\d{1,2})年(\d{1,2})月(\d{1,2})日',
-        r'(\d{4})/(\d{1,2})/(\d{1,2})',
-        r'(\d{4})-(\d{1,2})-(\d{1,2})'
-    ]
-
-    for pattern in patterns:
-        if re.search(pattern, text):
-            return True
-    return False
+    """生年月日として読み取れれば date を返す（読み取れなければNone）"""
+    return parse_birthday(text)
 
 def analyze_palm_image(image_data):
     """手相画像をGemini Vision APIで解析（一時的に簡易版）"""
     # 画像処理ライブラリが使えないため、一時的に固定メッセージを返す
     return "手相から温かい愛情運を感じます。詳細な分析は後日お伝えします。"
 
-def generate_first_fortune_with_all_data(user_data):
+def generate_first_fortune_with_all_data(user_data, raise_on_error=False):
     """全データを使った初回診断"""
     animal = user_data.get('animal_character', {})
     sanmeigaku = user_data.get('sanmeigaku', {})
@@ -399,9 +597,11 @@ def generate_first_fortune_with_all_data(user_data):
 * 名前: {user_data.get('name')}
 * 性別: {user_data.get('gender')}
 * 生年月日: {user_data.get('birthday')}
+* 動物占い結果（キャラクター）: {animal.get('full_name', animal.get('name', ''))}
 * 動物占い結果（性格）: {animal.get('traits', '')}
 * 動物占い結果（恋愛傾向）: {animal.get('love', '')}
 * 算命学結果（十干十二支）: {sanmeigaku.get('element', '')}
+* 算命学結果（日干支）: {sanmeigaku.get('day_element', '')}
 * 算命学結果（性格特性）: {sanmeigaku.get('traits', '')}
 * 恋愛状況: {user_data.get('relationship_status')}
 * 悩み: {user_data.get('main_concern')}
@@ -423,15 +623,24 @@ def generate_first_fortune_with_all_data(user_data):
    * 絵文字を各文に1つ程度使用し、感情を豊かに表現する。"""
 
     try:
-        response = model.generate_content(prompt)
+        text = gemini.generate(prompt)
         return f"""🔮 {user_data.get('name')}さんの診断結果 🔮
 
-{response.text}
+{text}
 
 💫 明日から毎朝7時に
 あなただけの占いをお届けします！"""
-    except:
-        return f"""🔮 {user_data.get('name')}さんの診断結果 🔮
+    except Exception as e:
+        if raise_on_error:
+            raise
+        print(f"Gemini API error: {e}")
+        return first_fortune_fallback(user_data)
+
+def first_fortune_fallback(user_data):
+    """Gemini APIが使えない場合の初回診断"""
+    animal = user_data.get('animal_character', {})
+    
+    return f"""🔮 {user_data.get('name')}さんの診断結果 🔮
 
 {animal.get('name', '')}タイプのあなたは
 {animal.get('traits', '')}な魅力の持ち主！
@@ -444,15 +653,15 @@ def generate_first_fortune_with_all_data(user_data):
 
 明日の朝7時に詳細な占いをお届けします！"""
 
-def generate_daily_morning_fortune(user_data):
+def generate_daily_morning_fortune(user_data, raise_on_error=False):
     """毎朝の占い生成（パーソナライズ版）"""
-    now = datetime.now()
+    now = datetime.now(JST)
     animal = user_data.get('animal_character', {})
     sanmeigaku = user_data.get('sanmeigaku', {})
     
     # 今日の運勢を算命学で計算
     daily_fortune = FortuneCalculator.get_daily_element_fortune(
-        sanmeigaku.get('jikkan', '甲')
+        sanmeigaku.get('jikkan', '甲'), now.date()
     )
     
     prompt = f"""
@@ -478,19 +687,33 @@ def generate_daily_morning_fortune(user_data):
 """
 
     try:
-        response = model.generate_content(prompt)
+        text = gemini.generate(prompt)
         
         return f"""おはようございます、{user_data.get('name')}さん☀️
 
 【{now.strftime('%m月%d日')}の運勢】
 算命学×{animal.get('name', '')}の診断
 
-{response.text}
+{text}
 
 詳細診断を見る >"""
         
-    except:
-        return f"""おはようございます、{user_data.get('name')}さん☀️
+    except Exception as e:
+        if raise_on_error:
+            raise
+        print(f"Gemini API error: {e}")
+        return daily_morning_fallback(user_data)
+
+def daily_morning_fallback(user_data):
+    """Gemini APIが使えない場合の今日の占い"""
+    now = datetime.now(JST)
+    animal = user_data.get('animal_character', {})
+    sanmeigaku = user_data.get('sanmeigaku', {})
+    daily_fortune = FortuneCalculator.get_daily_element_fortune(
+        sanmeigaku.get('jikkan', '甲'), now.date()
+    )
+    
+    return f"""おはようございます、{user_data.get('name')}さん☀️
 
 【{now.strftime('%m月%d日')}の運勢】
 総合運：{daily_fortune.get('compatibility', '★★★')}
@@ -506,11 +729,70 @@ def generate_daily_morning_fortune(user_data):
 
 詳細診断を見る >"""
 
+def get_daily_morning_fortune(user_id, user_data, raise_on_error=False):
+    """今日の占いを取得（配信済み・生成済みのものがあれば再利用）
+
+    DBモードではDB、ローカル保存（SQLite）ではローカルの daily_fortunes に保存して使い回す。
+    JSONモード（LOCAL_STORAGE=json）では保存先がないので毎回生成する。
+    """
+    fortune_store = DatabaseManager if USE_DATABASE else local_store
+    if fortune_store is None:
+        return generate_daily_morning_fortune(user_data, raise_on_error)
+    
+    fortune_date = datetime.now(JST).date()
+    fortune = fortune_store.get_daily_fortune(user_id, fortune_date)
+    if fortune:
+        return fortune
+    
+    try:
+        fortune = generate_daily_morning_fortune(user_data, raise_on_error=True)
+    except Exception as e:
+        # フォールバックは保存せず、次回また生成を試みる
+        if raise_on_error:
+            raise
+        print(f"Gemini API error: {e}")
+        return daily_morning_fallback(user_data)
+    
+    fortune_store.save_daily_fortune(user_id, fortune_date, fortune)
+    return fortune
+
+def compatibility_reply(user_data, partner_birthday):
+    """お相手の生年月日（date）との相性診断メッセージ"""
+    result = CompatibilityCalculator.diagnose(
+        FortuneCalculator.parse_birthday(user_data.get('birthday')), partner_birthday
+    )
+    if not result:
+        return """生年月日を読み取れませんでした💦
+（例：1996年8月20日）の形式で送ってください！"""
+    
+    name = user_data.get('name', 'あなた')
+    stars = "★" * result['stars'] + "☆" * (5 - result['stars'])
+    return f"""💕 {name}さんとお相手の相性 💕
+
+お相手：{result['partner_element']}・{result['partner_animal']}
+
+相性度：{result['score']}点 {stars}
+・十干：{result['jikkan']}
+・十二支：{result['junishi']}
+・動物占い：{result['animal']}
+
+{result['comment']}
+
+※算命学による本格相性診断は
+有料プランでさらに詳しく！"""
+
 def handle_regular_message(event, user_id, user_data):
     user_message = event.message.text
+    # 「相性」のあとに送られてきたお相手の生年月日（解析は1回だけ）
+    partner_birthday = validate_birthday(user_message) if user_data.get('birthday') else None
 
     if "診断" in user_message or "占い" in user_message:
-        reply = generate_daily_morning_fortune(user_data)
+        reply_with_deadline(
+            event, user_id,
+            lambda: get_daily_morning_fortune(user_id, user_data, raise_on_error=True),
+            lambda: daily_morning_fallback(user_data)
+        )
+        return
     elif "相性" in user_message:
         reply = """相性診断をご希望ですね💕
 
@@ -519,6 +801,8 @@ def handle_regular_message(event, user_id, user_data):
 
 ※算命学による本格相性診断は
 有料プランでさらに詳しく！"""
+    elif partner_birthday:
+        reply = compatibility_reply(user_data, partner_birthday)
     elif "料金" in user_message or "プラン" in user_message:
         reply = """💰 料金プラン 💰
 
@@ -558,7 +842,6 @@ if __name__ == "__main__":
     # スケジューラーを起動
     try:
         from scheduler import init_scheduler, shutdown_scheduler
-        import atexit
         
         # スケジューラー開始
         init_scheduler()
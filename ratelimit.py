@@ -0,0 +1,129 @@
+import time
+import threading
+
+
+class TokenBucket:
+    """トークンバケットによる流量制限（スレッドセーフ）
+
+    rate は1秒あたりに補充されるトークン数、capacity は貯められる上限（瞬間的な上限）。
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.counters = {'acquired': 0, 'rejected': 0, 'waited': 0, 'refunded': 0}
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def try_acquire(self, tokens=1):
+        """トークンがあれば取得してTrue（待たない）"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                self.counters['acquired'] += 1
+                return True
+            return False
+
+    def acquire(self, tokens=1, timeout=None, reserve=0):
+        """トークンが貯まるまで待って取得。timeout秒以内に取れなければFalse
+
+        reserve を指定すると、その分のトークンを残した状態でしか取得しない
+        （優先度の低い呼び出しが優先度の高い呼び出しの分まで使わないようにする）。
+        """
+        reserve = min(reserve, self.capacity - tokens)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens - reserve >= tokens:
+                    self._tokens -= tokens
+                    self.counters['acquired'] += 1
+                    if waited:
+                        self.counters['waited'] += 1
+                    return True
+                wait = (tokens + reserve - self._tokens) / self.rate
+                if deadline is not None and now + wait > deadline:
+                    self.counters['rejected'] += 1
+                    return False
+            waited = True
+            time.sleep(min(wait, 1.0))
+
+    def refund(self, tokens=1):
+        """取得したトークンを使わなかったときに戻す"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.capacity, self._tokens + tokens)
+            self.counters['refunded'] += 1
+
+    def stats(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return dict(self.counters, tokens=round(self._tokens, 2),
+                        rate=self.rate, capacity=self.capacity)
+
+
+class PrioritySlots:
+    """優先度つきの同時実行枠（スレッドセーフ）
+
+    高優先度（interactive）は空いている枠をすべて使える。
+    低優先度（batch）は reserved 枠を残した範囲でしか使えず、
+    高優先度の呼び出しが待っている間は新しく枠を取らない。
+    """
+
+    HIGH = 'interactive'
+    LOW = 'batch'
+
+    def __init__(self, size, reserved=0):
+        self.size = size
+        # 低優先度にも最低1枠は残す
+        self.reserved = max(0, min(reserved, size - 1))
+        self.in_use = {self.HIGH: 0, self.LOW: 0}
+        self.waiting = {self.HIGH: 0, self.LOW: 0}
+        self._cond = threading.Condition()
+
+    def _can_take(self, priority):
+        if sum(self.in_use.values()) >= self.size:
+            return False
+        if priority == self.HIGH:
+            return True
+        return self.waiting[self.HIGH] == 0 and self.in_use[self.LOW] < self.size - self.reserved
+
+    def acquire(self, priority, timeout=None):
+        """枠を取得。timeout秒以内に取れなければFalse"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self.waiting[priority] += 1
+            try:
+                while not self._can_take(priority):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                self.in_use[priority] += 1
+                return True
+            finally:
+                self.waiting[priority] -= 1
+                # 高優先度が諦めた・取得した場合、待っている低優先度が取れるようになることがある
+                self._cond.notify_all()
+
+    def release(self, priority):
+        with self._cond:
+            self.in_use[priority] -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self.size,
+                'reserved': self.reserved,
+                'in_use': dict(self.in_use),
+                'waiting': dict(self.waiting),
+            }
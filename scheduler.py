@@ -1,44 +1,93 @@
 import os
+import sys
 import json
-from datetime import datetime, time
+import uuid
+import threading
+from time import sleep
+from datetime import datetime, time, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 import pytz
-from linebot import LineBotApi
 from linebot.models import TextSendMessage
-import google.generativeai as genai
 
 # 追加インポート（main.pyから）
-from fortune_logic import FortuneCalculator
+from fortune_logic import FortuneCalculator, JIKKAN_INDEX
+from delivery import FanOutDelivery, BatchWriter
+from gemini_client import gemini, BATCH
+from line_client import (
+    line_client, PushFailed, MulticastBatcher, text_messages, LINE_RETRY_KEY_VALID_HOURS
+)
 
-# 環境変数
-line_bot_api = LineBotApi(os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', ''))
-genai.configure(api_key=os.environ.get('GEMINI_API_KEY', ''))
-model = genai.GenerativeModel('gemini-pro')
+# LINE API（main.pyと共通のクライアント）
+line_bot_api = line_client
 
 # タイムゾーン設定（日本時間）
 JST = pytz.timezone('Asia/Tokyo')
 
+# 朝の占いの配信時刻と事前生成の時刻（日本時間）
+MORNING_DELIVERY_HOUR = 7
+PREGENERATE_HOUR = int(os.environ.get('FORTUNE_PREGENERATE_HOUR', 3))
+# 事前生成した占いの保存日数
+DAILY_FORTUNE_RETENTION_DAYS = int(os.environ.get('DAILY_FORTUNE_RETENTION_DAYS', 7))
+# コホートモード：同じ属性のユーザーには本文を1回だけ生成して名前を差し込む
+FORTUNE_COHORT_MODE = os.environ.get('FORTUNE_COHORT_MODE', '').lower() in ('1', 'true', 'yes')
+# 事前生成の方式：single（1人1回）/ batch（FORTUNE_BATCH_SIZE人分を1回で）/ cohort
+FORTUNE_GENERATION_MODE = os.environ.get(
+    'FORTUNE_GENERATION_MODE', 'cohort' if FORTUNE_COHORT_MODE else 'single'
+).lower()
+FORTUNE_BATCH_SIZE = int(os.environ.get('FORTUNE_BATCH_SIZE', 8))
+# まとめて生成する呼び出しの期限（秒）。出力が長いので1人分より長めにする
+FORTUNE_BATCH_TIMEOUT = float(os.environ.get('FORTUNE_BATCH_TIMEOUT', 60))
+# これより短い本文は形式の誤りとして扱う
+MIN_BATCH_FORTUNE_LENGTH = 30
+# 同じ文面の宛先を multicast にまとめて送る（FORTUNE_PERSONALIZE_NAME がオフのときだけ効く）
+DELIVERY_MULTICAST = os.environ.get('DELIVERY_MULTICAST', 'true').lower() in ('1', 'true', 'yes')
+# 定期配信の文面に名前を入れる（オフにするとコホートや同じフォールバックの文面が全員同一になり、multicastでまとめられる）
+FORTUNE_PERSONALIZE_NAME = os.environ.get('FORTUNE_PERSONALIZE_NAME', 'true').lower() in ('1', 'true', 'yes')
+# 月曜日は週間占いを朝の占いと同じpushで送る（ユーザーの読み込みもAPI呼び出しも1回で済む）
+COALESCE_MONDAY_DELIVERIES = os.environ.get('COALESCE_MONDAY_DELIVERIES', 'true').lower() in ('1', 'true', 'yes')
+# 他のジョブの終了を待つときの確認間隔と上限（秒）
+JOB_WAIT_POLL_SECONDS = float(os.environ.get('JOB_WAIT_POLL_SECONDS', 30))
+JOB_WAIT_TIMEOUT = float(os.environ.get('JOB_WAIT_TIMEOUT', 3 * 60 * 60))
+
 class FortuneScheduler:
     """占い配信スケジューラー"""
     
+    # ジョブIDと実行するメソッド（実行の記録と再開に使う）
+    JOB_METHODS = {
+        'pregenerate_morning_fortune': 'pregenerate_morning_fortunes',
+        'morning_fortune': 'send_morning_fortunes',
+        'weekly_fortune': 'send_weekly_fortunes',
+    }
+    
     def __init__(self):
         self.scheduler = BackgroundScheduler(timezone=JST)
         self.setup_jobs()
     
     def setup_jobs(self):
         """定期実行ジョブの設定"""
-        # 毎朝7時の配信
+        # 深夜に朝の占いを事前生成
+        self.scheduler.add_job(
+            func=self.run_job,
+            args=['pregenerate_morning_fortune'],
+            trigger=CronTrigger(hour=PREGENERATE_HOUR, minute=0, timezone=JST),
+            id='pregenerate_morning_fortune',
+            replace_existing=True
+        )
+        
+        # 毎朝7時の配信（事前生成済みのメッセージを送るだけ）
         self.scheduler.add_job(
-            func=self.send_morning_fortunes,
-            trigger=CronTrigger(hour=7, minute=0, timezone=JST),
+            func=self.run_job,
+            args=['morning_fortune'],
+            trigger=CronTrigger(hour=MORNING_DELIVERY_HOUR, minute=0, timezone=JST),
             id='morning_fortune',
             replace_existing=True
         )
         
         # 毎週月曜日の週間占い
         self.scheduler.add_job(
-            func=self.send_weekly_fortunes,
+            func=self.run_job,
+            args=['weekly_fortune'],
             trigger=CronTrigger(day_of_week='mon', hour=7, minute=30, timezone=JST),
             id='weekly_fortune',
             replace_existing=True
@@ -51,6 +100,65 @@ class FortuneScheduler:
         """スケジューラー開始"""
         self.scheduler.start()
         print("Fortune Scheduler started!")
+        self.resume_interrupted_runs()
+    
+    def run_job(self, job_id):
+        """ジョブを実行し、開始と終了を job_runs に記録する
+
+        プロセスが途中で止まると running のまま残り、次の起動時に再開される。
+        """
+        from database import DatabaseManager
+        
+        run_date = datetime.now(JST).date()
+        DatabaseManager.start_job_run(job_id, run_date)
+        try:
+            result = getattr(self, self.JOB_METHODS[job_id])()
+        except Exception:
+            DatabaseManager.finish_job_run(job_id, run_date, status='failed')
+            raise
+        DatabaseManager.finish_job_run(job_id, run_date)
+        return result
+    
+    def wait_for_job(self, job_id, run_date):
+        """job_id の実行が running の間は待つ（JOB_WAIT_TIMEOUT 秒まで）"""
+        from database import DatabaseManager
+        
+        deadline = datetime.now(JST) + timedelta(seconds=JOB_WAIT_TIMEOUT)
+        while DatabaseManager.get_job_run_status(job_id, run_date) == 'running':
+            if datetime.now(JST) >= deadline:
+                print(f"Gave up waiting for {job_id} ({run_date}) to finish")
+                return False
+            print(f"Waiting for {job_id} ({run_date}) to finish")
+            sleep(JOB_WAIT_POLL_SECONDS)
+        return True
+    
+    def resume_interrupted_runs(self):
+        """前のプロセスで途中になった今日のジョブをすぐに再実行する
+
+        配信済みのユーザーは配信記録で飛ばされるので、残りのユーザーにだけ届く。
+        前日以前の実行は再開せずに abandoned にする。
+        """
+        from database import DatabaseManager
+        
+        try:
+            runs = DatabaseManager.get_interrupted_job_runs()
+        except Exception as e:
+            print(f"Could not check interrupted job runs: {e}")
+            return
+        
+        today = datetime.now(JST).date()
+        for job_id, run_date in runs:
+            if run_date != today or job_id not in self.JOB_METHODS:
+                DatabaseManager.finish_job_run(job_id, run_date, status='abandoned')
+                continue
+            print(f"Resuming interrupted run of {job_id} from {run_date}")
+            # トリガーなしの add_job はすぐに1回だけ実行される
+            self.scheduler.add_job(
+                func=self.run_job,
+                args=[job_id],
+                id=f'resume_{job_id}',
+                replace_existing=True
+            )
     
     def shutdown(self):
         """スケジューラー停止"""
@@ -62,70 +170,527 @@ class FortuneScheduler:
         from database import DatabaseManager
         return DatabaseManager.get_all_users()
     
+    @staticmethod
+    def iter_delivery_users(premium_only=False, **kwargs):
+        """配信対象（オンボーディング完了）のユーザーをDBから少しずつ読み込み"""
+        from database import DatabaseManager
+        return DatabaseManager.iter_users(
+            onboarding_complete=True, premium_only=premium_only, **kwargs
+        )
+    
+    @staticmethod
+    def next_morning_delivery_date():
+        """次の朝の配信日（7時前なら今日、それ以降なら明日）"""
+        now = datetime.now(JST)
+        if now.hour < MORNING_DELIVERY_HOUR:
+            return now.date()
+        return now.date() + timedelta(days=1)
+    
+    def pregenerate_morning_fortunes(self):
+        """朝の占いを事前生成してDBに保存"""
+        from database import DatabaseManager
+        
+        fortune_date = self.next_morning_delivery_date()
+        print(f"Starting morning fortune pre-generation for {fortune_date} at {datetime.now(JST)}")
+        
+        DatabaseManager.purge_daily_fortunes(
+            fortune_date - timedelta(days=DAILY_FORTUNE_RETENTION_DAYS)
+        )
+        DatabaseManager.purge_delivery_logs(
+            fortune_date - timedelta(days=DAILY_FORTUNE_RETENTION_DAYS)
+        )
+        
+        # 生成済みのユーザーはスキップ（再実行しても二重に生成しない）
+        # 生成できなかったユーザーのフォールバックは保存しない（再実行か配信時の生成に任せる）
+        targets = self.iter_delivery_users(missing_daily_fortune=(fortune_date, 'morning'))
+        
+        def store(user_id, message):
+            if not DatabaseManager.save_daily_fortune(user_id, fortune_date, message):
+                raise RuntimeError("failed to store pre-generated fortune")
+        
+        if FORTUNE_GENERATION_MODE == 'cohort':
+            result = self.pregenerate_by_cohort(targets, fortune_date, store)
+        elif FORTUNE_GENERATION_MODE == 'batch':
+            result = self.pregenerate_in_batches(targets, fortune_date, store)
+        else:
+            engine = FanOutDelivery(
+                'Morning fortune pre-generation',
+                generate=lambda user_id, user_data: self.generate_personalized_morning_fortune(
+                    user_data, fortune_date, fallback=False
+                ),
+                push=store
+            )
+            result = engine.run(targets)
+        
+        # 月曜日は週間占いも事前生成しておく（朝の配信・週間配信は保存済みの文面を送るだけ）
+        if fortune_date.weekday() == 0:
+            result['weekly'] = self.pregenerate_weekly_fortunes(fortune_date)
+        return result
+    
+    def pregenerate_weekly_fortunes(self, week_start):
+        """有料ユーザーの週間占いを事前生成して daily_fortunes に kind='weekly' で保存"""
+        from database import DatabaseManager
+        
+        week_scores = FortuneCalculator.get_weekly_element_scores(week_start)
+        # 生成済みのユーザーはスキップ。生成できなかったユーザーは配信時の生成に任せる
+        targets = self.iter_delivery_users(
+            premium_only=True, missing_daily_fortune=(week_start, 'weekly')
+        )
+        
+        def store(user_id, message):
+            if not DatabaseManager.save_daily_fortune(user_id, week_start, message, kind='weekly'):
+                raise RuntimeError("failed to store pre-generated weekly fortune")
+        
+        engine = FanOutDelivery(
+            'Weekly fortune pre-generation',
+            generate=lambda user_id, user_data: self.generate_weekly_fortune(
+                user_data, week_start, week_scores, fallback=False
+            ),
+            push=store
+        )
+        return engine.run(targets)
+    
+    def pregenerate_by_cohort(self, targets, fortune_date, store):
+        """同じ属性の組を持つユーザーをまとめて、コホートごとに1回だけ生成"""
+        cohorts = {}
+        user_count = 0
+        for user_id, user_data in targets:
+            key = self.cohort_key(user_data, fortune_date)
+            if key not in cohorts:
+                # 先頭のユーザーをプロンプト用の代表にする
+                cohorts[key] = (user_data, [])
+            cohorts[key][1].append(
+                (user_id, user_data.get('name', 'あなた'), user_data.get('is_premium', False))
+            )
+            user_count += 1
+        
+        if cohorts:
+            print(f"Cohort mode: {user_count} users in {len(cohorts)} cohorts "
+                  f"(dedup ratio {user_count / len(cohorts):.1f}x)")
+        
+        users = {'stored': 0, 'failed': 0, 'deferred': 0}
+        users_lock = threading.Lock()
+        
+        def count(key, amount=1):
+            with users_lock:
+                users[key] += amount
+        
+        def generate(key, cohort):
+            sample, members = cohort
+            body = self.generate_cohort_morning_body(sample, fortune_date)
+            if body is None:
+                count('deferred', len(members))
+                raise RuntimeError(f"no body generated; {len(members)} users left for delivery time")
+            return sample, members, body
+        
+        def store_members(key, generated):
+            sample, members, body = generated
+            for user_id, name, is_premium in members:
+                # 1人の保存に失敗しても、同じコホートの残りのユーザーは続ける
+                try:
+                    user_data = dict(sample, name=name, is_premium=is_premium)
+                    store(user_id, self.render_morning_fortune(user_data, body, fortune_date))
+                except Exception as e:
+                    print(f"Error storing for {user_id}: {e}")
+                    count('failed')
+                    continue
+                count('stored')
+        
+        engine = FanOutDelivery(
+            'Morning fortune pre-generation (cohort)',
+            generate=generate,
+            push=store_members
+        )
+        result = engine.run(cohorts.items())
+        # FanOutDelivery の件数はコホート単位なので、ユーザー単位の件数を別に出す
+        print(f"  users: {users['stored']} stored, {users['failed']} failed to store, "
+              f"{users['deferred']} left for delivery time")
+        result['users'] = users
+        return result
+    
+    def pregenerate_in_batches(self, targets, fortune_date, store, batch_size=None):
+        """FORTUNE_BATCH_SIZE 人分の占いを1回の呼び出しでまとめて生成"""
+        batch_size = batch_size or FORTUNE_BATCH_SIZE
+        outcomes = {'batched': 0, 'retried': 0, 'deferred': 0}
+        outcomes_lock = threading.Lock()
+        
+        def chunks():
+            # ログ用のキーは「先頭のユーザーID (+残りの人数)」
+            chunk = []
+            for user in targets:
+                chunk.append(user)
+                if len(chunk) == batch_size:
+                    yield f"{chunk[0][0]} (+{len(chunk) - 1})", chunk
+                    chunk = []
+            if chunk:
+                yield f"{chunk[0][0]} (+{len(chunk) - 1})", chunk
+        
+        def generate(batch_key, users):
+            messages, counts = self.generate_morning_fortune_batch(users, fortune_date)
+            with outcomes_lock:
+                for key, count in counts.items():
+                    outcomes[key] += count
+            return messages
+        
+        def store_all(batch_key, messages):
+            for user_id, message in messages:
+                store(user_id, message)
+        
+        engine = FanOutDelivery(
+            f'Morning fortune pre-generation (batch of {batch_size})',
+            generate=generate,
+            push=store_all
+        )
+        result = engine.run(chunks())
+        print(f"  batched: {outcomes['batched']}, retried individually: {outcomes['retried']}, "
+              f"left for delivery time: {outcomes['deferred']}")
+        result['outcomes'] = outcomes
+        return result
+    
+    def build_morning_batch_prompt(self, users, fortune_date):
+        """複数人分の朝の占いを1回で頼むプロンプト（usersは [(user_id, user_data), ...]）"""
+        weekday_msg = self.WEEKDAY_MESSAGES.get(fortune_date.weekday(), "")
+        inputs = []
+        for number, (user_id, user_data) in enumerate(users, start=1):
+            animal = user_data.get('animal_character') or {}
+            sanmeigaku = user_data.get('sanmeigaku') or {}
+            daily_fortune = FortuneCalculator.get_daily_element_fortune(
+                sanmeigaku.get('jikkan', '甲'), fortune_date
+            )
+            inputs.append({
+                "id": number,
+                "name": user_data.get('name', 'あなた') if FORTUNE_PERSONALIZE_NAME else 'あなた',
+                "animal": f"{animal.get('name', '')} - {animal.get('traits', '')}",
+                "sanmeigaku": f"{sanmeigaku.get('element', '')} - {sanmeigaku.get('traits', '')}",
+                "today_compatibility": daily_fortune.get('compatibility', ''),
+                "relationship_status": user_data.get('relationship_status', ''),
+                "main_concern": user_data.get('main_concern', ''),
+            })
+        
+        users_json = ",\n".join(json.dumps(item, ensure_ascii=False) for item in inputs)
+        return f"""
+以下の{len(users)}人それぞれに、今日の占いを作成してください。
+
+【日付】
+{fortune_date.strftime('%m月%d日')}（{weekday_msg}）
+
+【ユーザー一覧】
+[
+{users_json}
+]
+
+1人あたり200-250文字で以下を含めて：
+1. 今日の総合運（★5段階）
+2. 恋愛運のピークタイム（具体的な時間）
+3. 今日のラッキーアクション（ユニークで実践しやすい）
+4. 一言アドバイス
+
+明るく前向きで、読んだ人が行動したくなる内容で。
+絵文字を適度に使用。
+
+出力は次の形式のJSON配列だけにしてください（説明文やコードブロックは付けない）。
+[{{"id": 1, "fortune": "占いの本文"}}, ...]
+全員分、ちょうど{len(users)}件を出力すること。
+"""
+    
+    @staticmethod
+    def parse_morning_batch(text, count):
+        """まとめて生成した結果を {番号: 本文} にする（形式が正しいものだけ）"""
+        text = text.strip()
+        if text.startswith("```"):
+            # ```json ... ``` で囲まれて返ってくることがある
+            text = text.split("\n", 1)[-1].rsplit("```", 1)[0]
+        try:
+            items = json.loads(text)
+        except ValueError:
+            return {}
+        if not isinstance(items, list):
+            return {}
+        
+        bodies = {}
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            number = item.get('id')
+            body = item.get('fortune')
+            # JSONの true/false は int として扱われるので除く
+            if (isinstance(number, int) and not isinstance(number, bool)
+                    and 1 <= number <= count and number not in bodies
+                    and isinstance(body, str) and len(body.strip()) >= MIN_BATCH_FORTUNE_LENGTH):
+                bodies[number] = body.strip()
+        return bodies
+    
+    def generate_morning_fortune_batch(self, users, fortune_date):
+        """複数人分の朝の占いを生成して ([(user_id, message), ...], 件数の内訳) を返す
+
+        形式が正しくない・欠けている人の分は1人ずつ生成し直す。
+        呼び出し自体が失敗した人・生成し直しても失敗した人は結果に入れない
+        （フォールバックを保存せず、配信時の生成に任せる）。
+        """
+        prompt = self.build_morning_batch_prompt(users, fortune_date)
+        counts = {'batched': 0, 'retried': 0, 'deferred': 0}
+        try:
+            text = gemini.generate(prompt, priority=BATCH, timeout=FORTUNE_BATCH_TIMEOUT)
+        except Exception as e:
+            print(f"Gemini API error (batch of {len(users)}): {e}")
+            counts['deferred'] = len(users)
+            return [], counts
+        
+        # 全体が読めなかった場合も、1人ずつ生成し直す（フォールバックは保存しない）
+        bodies = self.parse_morning_batch(text, len(users))
+        messages = []
+        for number, (user_id, user_data) in enumerate(users, start=1):
+            body = bodies.get(number)
+            if body is None:
+                counts['retried'] += 1
+                try:
+                    message = self.generate_personalized_morning_fortune(
+                        user_data, fortune_date, fallback=False
+                    )
+                except Exception:
+                    counts['deferred'] += 1
+                    continue
+            else:
+                counts['batched'] += 1
+                message = self.render_morning_fortune(user_data, body, fortune_date)
+            messages.append((user_id, message))
+        return messages, counts
+    
     def send_morning_fortunes(self):
-        """毎朝の占い配信"""
+        """毎朝の占い配信（月曜日は有料ユーザーに週間占いも同じpushで送る）"""
         print(f"Starting morning fortune delivery at {datetime.now(JST)}")
         
-        users_data = self.load_users_data()
-        success_count = 0
-        error_count = 0
+        fortune_date = datetime.now(JST).date()
+        with_weekly = self.coalesces_weekly(fortune_date)
+        if with_weekly:
+            week_start = fortune_date
+            week_scores = FortuneCalculator.get_weekly_element_scores(week_start)
         
-        for user_id, user_data in users_data.items():
-            # オンボーディング完了ユーザーのみ
-            if not user_data.get('onboarding_complete', False):
-                continue
-            
-            # 有料プランチェック（今は全員に配信）
-            # if not user_data.get('is_premium', True):
-            #     continue
+        # オンボーディング完了ユーザーのみ（事前生成した占いも一緒に読み込む）
+        # 有料プランチェック（今は全員に配信）
+        # 配信記録のあるユーザーは飛ばす（再実行・途中からの再開でも二重に送らない）
+        fortune_kinds = ('morning', 'weekly') if with_weekly else ('morning',)
+        targets = self.iter_delivery_users(
+            daily_fortune=(fortune_date,) + fortune_kinds, undelivered=(fortune_date, 'morning')
+        )
+        
+        # 事前生成に間に合わなかったユーザー（深夜以降に登録など）はその場で生成
+        sources = {'pregenerated': 0, 'inline': 0, 'with_weekly': 0,
+                   'weekly_pregenerated': 0, 'weekly_inline': 0}
+        sources_lock = threading.Lock()
+        
+        def morning_message(user_id, user_data):
+            message = user_data.get('daily_fortune')
+            source = 'pregenerated' if message is not None else 'inline'
+            with sources_lock:
+                sources[source] += 1
+            if message is None:
+                message = self.generate_personalized_morning_fortune(user_data, fortune_date)
+            if with_weekly and user_data.get('is_premium'):
+                weekly = user_data.get('weekly_fortune')
+                source = 'weekly_pregenerated' if weekly is not None else 'weekly_inline'
+                if weekly is None:
+                    weekly = self.generate_weekly_fortune(user_data, week_start, week_scores)
+                with sources_lock:
+                    sources[source] += 1
+                    sources['with_weekly'] += 1
+                return [message, weekly]
+            return message
+        
+        result = self.deliver(
+            'Morning fortune delivery', targets, morning_message, ('morning', 'weekly'), fortune_date
+        )
+        print(f"  pre-generated: {sources['pregenerated']}, generated inline: {sources['inline']}")
+        result['sources'] = sources
+        if with_weekly:
+            # 週間占いを別に配信した場合と比べて、その人数分のpushと有料ユーザーの読み込みが減る
+            result['coalesced'] = {
+                'users': sources['with_weekly'],
+                'api_calls_saved': sources['with_weekly'],
+                'user_scans_saved': 1,
+                'db_reads_saved': sources['with_weekly'],
+            }
+            print(f"  weekly fortune sent with the morning push to {sources['with_weekly']} users: "
+                  f"saved {sources['with_weekly']} API calls, 1 user scan "
+                  f"({sources['with_weekly']} DB reads); weekly pre-generated: "
+                  f"{sources['weekly_pregenerated']}, generated inline: {sources['weekly_inline']}")
+        return result
+    
+    @staticmethod
+    def coalesces_weekly(fortune_date):
+        """その日の朝の配信に週間占いを含めるか"""
+        return COALESCE_MONDAY_DELIVERIES and fortune_date.weekday() == 0
+    
+    def deliver(self, name, targets, generate, kinds, delivery_date):
+        """generate(user_id, user_data) で作った文面を配信し、配信記録を残す
+
+        generate はテキスト1件か、1回で送るテキストのリストを返す。i 番目のテキストは
+        kinds[i] の配信として delivery_logs にまとめて記録する（再実行のときに飛ばすため）。
+        DELIVERY_MULTICAST が有効で FORTUNE_PERSONALIZE_NAME がオフなら、同じ文面の宛先は
+        multicast（500人ずつ）にまとめ、multicast・push の回数を結果の sends に入れる。
+        それ以外は生成できたユーザーから1人ずつ push する。
+        """
+        from database import DatabaseManager
+        
+        log = BatchWriter('Delivery log', DatabaseManager.save_delivery_logs)
+        
+        def record(user_id, count, status):
+            for kind in kinds[:count]:
+                log.add((user_id, delivery_date, kind, status))
+        
+        def dead_letter_kind(count):
+            return '+'.join(kinds[:count])
+        
+        # 名前入りの文面はほぼ全員違うので、multicast でまとめられるのは名前を入れないときだけ
+        if not (DELIVERY_MULTICAST and not FORTUNE_PERSONALIZE_NAME):
+            if DELIVERY_MULTICAST:
+                print("  multicast not used: scheduled texts include names "
+                      "(set FORTUNE_PERSONALIZE_NAME=false to share identical texts)")
+            def push(user_id, text):
+                count = len(text_messages(text))
+                try:
+                    self.push_text(user_id, text, dead_letter_kind(count))
+                except PushFailed:
+                    record(user_id, count, 'dead_lettered')
+                    raise
+                record(user_id, count, 'delivered')
             
+            engine = FanOutDelivery(name, generate=generate, push=push)
             try:
-                fortune_message = self.generate_personalized_morning_fortune(user_data)
-                
-                # LINE配信
-                line_bot_api.push_message(
-                    user_id,
-                    TextSendMessage(text=fortune_message)
+                result = engine.run(targets)
+            finally:
+                log.flush()
+            result['log'] = log.summary()
+            return result
+        
+        def delivered(recipients, texts):
+            for user_id in recipients:
+                record(user_id, len(texts), 'delivered')
+        
+        def failed(user_id, messages, error):
+            self.save_dead_letter(user_id, dead_letter_kind(len(messages)), messages, error)
+            record(user_id, len(messages), 'dead_lettered')
+        
+        batcher = MulticastBatcher(line_client, on_failure=failed, on_delivered=delivered)
+        engine = FanOutDelivery(name, generate=generate, push=batcher.add)
+        try:
+            result = engine.run(targets)
+        finally:
+            batcher.close()
+            log.flush()
+        
+        # FanOutDelivery の success は「送信待ちに入れた」件数なので、送れなかった分を差し替える
+        sends = batcher.summary()
+        result['success'] -= sends['failed']
+        result['errors'] += sends['failed']
+        result['sends'] = sends
+        result['log'] = log.summary()
+        print(f"  multicast: {sends['multicast_calls']} calls to {sends['multicast_recipients']} users, "
+              f"unicast: {sends['unicast_calls']} calls, failed: {sends['failed']} "
+              f"({sends['api_calls']} API calls for {sends['delivered'] + sends['failed']} users, "
+              f"{sends['api_calls_saved']} saved)")
+        print(f"  delivery log: {result['log']['written']} records in "
+              f"{result['log']['batches']['count']} writes, {result['log']['failed']} failed")
+        return result
+    
+    def push_text(self, user_id, text, kind='morning'):
+        """LINE配信（429・5xxは再送し、送れなかった分はデッドレターに保存して例外を投げ直す）
+
+        text はテキスト1件か、1回のpushで続けて送るテキストのリスト（5件まで）。
+        """
+        messages = text_messages(text)
+        try:
+            line_client.push_reliably(user_id, messages)
+        except PushFailed as e:
+            self.save_dead_letter(user_id, kind, messages, e)
+            raise
+    
+    @staticmethod
+    def save_dead_letter(user_id, kind, messages, failure):
+        from database import DatabaseManager
+        
+        # multicast の失敗は宛先ごとに新しい retry key で再送する
+        # （同じキーを使い回すと2人目以降の再送が409で送信済み扱いになる）
+        retry_key = getattr(failure, 'retry_key', None)
+        if retry_key is None or getattr(failure, 'to', None) != user_id:
+            retry_key = str(uuid.uuid4())
+        DatabaseManager.save_dead_letter(
+            user_id, kind,
+            [message.as_json_dict() for message in messages],
+            retry_key, getattr(failure, 'cause', failure),
+            status_code=getattr(failure, 'status_code', None),
+            attempts=getattr(failure, 'attempts', 0)
+        )
+    
+    def redrive_dead_letters(self, limit=None):
+        """デッドレターに残っているpushを再送
+
+        LINEが retry key を覚えている期間（LINE_RETRY_KEY_VALID_HOURS）内なら最初と同じキーを使い、
+        前の送信が実は届いていた場合に二重に届かないようにする。それより古いものは新しいキーで送る
+        （期限切れのキーは重複の判定に使われないため。前の送信が届いていれば二重に届く）。
+        """
+        from database import DatabaseManager
+        
+        letters = DatabaseManager.get_pending_dead_letters(limit)
+        print(f"Redriving {len(letters)} dead letters at {datetime.now(JST)}")
+        key_valid_since = datetime.now() - timedelta(hours=LINE_RETRY_KEY_VALID_HOURS)
+        
+        def redrive(letter_id, letter):
+            messages = [TextSendMessage(text=message['text']) for message in letter['messages']]
+            retry_key = letter['retry_key']
+            if letter['created_at'] is None or letter['created_at'] < key_valid_since:
+                retry_key = str(uuid.uuid4())
+            try:
+                attempts = line_client.push_reliably(
+                    letter['user_id'], messages, retry_key=retry_key
                 )
-                
-                success_count += 1
-                
-            except Exception as e:
-                print(f"Error sending to {user_id}: {e}")
-                error_count += 1
+            except PushFailed as e:
+                DatabaseManager.update_dead_letter(
+                    letter_id, error=e.cause, status_code=e.status_code, attempts=e.attempts
+                )
+                raise
+            DatabaseManager.update_dead_letter(letter_id, redriven=True, attempts=attempts)
         
-        print(f"Morning fortune delivery completed: {success_count} success, {error_count} errors")
+        engine = FanOutDelivery(
+            'Dead letter redrive',
+            generate=lambda letter_id, letter: letter,
+            push=redrive
+        )
+        return engine.run((letter['id'], letter) for letter in letters)
     
-    def generate_personalized_morning_fortune(self, user_data):
-        """個人用の朝の占い生成"""
-        now = datetime.now(JST)
-        name = user_data.get('name', 'あなた')
+    # 曜日別の特別メッセージ
+    WEEKDAY_MESSAGES = {
+        0: "月曜日、新しい週の始まり！",
+        1: "火曜日、エネルギーが高まる日",
+        2: "水曜日、バランスを大切に",
+        3: "木曜日、恋愛運のピーク！",
+        4: "金曜日、華やかな出会いの予感",
+        5: "土曜日、デート日和",
+        6: "日曜日、心の充電を"
+    }
+    
+    def build_morning_prompt(self, user_data, fortune_date, name=None):
+        """朝の占いのプロンプト（name=Noneならコホート共通の名前なし版）"""
         animal = user_data.get('animal_character', {})
         sanmeigaku = user_data.get('sanmeigaku', {})
         
         # 今日の運勢を算命学で計算
         daily_fortune = FortuneCalculator.get_daily_element_fortune(
-            sanmeigaku.get('jikkan', '甲')
+            sanmeigaku.get('jikkan', '甲'), fortune_date
         )
         
-        # 曜日別の特別メッセージ
-        weekday_messages = {
-            0: "月曜日、新しい週の始まり！",
-            1: "火曜日、エネルギーが高まる日",
-            2: "水曜日、バランスを大切に",
-            3: "木曜日、恋愛運のピーク！",
-            4: "金曜日、華やかな出会いの予感",
-            5: "土曜日、デート日和",
-            6: "日曜日、心の充電を"
-        }
+        weekday_msg = self.WEEKDAY_MESSAGES.get(fortune_date.weekday(), "")
         
-        weekday_msg = weekday_messages.get(now.weekday(), "")
+        if name is None:
+            request_line = "今日の占いを作成してください。\n名前は書かずに「あなた」と呼びかけてください。"
+        else:
+            request_line = f"{name}さんへの今日の占いを作成してください。"
         
-        prompt = f"""
-{name}さんへの今日の占いを作成してください。
+        return f"""
+{request_line}
 
 【基本情報】
-日付：{now.strftime('%m月%d日')}（{weekday_msg}）
+日付：{fortune_date.strftime('%m月%d日')}（{weekday_msg}）
 動物占い：{animal.get('name', '')} - {animal.get('traits', '')}
 算命学：{sanmeigaku.get('element', '')} - {sanmeigaku.get('traits', '')}
 今日の相性：{daily_fortune.get('compatibility', '')}
@@ -143,29 +708,48 @@ class FortuneScheduler:
 明るく前向きで、読んだ人が行動したくなる内容で。
 絵文字を適度に使用。
 """
+    
+    @staticmethod
+    def addressee(user_data):
+        """定期配信での呼びかけ（FORTUNE_PERSONALIZE_NAME がオフなら全員共通）"""
+        if not FORTUNE_PERSONALIZE_NAME:
+            return "あなた"
+        return f"{user_data.get('name', 'あなた')}さん"
+    
+    def morning_greeting(self, user_data):
+        if not FORTUNE_PERSONALIZE_NAME:
+            return "おはようございます☀️"
+        return f"おはようございます、{self.addressee(user_data)}☀️"
+    
+    def render_morning_fortune(self, user_data, body, fortune_date):
+        """生成された本文に名前と有料プラン誘導を差し込む"""
+        animal = user_data.get('animal_character', {})
+        sanmeigaku = user_data.get('sanmeigaku', {})
+        
+        base_message = f"""{self.morning_greeting(user_data)}
 
-        try:
-            response = model.generate_content(prompt)
-            
-            base_message = f"""おはようございます、{name}さん☀️
-
-【{now.strftime('%m月%d日')}の運勢】
+【{fortune_date.strftime('%m月%d日')}の運勢】
 {animal.get('name', '')}×{sanmeigaku.get('element', '')}
 
-{response.text}"""
-            
-            # 有料プラン誘導（無料ユーザーの場合）
-            if not user_data.get('is_premium', False):
-                base_message += "\n\n💎 詳細な時間別運勢は有料プランで！"
-            
-            return base_message
-            
-        except Exception as e:
-            print(f"Gemini API error: {e}")
-            # フォールバック
-            return f"""おはようございます、{name}さん☀️
+{body}"""
+        
+        # 有料プラン誘導（無料ユーザーの場合）
+        if not user_data.get('is_premium', False):
+            base_message += "\n\n💎 詳細な時間別運勢は有料プランで！"
+        
+        return base_message
+    
+    def render_morning_fallback(self, user_data, fortune_date):
+        """Gemini APIが使えない場合の朝の占い"""
+        animal = user_data.get('animal_character', {})
+        sanmeigaku = user_data.get('sanmeigaku', {})
+        daily_fortune = FortuneCalculator.get_daily_element_fortune(
+            sanmeigaku.get('jikkan', '甲'), fortune_date
+        )
+        
+        return f"""{self.morning_greeting(user_data)}
 
-【{now.strftime('%m月%d日')}の運勢】
+【{fortune_date.strftime('%m月%d日')}の運勢】
 総合運：{daily_fortune.get('compatibility', '★★★☆☆')}
 
 {animal.get('name', '')}の今日は
@@ -179,41 +763,108 @@ class FortuneScheduler:
 
 素敵な一日を！"""
     
+    def generate_personalized_morning_fortune(self, user_data, fortune_date=None, fallback=True):
+        """個人用の朝の占い生成（fortune_date省略時は今日）
+
+        fallback=False なら生成できなかったときにフォールバックを返さず例外を投げ直す（事前生成用）。
+        """
+        fortune_date = fortune_date or datetime.now(JST).date()
+        name = user_data.get('name', 'あなた') if FORTUNE_PERSONALIZE_NAME else None
+        prompt = self.build_morning_prompt(user_data, fortune_date, name)
+        
+        try:
+            text = gemini.generate(prompt, priority=BATCH)
+            return self.render_morning_fortune(user_data, text, fortune_date)
+            
+        except Exception as e:
+            print(f"Gemini API error: {e}")
+            if not fallback:
+                raise
+            # フォールバック
+            return self.render_morning_fallback(user_data, fortune_date)
+    
+    @staticmethod
+    def cohort_key(user_data, fortune_date):
+        """プロンプトの内容を決める属性の組（名前以外）"""
+        animal = user_data.get('animal_character') or {}
+        sanmeigaku = user_data.get('sanmeigaku') or {}
+        return (
+            animal.get('name', ''),
+            sanmeigaku.get('element', ''),
+            user_data.get('relationship_status') or '',
+            user_data.get('main_concern') or '',
+            fortune_date.weekday(),
+        )
+    
+    def generate_cohort_morning_body(self, user_data, fortune_date):
+        """コホート共通の本文を生成（名前を含まない）。失敗時はNone"""
+        prompt = self.build_morning_prompt(user_data, fortune_date)
+        try:
+            return gemini.generate(prompt, priority=BATCH)
+        except Exception as e:
+            print(f"Gemini API error: {e}")
+            return None
+    
     def send_weekly_fortunes(self):
         """週間占い配信（月曜日）"""
         print(f"Starting weekly fortune delivery at {datetime.now(JST)}")
         
-        users_data = self.load_users_data()
+        # 今週7日分の運勢スコア（10×7）は全員共通なので1回だけ作る
+        week_start = datetime.now(JST).date()
         
-        for user_id, user_data in users_data.items():
-            if not user_data.get('onboarding_complete', False):
-                continue
-            
-            # 有料ユーザーのみ（または全員）
-            if not user_data.get('is_premium', True):
-                continue
-            
-            try:
-                weekly_message = self.generate_weekly_fortune(user_data)
-                
-                line_bot_api.push_message(
-                    user_id,
-                    TextSendMessage(text=weekly_message)
-                )
-                
-            except Exception as e:
-                print(f"Error sending weekly to {user_id}: {e}")
+        # 朝の配信と一緒に送った日は、送れたユーザーが配信記録で飛ばされるので残りだけに送る。
+        # 朝の配信がまだ動いていると同じユーザーに2回送りかねないので、終わるまで待つ
+        if self.coalesces_weekly(week_start):
+            self.wait_for_job('morning_fortune', week_start)
+        week_scores = FortuneCalculator.get_weekly_element_scores(week_start)
+        
+        # 有料ユーザーのみ（または全員）。事前生成した週間占いも一緒に読み込む
+        targets = self.iter_delivery_users(
+            premium_only=True, daily_fortune=(week_start, 'weekly'), undelivered=(week_start, 'weekly')
+        )
+        
+        def weekly_message(user_id, user_data):
+            message = user_data.get('daily_fortune')
+            if message is None:
+                message = self.generate_weekly_fortune(user_data, week_start, week_scores)
+            return message
+        
+        return self.deliver('Weekly fortune delivery', targets, weekly_message, ('weekly',), week_start)
+    
+    WEEKDAY_LABELS = ['月', '火', '水', '木', '金', '土', '日']
+    WEEKLY_SCORE_LABELS = {5: '最高潮！', 4: '上昇中', 3: '安定', 2: '慎重に', 1: '充電日'}
     
-    def generate_weekly_fortune(self, user_data):
-        """週間占い生成"""
-        name = user_data.get('name', 'あなた')
+    def weekly_star_lines(self, user_data, week_start, week_scores):
+        """その週の日別スコアを「月：★★★☆☆ 安定」の形式で返す"""
+        jikkan = user_data.get('sanmeigaku', {}).get('jikkan', '')
+        row = JIKKAN_INDEX.get(jikkan)
+        lines = []
+        for offset in range(week_scores.shape[1]):
+            score = int(week_scores[row, offset]) if row is not None else 3
+            day = self.WEEKDAY_LABELS[(week_start + timedelta(days=offset)).weekday()]
+            lines.append(f"{day}：{'★' * score}{'☆' * (5 - score)} {self.WEEKLY_SCORE_LABELS[score]}")
+        return "\n".join(lines)
+    
+    def generate_weekly_fortune(self, user_data, week_start=None, week_scores=None, fallback=True):
+        """週間占い生成
+
+        fallback=False なら生成できなかったときにフォールバックを返さず例外を投げ直す（事前生成用）。
+        """
+        if week_start is None:
+            week_start = datetime.now(JST).date()
+        if week_scores is None:
+            week_scores = FortuneCalculator.get_weekly_element_scores(week_start)
+        addressee = self.addressee(user_data)
         animal = user_data.get('animal_character', {})
+        star_lines = self.weekly_star_lines(user_data, week_start, week_scores)
         
         prompt = f"""
-{name}さんの今週の恋愛運を作成してください。
+{addressee}の今週の恋愛運を作成してください。
 
 動物占い：{animal.get('name', '')}
 恋愛状況：{user_data.get('relationship_status', '')}
+日別の五行相性（5段階）：
+{star_lines}
 
 150文字程度で：
 1. 今週の全体運
@@ -222,26 +873,24 @@ class FortuneScheduler:
 4. 週間ラッキーアイテム
 
 グラフィカルに星（★☆）を使って表現。
+日別の星の数は上の五行相性に合わせてください。
 """
 
         try:
-            response = model.generate_content(prompt)
-            return f"""📅 {name}さんの週間恋愛運 📅
+            text = gemini.generate(prompt, priority=BATCH)
+            return f"""📅 {addressee}の週間恋愛運 📅
 
-{response.text}
+{text}
 
 詳細な日別診断は有料プランで！"""
             
-        except:
-            return f"""📅 {name}さんの週間恋愛運 📅
+        except Exception as e:
+            print(f"Gemini API error: {e}")
+            if not fallback:
+                raise
+            return f"""📅 {addressee}の週間恋愛運 📅
 
-月：★★★☆☆ 準備期間
-火：★★★★☆ 上昇開始
-水：★★★★★ 最高潮！
-木：★★★★☆ 継続良好
-金：★★★☆☆ 一休み
-土：★★★★☆ デート日和
-日：★★★☆☆ 充電日
+{star_lines}
 
 今週のテーマ：「素直な気持ち」"""
 
@@ -255,3 +904,8 @@ def init_scheduler():
 # アプリケーション終了時に停止
 def shutdown_scheduler():
     fortune_scheduler.shutdown()
+
+if __name__ == '__main__':
+    # python scheduler.py redrive : デッドレターの再送
+    if sys.argv[1:2] == ['redrive']:
+        fortune_scheduler.redrive_dead_letters()
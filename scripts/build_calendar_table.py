@@ -0,0 +1,32 @@
+"""暦テーブル（data/calendar_table.npy）の生成
+
+1900〜2100年の各日について年柱・日柱・動物占い60分類を計算して保存する。
+実行時は calendar_table.load_table() がこのファイルをメモリマップして引くだけになる。
+
+    python scripts/build_calendar_table.py
+"""
+import os
+import sys
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import calendar_table
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default=calendar_table.CALENDAR_TABLE_PATH)
+    args = parser.parse_args()
+
+    table = calendar_table.build_table()
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    np.save(args.output, table)
+    print(f"Wrote {len(table)} days ({calendar_table.FIRST_DATE} - {calendar_table.LAST_DATE}, "
+          f"{table.nbytes / 1024:.0f} KiB) to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""LineClient のテスト：ローカルに立てた LINE API の代わりのHTTPサーバーに送って確かめる"""
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from linebot.models import TextSendMessage
+
+import line_client
+from line_client import LineClient, PushFailed
+
+# 旧API（linebot.LineBotApi）の非推奨警告は出さない
+pytestmark = pytest.mark.filterwarnings('ignore::DeprecationWarning')
+
+
+class StandInLineServer(ThreadingHTTPServer):
+    """LINE Messaging API の代わりをするHTTPサーバー
+
+    responses[宛先] に返すステータスのリストを入れておくと先頭から順に返す（空なら200）。
+    'close' を入れると応答せずに接続を切り、'truncated' を入れると本文の途中で接続を切る。
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.latency = latency
+        self.responses = {}
+        self.requests = []  # (パス, 宛先, X-Line-Retry-Key)
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def next_response(self, to):
+        key = to if isinstance(to, str) else tuple(to)
+        with self.lock:
+            statuses = self.responses.get(key)
+            return statuses.pop(0) if statuses else 200
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive を有効にする
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+            self.server.requests.append(
+                (self.path, data['to'], self.headers.get('X-Line-Retry-Key'))
+            )
+        try:
+            time.sleep(self.server.latency)
+            status = self.server.next_response(data['to'])
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+        if status == 'close':
+            self.close_connection = True
+            return
+        if status == 'truncated':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', '100')
+            self.end_headers()
+            self.wfile.write(b'{"sent')
+            self.close_connection = True
+            return
+        body = b'{"sentMessages":[]}' if status == 200 else b'{"message":"stand-in error"}'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = StandInLineServer()
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(server, monkeypatch):
+    # 再試行の待ち時間を短くする
+    monkeypatch.setattr(line_client, 'LINE_RETRY_BASE_DELAY', 0.001)
+    return LineClient('dummy', endpoint=server.endpoint, max_in_flight=4)
+
+
+def pushes(count):
+    message = TextSendMessage(text="おはようございます")
+    return [(f"U{i}", [message]) for i in range(count)]
+
+
+def test_push_many_sends_in_parallel_up_to_max_in_flight(server, client):
+    server.latency = 0.05
+    result = client.push_many(pushes(40))
+
+    assert result['success'] == 40
+    assert result['errors'] == 0
+    assert len(server.requests) == 40
+    assert 1 < server.max_in_flight <= 4
+    # 逐次なら 40 * 0.05 = 2秒かかる
+    assert result['elapsed'] < 1.5
+
+
+def test_push_many_respects_explicit_max_in_flight(server, client):
+    server.latency = 0.02
+    result = client.push_many(pushes(20), max_in_flight=2)
+
+    assert result['success'] == 20
+    assert server.max_in_flight <= 2
+
+
+def test_push_many_reuses_pooled_connections(server, client):
+    server.latency = 0.01
+    result = client.push_many(pushes(50))
+
+    assert result['success'] == 50
+    # PooledHttpClient は共有セッションの接続を使い回すので、接続は同時に送る数まで
+    assert server.connections <= 4
+
+
+def test_push_many_calls_on_success_for_each_delivered_push(server, client):
+    server.responses['U3'] = [400]
+    delivered = []
+    result = client.push_many(pushes(10), on_success=delivered.append)
+
+    assert sorted(delivered) == sorted(f"U{i}" for i in range(10) if i != 3)
+    assert result['success'] == 9
+    assert [to for to, error in result['failed']] == ['U3']
+    assert isinstance(result['failed'][0][1], PushFailed)
+
+
+def test_push_reliably_retries_with_the_same_retry_key(server, client):
+    server.responses['U1'] = [500, 429, 'close']
+    attempts = client.push_reliably('U1', [TextSendMessage(text="hi")])
+
+    assert attempts == 4
+    retry_keys = [key for path, to, key in server.requests]
+    assert len(retry_keys) == 4
+    assert len(set(retry_keys)) == 1 and retry_keys[0]
+    assert client.counters['retries'] == 3
+    assert client.counters['server_errors'] == 1
+    assert client.counters['rate_limited'] == 1
+    assert client.counters['network_errors'] == 1
+
+
+def test_push_reliably_treats_409_as_already_delivered(server, client):
+    server.responses['U1'] = [409]
+    attempts = client.push_reliably('U1', [TextSendMessage(text="hi")], retry_key='key-1')
+
+    assert attempts == 1
+    assert client.counters['duplicates'] == 1
+    assert client.counters['gave_up'] == 0
+    assert server.requests == [('/v2/bot/message/push', 'U1', 'key-1')]
+
+
+def test_push_reliably_gives_up_after_max_retries(server, client):
+    server.responses['U1'] = [503] * 10
+    with pytest.raises(PushFailed) as failed:
+        client.push_reliably('U1', [TextSendMessage(text="hi")], retry_key='key-1', max_retries=2)
+
+    assert failed.value.attempts == 3
+    assert failed.value.status_code == 503
+    assert failed.value.retry_key == 'key-1'
+    assert client.counters['gave_up'] == 1
+    assert len(server.requests) == 3
+
+
+def test_push_reliably_does_not_retry_client_errors(server, client):
+    server.responses['U1'] = [400]
+    with pytest.raises(PushFailed) as failed:
+        client.push_reliably('U1', [TextSendMessage(text="hi")])
+
+    assert failed.value.attempts == 1
+    assert failed.value.status_code == 400
+    assert len(server.requests) == 1
+
+
+def test_multicast_reliably_sends_one_request_for_all_recipients(server, client):
+    recipients = [f"U{i}" for i in range(5)]
+    server.responses[tuple(recipients)] = [500]
+    attempts = client.multicast_reliably(recipients, [TextSendMessage(text="hi")])
+
+    assert attempts == 2
+    assert [(path, to) for path, to, key in server.requests] == [
+        ('/v2/bot/message/multicast', recipients)
+    ] * 2
+    assert client.counters['multicast_recipients'] == 5
+
+
+def test_push_reliably_wraps_other_request_errors_in_push_failed(server, client):
+    server.responses['U1'] = ['truncated']
+    with pytest.raises(PushFailed) as failed:
+        client.push_reliably('U1', [TextSendMessage(text="hi")], retry_key='key-1')
+
+    assert failed.value.retry_key == 'key-1'
+    assert client.counters['network_errors'] == 1
+    assert client.counters['gave_up'] == 1
+
+
+def test_push_reliably_wraps_unexpected_errors_in_push_failed(server, client, monkeypatch):
+    def broken_push(to, messages, retry_key=None):
+        raise ValueError("unreadable response")
+    monkeypatch.setattr(client, 'push_message', broken_push)
+
+    with pytest.raises(PushFailed) as failed:
+        client.push_reliably('U1', [TextSendMessage(text="hi")], retry_key='key-1')
+
+    assert isinstance(failed.value.cause, ValueError)
+    assert failed.value.attempts == 1
+    assert client.counters['other_errors'] == 1
+    assert client.counters['gave_up'] == 1
@@ -0,0 +1,140 @@
+import os
+import time
+import queue
+import threading
+import zlib
+
+from delivery import StageStats
+
+# ワーカー設定（環境変数で調整可能）
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 4))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 500))
+# キューが満杯のときに空きを待つ秒数（過ぎたらイベントを捨てる）
+WEBHOOK_SUBMIT_TIMEOUT = float(os.environ.get('WEBHOOK_SUBMIT_TIMEOUT', 0.5))
+# 終了時に残りのイベントを処理しきるまで待つ秒数
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get('WEBHOOK_DRAIN_TIMEOUT', 20))
+
+_STOP = object()
+
+
+class WebhookWorkerPool:
+    """Webhookの処理をバックグラウンドで行うワーカープール
+
+    同じユーザーのイベントは常に同じワーカーに振り分けるため、
+    オンボーディングのように順序が重要な会話も追い越しが起きない。
+    キューが満杯の場合は submit_timeout 秒だけ空きを待ち、空かなければイベントを捨てて
+    rejected に数える（呼び出し元で処理するとWebhookへの200が遅れ、負荷が高いときほど詰まるため）。
+    停止を始めた後に届いたイベントだけは呼び出し元のスレッドで処理する。
+    """
+
+    def __init__(self, process, workers=None, queue_size=None, submit_timeout=None):
+        self.process = process
+        self.workers = workers or WEBHOOK_WORKERS
+        self.queue_size = queue_size or WEBHOOK_QUEUE_SIZE
+        self.submit_timeout = WEBHOOK_SUBMIT_TIMEOUT if submit_timeout is None else submit_timeout
+        self.queues = []
+        self.threads = []
+        self.accepting = True
+        self.wait_stats = StageStats('queue wait', window=1000)
+        self.process_stats = StageStats('processing', window=1000)
+        self.counters = {'enqueued': 0, 'inline': 0, 'rejected': 0, 'max_depth': 0}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        """ワーカーを起動（gunicornのfork後に各プロセスで起動されるよう遅延させる）"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+            self.threads = []
+            for i, q in enumerate(self.queues):
+                thread = threading.Thread(
+                    target=self._run, args=(q,), name=f'webhook-worker-{i}', daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+            self._pid = os.getpid()
+
+    def submit(self, shard_key, *args):
+        """処理をキューに積む（満杯のまま空かなければ捨てる。停止中ならその場で処理）"""
+        if self.accepting:
+            self._ensure_started()
+            q = self.queues[zlib.crc32(str(shard_key).encode('utf-8')) % self.workers]
+            try:
+                q.put((time.monotonic(), args), timeout=self.submit_timeout)
+            except queue.Full:
+                with self._lock:
+                    self.counters['rejected'] += 1
+                print(f"Webhook queue full: dropped an event for {shard_key}")
+                return False
+            with self._lock:
+                self.counters['enqueued'] += 1
+                self.counters['max_depth'] = max(self.counters['max_depth'], self.depth())
+            return True
+        with self._lock:
+            self.counters['inline'] += 1
+        self._process(time.monotonic(), args)
+        return False
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            try:
+                if item is _STOP:
+                    return
+                enqueued_at, args = item
+                self._process(enqueued_at, args)
+            finally:
+                q.task_done()
+
+    def _process(self, enqueued_at, args):
+        started = time.monotonic()
+        self.wait_stats.record(started - enqueued_at)
+        try:
+            self.process(*args)
+            self.process_stats.record(time.monotonic() - started)
+        except Exception as e:
+            self.process_stats.record(time.monotonic() - started, ok=False)
+            print(f"Webhook processing error: {e}")
+
+    def drain(self, timeout=None):
+        """新規受付を止め、キューに残ったイベントを処理してからワーカーを停止"""
+        timeout = WEBHOOK_DRAIN_TIMEOUT if timeout is None else timeout
+        if not self.accepting:
+            return
+        self.accepting = False
+        if self._pid != os.getpid():
+            return
+        remaining = self.depth()
+        deadline = time.monotonic() + timeout
+        stopping = []
+        for q, thread in zip(self.queues, self.threads):
+            try:
+                # キューが満杯のまま空かなければ、そのワーカーは止めずに終わる（daemonスレッド）
+                q.put(_STOP, timeout=max(0.0, deadline - time.monotonic()))
+                stopping.append(thread)
+            except queue.Full:
+                pass
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        # 停止できなかったワーカーのキューには_STOPが残っている
+        left = max(0, self.depth() - sum(thread.is_alive() for thread in stopping))
+        print(f"Webhook workers drained: {remaining - left} processed, {left} left")
+
+    def stats(self):
+        """キューの深さと処理レイテンシ"""
+        with self._lock:
+            counters = dict(self.counters)
+        return dict(
+            counters,
+            depth=self.depth(),
+            workers=self.workers,
+            queue_wait=self.wait_stats.summary(),
+            processing=self.process_stats.summary(),
+        )